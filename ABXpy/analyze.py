@@ -42,6 +42,7 @@ import warnings
 import sys
 
 from ABXpy.misc.type_fitting import fit_integer_type
+from ABXpy.task import read_triplets, regressors_group
 
 reload(sys)
 sys.setdefaultencoding('utf8')
@@ -69,12 +70,15 @@ def unique_rows(arr):
             .view(arr.dtype).reshape(-1, arr.shape[1]))
 
 
-def collapse(scorefile, taskfile, fid):
+def collapse(scorefile, taskfile, fid, chunk_size=10 ** 6):
     """Collapses the results for each triplets sharing the same on, across
     and by labels.
 
+    The triplets and scores are read by chunks of chunk_size, so that
+    the memory used depends on the number of distinct labels rather than
+    on the number of triplets.
+
     """
-    # We make the assumption that everything fits in memory...
     scorefid = h5py.File(scorefile)
     taskfid = h5py.File(taskfile)
     bys = taskfid['bys'][...]
@@ -82,41 +86,47 @@ def collapse(scorefile, taskfile, fid):
         # print 'collapsing {0}/{1}'.format(by_idx + 1, len(bys))
         trip_attrs = taskfid['triplets']['by_index'][by_idx]
 
-        tfrk = taskfid['regressors'][by]
-
-        tmp = tfrk[u'indexed_data']
-        indices = np.array(tmp)
-        if indices.size == 0:
-            continue
-        tmp = scorefid['scores'][trip_attrs[0]:trip_attrs[1]]
-        scores_arr = np.array(tmp)
-        tmp = np.ascontiguousarray(indices).view(
-            np.dtype((np.void, indices.dtype.itemsize * indices.shape[1])))
-        n_indices = np.max(indices, 0) + 1
+        tfrk = regressors_group(taskfid, by)
+        regs = tfrk['indexed_datasets']
+        indexes = []
+        for reg in regs:
+            indexes.append(tfrk['indexes'][reg][:])
+        nregs = len(regs)
+        n_indices = np.array([len(index) for index in indexes])
         assert np.prod(n_indices) < 18446744073709551615, "type not big enough"
         ind_type = fit_integer_type(np.prod(n_indices),
                                     is_signed=False)
-        # encoding the indices of a triplet to a unique index
-        new_index = indices[:, 0].astype(ind_type)
-        for i in range(1, len(n_indices)):
-            new_index = indices[:, i] + n_indices[i] * new_index
-
-        permut = np.argsort(new_index)
+        n_indices = n_indices.astype(ind_type)
+
+        # sum and count of the scores of each label in each chunk
+        keys, sums, counts = [], [], []
+        start = trip_attrs[0]
+        for _, indices in read_triplets(taskfid, by_idx, chunk_size,
+                                        regressors=True):
+            stop = start + indices.shape[0]
+            scores_arr = scorefid['scores'][start:stop, 0]
+            start = stop
+            # encoding the indices of a triplet to a unique index
+            new_index = indices[:, 0].astype(ind_type)
+            for i in range(1, len(n_indices)):
+                new_index = indices[:, i] + n_indices[i] * new_index
+            chunk_keys, inverse = np.unique(new_index, return_inverse=True)
+            keys.append(chunk_keys)
+            sums.append(np.bincount(inverse, weights=scores_arr))
+            counts.append(np.bincount(inverse))
+        if not keys:
+            continue
 
         # collapsing the score
-        sorted_scores = scores_arr[permut]
-        sorted_index = new_index[permut]
-        mean, unique_index, counts = unique(sorted_index, sorted_scores)
+        unique_index, inverse = np.unique(
+            np.concatenate(keys), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(counts))
+        mean = np.bincount(inverse, weights=np.concatenate(sums)) / counts
+        mean = (mean + 1) / 2
 
         # retrieving the triplet indices from the unique index.
         tmp = npdecode(unique_index, n_indices)
 
-        regs = tfrk['indexed_datasets']
-        indexes = []
-        for reg in regs:
-            indexes.append(tfrk['indexes'][reg][:])
-        nregs = len(regs)
-
         for i, key in enumerate(tmp):
             aux = list()
             for j in range(nregs):
@@ -134,22 +144,6 @@ def collapse(scorefile, taskfile, fid):
     # return results
 
 
-def unique(index, scores):
-    flag = np.concatenate(
-        ([True], index[1:] != index[:-1], [True]))
-    unique_idx = np.nonzero(flag)[0]
-    counts = unique_idx[1:] - unique_idx[:-1]
-    unique_index = index[unique_idx[:-1]]
-
-    means = np.empty((len(counts)),)
-    i = 0
-    for a, c in enumerate(counts):
-        means[a] = np.mean(scores[i:i+c])
-        i += c
-    means = (means + 1) / 2
-    return means, unique_index, counts
-
-
 def analyze(task_file, score_file, result_file):
     """Analyse the results of a task
 
@@ -165,8 +159,7 @@ def analyze(task_file, score_file, result_file):
     """
     with open(result_file, 'w+') as fid:
         taskfid = h5py.File(task_file)
-        aux = taskfid['regressors']
-        tfrk = aux[aux.keys()[0]]
+        tfrk = regressors_group(taskfid, taskfid['bys'][0])
         regs = tfrk['indexed_datasets']
         string = ''
         for reg in regs:
@@ -1,4 +1,5 @@
 # make sure the rest of the ABXpy package is accessible
+import collections
 import os
 import sys
 package_path = os.path.dirname(
@@ -10,25 +11,176 @@ if not(package_path in sys.path):
 import pandas
 import numpy
 import ABXpy.misc.tinytree as tinytree
+from ABXpy.misc.type_fitting import fit_integer_type
 
 
 # FIXME use just one isolated | as a separator instead of two #
 
+# version of the sidecar format, to be incremented when it changes
+SIDECAR_VERSION = 1
+
+
+def sidecar_name(filename):
+    """Name of the binary sidecar caching the content of a table file"""
+    return filename + '.npz'
+
+
 # custom read_table that ignore empty entries at the end of a file (they
 # can result from trailing white spaces at the end for example)
-def read_table(filename):
-    db = pandas.read_table(filename, sep='[ \t]+', engine='python')
+def read_table(filename, sidecar=False):
+    """Read a whitespace-delimited table file in a pandas.DataFrame
+
+    If sidecar is True, the parsed table is read from (or written to) a
+    binary sidecar next to the file (see sidecar_name), which is used as
+    long as the size and modification time of the file do not change.
+
+    """
+    db = None
+    if sidecar:
+        db = _read_sidecar(filename)
+    if db is None:
+        # the C parser is much faster than the python one required by
+        # a regular expression separator
+        db = pandas.read_table(filename, delim_whitespace=True)
+        if sidecar:
+            _write_sidecar(filename, db)
     # removes row with all null values (None or NaN...)
     db = db.dropna(how='all')
     return db
 
+
+def encode_frame(db):
+    """Encode a pandas.DataFrame as a dict of numpy arrays
+
+    The string (object) columns are stored as integer codes ('codes_<i>'
+    for the i-th column) with the sorted table of their distinct values
+    ('table_<i>'), and the other columns as their values ('values_<i>').
+    'columns' and 'index' contain the column names and the index. None of
+    these arrays contains python objects, so that they can be saved with
+    numpy and memory-mapped.
+
+    """
+    arrays = {'columns': numpy.array(db.columns.tolist()),
+              'index': db.index.values}
+    for i, col in enumerate(db.columns):
+        if db[col].dtype == object:
+            codes, table = pandas.factorize(db[col], sort=True)
+            arrays['codes_{}'.format(i)] = codes.astype(
+                fit_integer_type(len(table), is_signed=True))
+            arrays['table_{}'.format(i)] = numpy.array(
+                [str(e) for e in table])
+        else:
+            arrays['values_{}'.format(i)] = db[col].values
+    return arrays
+
+
+def decode_frame(arrays, rows=None, columns=None):
+    """Decode a pandas.DataFrame encoded by encode_frame
+
+    rows and columns, if specified, select the rows (a slice or an array
+    of positions) and the columns (a list of names) to decode, the rest
+    of the arrays being left untouched.
+
+    """
+    if rows is None:
+        rows = slice(None)
+    all_columns = arrays['columns'].tolist()
+    if columns is None:
+        columns = all_columns
+    db = pandas.DataFrame(index=pandas.Index(arrays['index'][rows]))
+    for col in columns:
+        i = all_columns.index(col)
+        if 'table_{}'.format(i) in arrays:
+            # categorical column: decode the string table, the missing
+            # values having the code -1
+            table = arrays['table_{}'.format(i)].astype(object)
+            codes = numpy.asarray(arrays['codes_{}'.format(i)][rows])
+            values = numpy.empty(len(codes), dtype=object)
+            values[:] = numpy.nan
+            values[codes >= 0] = table[codes[codes >= 0]]
+            db[col] = values
+        else:
+            db[col] = numpy.asarray(arrays['values_{}'.format(i)][rows])
+    db.columns = pandas.Index(columns)
+    return db
+
+
+def encode_table(table):
+    """Encode the table of a coded column (see encode_columns) as an
+    array without python objects, the values being stored as strings if
+    they are not numbers"""
+    table = numpy.asarray(table)
+    if table.dtype == object:
+        return numpy.array([str(e) for e in table])
+    return table
+
+
+def decode_table(array):
+    """Decode a table encoded by encode_table"""
+    if array.dtype.kind in 'SU':
+        return array.astype(object)
+    return array
+
+
+def _source_info(filename):
+    """Size and modification time identifying the version of a file"""
+    stat = os.stat(filename)
+    return numpy.array([stat.st_size, stat.st_mtime], dtype=numpy.float64)
+
+
+def _read_sidecar(filename):
+    """Table cached in the sidecar of filename, None if not usable"""
+    name = sidecar_name(filename)
+    if not os.path.isfile(name):
+        return None
+    try:
+        with numpy.load(name) as data:
+            if (data['version'] != SIDECAR_VERSION or not
+                    numpy.array_equal(data['source'],
+                                      _source_info(filename))):
+                return None
+            return decode_frame({key: data[key] for key in data.files})
+    except (IOError, OSError, KeyError, ValueError):
+        # corrupted or incompatible sidecar, parse the text file again
+        return None
+
+
+def _write_sidecar(filename, db):
+    """Cache a parsed table in the sidecar of filename
+
+    The table is encoded with encode_frame. The sidecar is written under a
+    temporary name and renamed so that a concurrent reader never sees a
+    partial file. Errors (such as a read-only directory) are ignored, the
+    table being then parsed again next time.
+
+    """
+    name = sidecar_name(filename)
+    arrays = encode_frame(db)
+    arrays['version'] = numpy.array(SIDECAR_VERSION)
+    arrays['source'] = _source_info(filename)
+    tmp = name + '.{}.tmp'.format(os.getpid())
+    try:
+        with open(tmp, 'wb') as fid:
+            numpy.savez(fid, **arrays)
+        os.rename(tmp, name)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 # function that loads a database
-def load(filename, features_info=False):
+def load(filename, features_info=False, sidecar=False):
+    """Load an item file and its auxiliary files
+
+    If sidecar is True, the tables are cached in binary sidecar files
+    (see read_table), making the next loads much faster.
+
+    """
     # reading the main database using pandas (it is now a DataFrame)
     ext = '.item'
     if not(filename[len(filename) - len(ext):] == ext):
         filename = filename + ext
-    db = read_table(filename)
+    db = read_table(filename, sidecar)
 
     # finding '#' (to separate location info from attribute info) and fixing
     # names of columns
@@ -61,7 +213,8 @@ def load(filename, features_info=False):
     # for optimizing regressor generation and filtering)
 
     (basename, _) = os.path.splitext(filename)
-    db, db_hierarchy = load_aux_dbs(basename, db, db.columns, filename)
+    db, db_hierarchy = load_aux_dbs(
+        basename, db, db.columns, filename, sidecar)
 
     # dealing with missing items: for now rows with missing items are dropped
     nanrows = numpy.any(pandas.isnull(db), 1)
@@ -80,21 +233,21 @@ def load(filename, features_info=False):
 
 
 # recursive auxiliary function for loading the auxiliary databases
-def load_aux_dbs(basename, db, cols, mainfile):
+def load_aux_dbs(basename, db, cols, mainfile, sidecar=False):
     forest = [tinytree.Tree() for col in cols]
     for i, col in enumerate(cols):
         forest[i].name = col
         try:
             auxfile = basename + '.' + col
             if not(auxfile == mainfile):
-                auxdb = read_table(auxfile)
+                auxdb = read_table(auxfile, sidecar)
                 assert col == auxdb.columns[0], (
                     'First column name in file %s'
                     ' is %s. It should be %s instead.' % (
                         auxfile, auxdb.columns[0], col))
                 # call get_aux_dbs on child columns
                 auxdb, auxforest = load_aux_dbs(
-                    basename, auxdb, auxdb.columns[1:])
+                    basename, auxdb, auxdb.columns[1:], mainfile, sidecar)
                 # add to forest
                 forest[i].addChildrenFromList(auxforest)
                 # merging the databases
@@ -104,3 +257,256 @@ def load_aux_dbs(basename, db, cols, mainfile):
         except IOError:
             pass
     return db, forest
+
+
+def encode_columns(db, columns):
+    """Integer codes of some columns of a database
+
+    Returns
+    -------
+    codes : dict
+        For each column, an integer array aligned with the rows of db.
+    tables : dict
+        For each column, the sorted array of its distinct values, the code
+        of a value being its position in this array.
+
+    """
+    codes, tables = {}, {}
+    for col in columns:
+        col_codes, table = pandas.factorize(db[col], sort=True)
+        codes[col] = col_codes.astype(
+            fit_integer_type(len(table), is_signed=True))
+        tables[col] = numpy.asarray(table)
+    return codes, tables
+
+
+class CodedGroups(object):
+    """Groups of the rows of a database sharing the same values in some
+    columns, computed from the integer codes of these columns
+
+    Lightweight counterpart of db.groupby(columns) providing its size,
+    ngroup and groups methods and attributes. The groups are sorted by
+    their keys, a key being the value of the column for a single column
+    and the tuple of the values otherwise.
+
+    Parameters
+    ----------
+    index : pandas.Index
+        The index of the grouped database.
+    codes : dict
+        For each column, the codes of the rows of the grouped database.
+    tables : dict
+        For each column, the values of the codes (see encode_columns).
+    columns : list
+        The grouping columns.
+    group_codes : numpy.array, optional
+        The group of each row, if already known (see the group_codes
+        attribute).
+
+    """
+    def __init__(self, index, codes, tables, columns, group_codes=None):
+        self.index = index
+        self.columns = columns
+        if group_codes is None:
+            # the codes of the successive columns are combined
+            # lexicographically, and ranked again after each column so
+            # that the combined codes never overflow
+            group_codes = numpy.zeros(len(index), dtype=numpy.int64)
+            for col in columns:
+                group_codes = (group_codes * len(tables[col]) +
+                               codes[col].astype(numpy.int64))
+                _, group_codes = numpy.unique(
+                    group_codes, return_inverse=True)
+        self.group_codes = numpy.asarray(group_codes, dtype=numpy.int64)
+        self.counts = numpy.bincount(self.group_codes)
+        # rows sorted by group, and boundaries of the groups in this order
+        self.order = numpy.argsort(self.group_codes, kind='mergesort')
+        self.bounds = numpy.concatenate(([0], numpy.cumsum(self.counts)))
+        # the key of a group is read from its first row
+        first = self.order[self.bounds[:-1]]
+        self.values = [tables[col][codes[col][first]] for col in columns]
+        self._groups = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def keys(self):
+        """The keys of the groups, in sorted order"""
+        if len(self.columns) == 1:
+            return list(self.values[0])
+        return list(zip(*self.values))
+
+    def size(self):
+        """Number of rows in each group, as a pandas.Series indexed by
+        the group keys"""
+        if len(self.columns) == 1:
+            index = pandas.Index(self.values[0], name=self.columns[0])
+        else:
+            index = pandas.MultiIndex.from_arrays(
+                self.values, names=self.columns)
+        return pandas.Series(self.counts, index=index)
+
+    def ngroup(self):
+        """Number of the group of each row, as a pandas.Series"""
+        return pandas.Series(self.group_codes, index=self.index)
+
+    @property
+    def groups(self):
+        """dict from group keys to the index labels of their rows"""
+        if self._groups is None:
+            labels = self.index.values[self.order]
+            self._groups = {
+                key: pandas.Index(labels[start:stop])
+                for key, start, stop in zip(
+                    self.keys(), self.bounds[:-1], self.bounds[1:])}
+        return self._groups
+
+
+class LazyDict(collections.MutableMapping):
+    """dict whose values are computed on first access
+
+    Parameters
+    ----------
+    loaders : dict
+        For each key, a function without arguments returning its value.
+        The value is then kept, values can also be set directly.
+
+    """
+    def __init__(self, loaders):
+        self._loaders = dict(loaders)
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            self._values[key] = self._loaders[key]()
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._loaders[key] = None
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._loaders[key]
+        self._values.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+
+class AntiacrossIndex(object):
+    """Items whose values differ from a given key in each of some columns
+
+    Used for the 'antiacross' items of a block when there are several
+    'across' columns: the possible X of a block are the items sharing its
+    'on' value but none of its 'across' values. Rather than storing the
+    list of these items for each key, they are found from the integer
+    codes of the items when queried.
+
+    Parameters
+    ----------
+    index : pandas.Index
+        The index of the database.
+    codes : dict
+        For each column, the codes of the rows of the database.
+    tables : dict
+        For each column, the values of the codes (see encode_columns).
+    columns : list
+        The columns.
+
+    """
+    def __init__(self, index, codes, tables, columns):
+        self.index = index
+        self.columns = columns
+        self.codes = [codes[col] for col in columns]
+        self.sizes = [len(tables[col]) for col in columns]
+        # hash tables giving the code of a value in each column
+        self.positions = [pandas.Index(tables[col]) for col in columns]
+
+    def key_codes(self, key):
+        """Codes of the values of a key (a tuple with a value per column)"""
+        return [positions.get_loc(value)
+                for positions, value in zip(self.positions, key)]
+
+    def mask(self, key, rows=None):
+        """Boolean mask of the rows differing from key in every column
+
+        rows are positions in the database, all the rows by default.
+
+        """
+        mask = numpy.ones(len(self.index) if rows is None else len(rows),
+                          dtype=bool)
+        for codes, code in zip(self.codes, self.key_codes(key)):
+            if rows is not None:
+                codes = codes[rows]
+            mask &= codes != code
+        return mask
+
+    def items(self, key):
+        """Index labels of the rows differing from key in every column"""
+        return self.index[self.mask(key)]
+
+    def group_counts(self, keys, groups, weights=None):
+        """Number of rows of each group differing from each key in every
+        column
+
+        The counts are obtained by inclusion-exclusion from the numbers of
+        rows of each group sharing the values of the keys for each subset
+        of the columns, in one vectorized pass per subset.
+
+        Parameters
+        ----------
+        keys : list
+            The keys.
+        groups : CodedGroups
+            Groups of the rows of the database.
+        weights : numpy.array, optional
+            If specified, the weight of each row, the sums of the weights
+            of the rows being returned instead of their numbers.
+
+        Returns
+        -------
+        counts : numpy.array
+            counts[i, j] is the number of rows in the j-th group differing
+            from the i-th key in every column.
+
+        """
+        n_groups = len(groups)
+        if len(groups.group_codes) == 0:
+            return numpy.zeros((len(keys), n_groups), dtype=numpy.int64)
+        key_codes = numpy.array([self.key_codes(key) for key in keys],
+                                dtype=numpy.int64).reshape(
+                                    len(keys), len(self.columns))
+        if weights is None:
+            group_sizes = groups.counts.astype(numpy.int64)
+        else:
+            group_sizes = numpy.bincount(
+                groups.group_codes, weights, minlength=n_groups)
+        counts = numpy.tile(group_sizes, (len(keys), 1))
+        group_range = numpy.arange(n_groups, dtype=numpy.int64)
+        for subset in _nonempty_subsets(len(self.columns)):
+            # combined code of (group, values of the columns in subset)
+            row_codes = groups.group_codes.copy()
+            query = numpy.zeros(len(keys), dtype=numpy.int64)
+            base = 1
+            for j in subset:
+                row_codes = (row_codes * self.sizes[j] +
+                             self.codes[j].astype(numpy.int64))
+                query = query * self.sizes[j] + key_codes[:, j]
+                base = base * self.sizes[j]
+            uniques, inverse = numpy.unique(row_codes, return_inverse=True)
+            sizes = numpy.bincount(inverse, weights)
+            query = group_range[None, :] * base + query[:, None]
+            found = numpy.searchsorted(uniques, query)
+            found = numpy.minimum(found, len(uniques) - 1)
+            shared = numpy.where(uniques[found] == query, sizes[found], 0)
+            counts += (-1) ** len(subset) * shared
+        return counts
+
+
+def _nonempty_subsets(n):
+    """Non-empty subsets of range(n), as tuples"""
+    return [tuple(j for j in range(n) if i & (1 << j))
+            for i in range(1, 2 ** n)]
@@ -6,18 +6,30 @@ Created on Fri Dec 20 13:36:52 2013
 """
 
 import numpy as np
+import pandas as pd
 import dbfun
 
 
 class DBfun_Column(dbfun.DBfun):
 
-    def __init__(self, name, db=None, column=None, indexed=True):
+    # table is the sorted array of the values of the column, if it is
+    # stored as integer codes (see database.encode_columns). If coded is
+    # set to True, the column is given as these codes in the context,
+    # which are then directly the positions of its values in the index
+    def __init__(self, name, db=None, column=None, indexed=True,
+                 table=None):
         self.input_names = [name]
         self.n_outputs = 1
+        self.coded = False
         if indexed:
-            index = list(set(db[column]))
-            index.sort()
+            if table is None:
+                index = list(set(db[column]))
+                index.sort()
+            else:
+                index = list(table)
             self.index = index
+            # hash table giving the position of a value in the index
+            self.positions = pd.Index(index)
         else:
             self.index = []
 
@@ -31,9 +43,10 @@ class DBfun_Column(dbfun.DBfun):
     # function for evaluating the column function given data for the context
     # context is a dictionary with just the right name/content associations
     def evaluate(self, context):
-        if self.index:
-            # FIXME optimize this
-            return [np.array([self.index.index(e)
-                    for e in context[self.input_names[0]]])]
+        if self.index and self.coded:
+            return [np.asarray(context[self.input_names[0]], dtype=np.int64)]
+        elif self.index:
+            return [self.positions.get_indexer(
+                list(context[self.input_names[0]]))]
         else:
             return [context[self.input_names[0]]]
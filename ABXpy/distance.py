@@ -27,8 +27,38 @@ def default_distance(x, y, normalized):
     return d
 
 
+def default_distance_many(x, ys, normalized):
+    """ Dynamic time warping cosine distances between each y of ys and x
+
+    Batched counterpart of default_distance (see
+    ABXpy.distances.distances.run_distance_job), returning the array of
+    the default_distance(y, x) for y in ys: the cosine distances between
+    the frames of all the ys and those of x are computed at once, on the
+    stacked frames of the ys, and DTW is then run on the rows of each y.
+    """
+    lengths = np.array([y.shape[0] for y in ys], dtype=np.int64)
+    if x.shape[0] == 0:
+        return np.where(lengths == 0, 0., np.inf)
+    d = np.empty(len(ys))
+    d.fill(np.inf)
+    nonempty = np.flatnonzero(lengths)
+    if len(nonempty) > 0:
+        dist = cosine.cosine_distance(
+            np.concatenate([ys[i] for i in nonempty]), x)
+        bounds = np.cumsum(lengths[nonempty])
+        for i, start, stop in zip(nonempty, bounds - lengths[nonempty],
+                                  bounds):
+            d[i] = dtw._dtw(stop - start, x.shape[0], dist[start:stop],
+                            normalized)
+    return d
+
+
+default_distance.distance_many = default_distance_many
+
+
 def run(features, task, output, normalized,
-        distance=None, njobs=1, group='features'):
+        distance=None, njobs=1, group='features', storage='lzf',
+        tmpdir=None):
     njobs = int(njobs)
     if distance:
         distancepair = distance.split('.')
@@ -42,7 +72,8 @@ def run(features, task, output, normalized,
 
     distances.compute_distances(
         features, group, task, output,
-        distancefun, normalized=normalized, n_cpu=njobs)
+        distancefun, normalized=normalized, n_cpu=njobs, storage=storage,
+        tmpdir=tmpdir)
 
 
 def main():
@@ -51,7 +82,8 @@ def main():
 
     parser.add_argument(
         'features',
-        help='h5features file containing the feature to evaluate')
+        help='h5features file containing the feature to evaluate, or '
+        'feature store directory (see ABXpy.distances.feature_store)')
 
     parser.add_argument(
         '-g', '--group', default='features',
@@ -78,6 +110,16 @@ def main():
         'sum. If put to 1 : computes with normalization, if put to 0 : '
         'computes with sum. Common choice is to use normalization (-n 1)')
 
+    parser.add_argument(
+        '--storage', default='lzf',
+        help='storage profile of the distances: none, lzf, gzip or '
+        'gzip-<level>, default is %(default)s')
+
+    parser.add_argument(
+        '--tempdir', default=None,
+        help='directory where the features shared by the jobs are '
+        'temporarily stored')
+
     args = parser.parse_args()
 
     if os.path.exists(args.output):
@@ -89,7 +131,8 @@ def main():
         sys.exit("ERROR : DTW normalization parameter not specified !")
 
     run(args.features, args.task, args.output, normalized=args.normalization,
-        distance=args.distance, njobs=args.njobs, group=args.group)
+        distance=args.distance, njobs=args.njobs, group=args.group,
+        storage=args.storage, tmpdir=args.tempdir)
 
 
 if __name__ == '__main__':
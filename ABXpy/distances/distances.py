@@ -10,6 +10,8 @@ import numpy as np
 import pandas
 import multiprocessing
 import os
+import shutil
+import tempfile
 # import time
 import traceback
 import sys
@@ -23,6 +25,9 @@ except ImportError:
             os.path.realpath(__file__))))), 'h5features'))
     import h5features
 
+import ABXpy.h5tools.np2h5 as np2h5
+from ABXpy.distances.feature_store import FeatureStore
+
 # FIXME Enforce single process usage when using python compiled with OMP
 # enabled
 
@@ -31,7 +36,8 @@ except ImportError:
 # FIXME write distances in a separate file
 
 
-def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
+def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100,
+                         storage=None, chunks_per_cpu=8):
     """Divide the work load into smaller blocks to be passed to the cpus
 
     Parameters:
@@ -42,15 +48,28 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
         hdf5 file taht will contain the distance datasets
     n_cpu:
         number of cpus tu use
-    block_ceil_size: int
+    buffer_max_size: int
         maximum size in RAM of a block in Mb
+    storage: None, str or dict
+        storage profile of the distances dataset (see
+        ABXpy.h5tools.np2h5.storage_options)
+    chunks_per_cpu: int
+        approximate number of blocks by cpu, if n_cpu > 1
+
+    Returns:
+    --------
+    jobs: list of dict
+        with n_cpu == 1, a single job computing all the distances,
+        otherwise one job by block, in decreasing order of estimated cost,
+        to be served to the cpus as they become idle (see
+        compute_distances)
     """
     # FIXME check (given an optional checking function)
     # that all features required in feat_dbs are indeed present in feature
     # files
 
     # getting 'by' datasets characteristics
-    with h5py.File(pair_file) as fh:
+    with h5py.File(pair_file, 'r') as fh:
         # by_dsets = [by_dset for by_dset in fh['feat_dbs']]
         by_dsets = fh['bys'][...]
         by_n_pairs = []  # number of distances to be computed for each by db
@@ -62,69 +81,87 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
     with h5py.File(distance_file) as fh:
         fh.attrs.create('done', False)
         g = fh.create_group('distances')
-        g.create_dataset('data', shape=(total_n_pairs, 1), dtype=np.float)
+        g.create_dataset('data', shape=(total_n_pairs, 1), dtype=np.float,
+                         **np2h5.storage_options(storage, np.float, 1,
+                                                 total_n_pairs))
+    # blocks are never bigger than the buffer
+    max_block_size = buffer_max_size * 1000000 // 8
+    if n_cpu == 1:
+        by, start, stop = [], [], []
+        for n_pairs, dset in zip(by_n_pairs, by_dsets):
+            for sta in range(0, n_pairs, max_block_size):
+                by.append(dset)
+                start.append(sta)
+                stop.append(min(sta + max_block_size, n_pairs))
+        return [{'pair_file': pair_file, 'by': by,
+                 'start': np.int64(start), 'stop': np.int64(stop)}]
     """
     #### Load balancing ####
-    Heuristic: each process should have approximately
-    the same number of distances to compute.
-        1 - 'by' blocks bigger than n_pairs/n_proc are divided into blocks
-            of size n_pairs/n_proc + a remainder block
-        2 - iteratively the cpu with the lowest number of distances gets
-            attributed the biggest remaining block
-    This will not be a good heuristic if the average time required to compute
-    a distance varies widely from one 'by' dataset to another or if the i/o
-    time is larger than the time required to compute the distances.
+    The time required to compute a distance varies widely: with DTW it is
+    proportional to the product of the number of frames of the two items.
+    The cost of each pair is thus estimated by the product of the
+    durations of its items (from feat_dbs) and the pairs are cut in
+    blocks of approximately the same cost, about chunks_per_cpu blocks
+    by cpu. The cpus pull the next block from a queue when they finish
+    one, the most costly blocks first, so that they all finish at about
+    the same time.
     """
-    # step 1
-    by_n_pairs = np.int64(by_n_pairs)
-    total_n_pairs = np.sum(by_n_pairs)
-    max_block_size = min(np.int64(np.ceil(total_n_pairs / np.float(n_cpu))),
-                         # buffer_max_size * 1000000 / np.dtype(by_n_pairs).itemsize)
-                         buffer_max_size * 1000000 / 8)
+    total_cost = 0
+    for dset, sta, cost in pair_costs(pair_file, by_dsets, max_block_size):
+        total_cost = total_cost + np.sum(cost)
+    uniform = not(total_cost > 0)
+    if uniform:
+        # no duration information, each pair costs the same
+        total_cost = np.sum(by_n_pairs)
+    block_cost = total_cost / float(n_cpu * chunks_per_cpu)
     by = []
     start = []
     stop = []
-    n_dist = []
-    for n_pairs, dset in zip(by_n_pairs, by_dsets):
-        sta = 0
-        sto = 0
-        while n_pairs > 0:
-            if n_pairs > max_block_size:
-                amount = max_block_size
-            else:
-                amount = n_pairs
-            n_pairs = n_pairs - amount
-            sto = sto + amount
+    costs = []
+    for dset, sta, cost in pair_costs(pair_file, by_dsets, max_block_size):
+        if uniform:
+            cost = np.ones(len(cost))
+        cum_cost = np.cumsum(cost)
+        n_blocks = np.int64(np.ceil(cum_cost[-1] / block_cost))
+        cuts = np.searchsorted(cum_cost, block_cost * np.arange(1, n_blocks),
+                               side='right')
+        cuts = np.unique(np.concatenate(([0], cuts, [len(cost)])))
+        cum_cost = np.concatenate(([0], cum_cost))
+        for sto_, sta_ in zip(cuts[1:], cuts[:-1]):
             by.append(dset)
-            start.append(sta)
-            stop.append(sto)
-            n_dist.append(amount)
-            sta = sta + amount
-    # step 2
-    # blocks are sorted according to the number of distances they contain
-    # (in decreasing order, hence the [::-1])
-    order = np.argsort(np.int64(n_dist))[::-1]
-    # associated cpu for each block in zip(by, start, stop, n_dist)
-    cpu = np.zeros(len(by), dtype=np.int64)
-    cpu_loads = np.zeros(n_cpu, dtype=np.int64)
-    for i in order:
-        idlest_cpu = np.argmin(cpu_loads)
-        cpu[i] = idlest_cpu
-        cpu_loads[idlest_cpu] = cpu_loads[idlest_cpu] + n_dist[i]
-    # output job description for each cpu
-    by = np.array(by)  # easier to index...
-    start = np.array(start)
-    stop = np.array(stop)
-    jobs = []
-    for i in range(n_cpu):
-        indices = np.where(cpu == i)[0]
-        _by = list(by[indices])
-        _start = start[indices]
-        _stop = stop[indices]
-        job = {'pair_file': pair_file, 'by': _by,
-               'start': _start, 'stop': _stop}
-        jobs.append(job)
-    return jobs
+            start.append(sta + sta_)
+            stop.append(sta + sto_)
+            costs.append(cum_cost[sto_] - cum_cost[sta_])
+    order = np.argsort(costs, kind='mergesort')[::-1]
+    return [{'pair_file': pair_file, 'by': [by[i]],
+             'start': np.int64([start[i]]), 'stop': np.int64([stop[i]])}
+            for i in order]
+
+
+def pair_costs(pair_file, by_dsets, buffer_size):
+    """Estimated cost of computing the distances of the unique pairs
+
+    Yields the (by, start, cost) of successive slices of at most
+    buffer_size pairs of each 'by', where start is the index of the first
+    pair of the slice in the pairs of the 'by' and cost is the product of
+    the durations of the items of each pair of the slice.
+
+    """
+    store = pandas.HDFStore(pair_file, mode='r')
+    try:
+        with h5py.File(pair_file, 'r') as fh:
+            for by in by_dsets:
+                attrs = fh['unique_pairs'].attrs[by]
+                by_db = store['feat_dbs/' + by]
+                durations = np.float64(by_db['offset'] - by_db['onset'])
+                for sta in range(0, attrs[2] - attrs[1], buffer_size):
+                    sto = min(sta + buffer_size, attrs[2] - attrs[1])
+                    pairs = fh['unique_pairs/data'][
+                        attrs[1]+sta:attrs[1]+sto, 0]
+                    yield by, sta, (durations[np.mod(pairs, attrs[0])] *
+                                    durations[pairs // attrs[0]])
+    finally:
+        store.close()
 
 """
 If there are very large by blocks, two additional
@@ -139,23 +176,42 @@ could group them into intermediate size h5features files
 """
 
 """
-This function can be used concurrently by several processes.
-When it is the case synchronization of the writing operations in
-the target distance_file is required by HDF5.
-The current solution uses a global lock for the whole file.
-Since each job is writing in different places, it should in principle be
-possible to do all the write concurrently if ever necessary, using parallel
-HDF5 (based on MPI-IO).
+This function can be used concurrently by several processes, which only
+read the pair file. In that case, the distances of each job are written
+to its own shard_file, in the order of the blocks of the job, and the
+shards are then copied by a single process to the distance_file (see
+merge_distance_shard), so that the processes never wait for each other.
+Otherwise, the distances are written directly to the distance_file.
+
+If the distance has a 'distance_many' attribute, it is used to compute at
+once the distances between an item x and several items ys:
+distance.distance_many(x, ys) must return the array of the distance(y, x)
+for y in ys (with the same normalized argument, if any). As the pairs are
+sorted by X, consecutive pairs share the same X, so that most of the
+per pair overhead of the distance can be factored out (see
+ABXpy.distance.default_distance_many).
 """
 
 def run_distance_job(job_description, distance_file, distance,
                      feature_files, feature_groups, splitted_features,
-                     job_id, normalize, distance_file_lock=None):
-    if distance_file_lock is None:
-        synchronize = False
-    else:
-        synchronize = True
-    if not(splitted_features):
+                     job_id, normalize, shard_file=None,
+                     feature_store=None):
+    if normalize is not None:
+        if normalize == 1:
+            normalize = True
+        elif normalize == 0:
+            normalize = False
+        else:
+            print('normalized parameter neither 1 nor 0,'
+                  'using normalization')
+            normalize = True
+    distance_many = getattr(distance, 'distance_many', None)
+    if feature_store is not None:
+        # the features are memory mapped from the store written by the
+        # parent process, and thus shared with the other processes
+        get_features = FeatureStore.load(
+            feature_store).get_features_from_raw
+    elif not(splitted_features):
         times = {}
         features = {}
         for feature_file, feature_group in zip(feature_files, feature_groups):
@@ -168,104 +224,146 @@ def run_distance_job(job_description, distance_file, distance,
         get_features = Features_Accessor(times, features).get_features_from_raw
     pair_file = job_description['pair_file']
     n_blocks = len(job_description['by'])
-    for b in range(n_blocks):
-        print('Job %d: computing distances for block %d on %d' % (job_id, b,
-                                                                  n_blocks))
-        # get block spec
-        by = job_description['by'][b]
-        start = job_description['start'][b]
-        stop = job_description['stop'][b]
-        if splitted_features:
-            # FIXME modify feature_file/feature_group to adapt to 'by'
-            # FIXME any change needed when several feature files before
-            # splitting ?
-            times = {}
-            features = {}
-            for feature_file, feature_group in zip(feature_files,
-                                                   feature_groups):
-                t, f = h5features.read(feature_file, feature_group)
-                assert not(set(times.keys()).intersection(
-                    t.keys())), ("The same file is indexed by (at least) two "
-                                 "different feature files")
-                times.update(t)
-                features.update(f)
-            accessor = Features_Accessor(times, features)
-            get_features = accessor.get_features_from_splitted
-        # load pandas dataframe containing info for loading the features
-        if synchronize:
-            distance_file_lock.acquire()
-        store = pandas.HDFStore(pair_file)
-        by_db = store['feat_dbs/' + by]
-        store.close()
-        # load pairs to be computed
-        # indexed relatively to the above dataframe
-        with h5py.File(pair_file) as fh:
-            attrs = fh['unique_pairs'].attrs[by]
-            pair_list = fh['unique_pairs/data'][attrs[1]+start:attrs[1]+stop, 0]
-            base = attrs[0]
-        if synchronize:
-            distance_file_lock.release()
-
-        A = np.mod(pair_list, base)
-        B = pair_list // base
-        pairs = np.column_stack([A, B])
-        n_pairs = pairs.shape[0]
-        # get dataframe with one entry by item involved in this block
-        # indexed by its 'by'-specific index
-        by_inds = np.unique(np.concatenate([A, B]))
-        items = by_db.iloc[by_inds]
-        # get a dictionary whose keys are the 'by' indices
-        features = get_features(items)
-        dis = np.empty(shape=(n_pairs, 1))
-        # FIXME: second dim is 1 because of the way it is stored to disk,
-        # but ultimately it shouldn't be necessary anymore
-        # (if using axis arg in np2h5, h52np and h5io...)
-        for i in range(n_pairs):
-            dataA = features[pairs[i, 0]]
-            dataB = features[pairs[i, 1]]
-            if dataA.shape[0] == 0:
-                warnings.warn('No features found for file {}, {} - {}'
-                              .format(items['file'][pairs[i, 0]],
-                                      items['onset'][pairs[i, 0]],
-                                      items['offset'][pairs[i, 0]]),
-                              UserWarning)
-            if dataB.shape[0] == 0:
-                warnings.warn('No features found for file {}, {} - {}'
-                              .format(items['file'][pairs[i, 1]],
-                                      items['onset'][pairs[i, 1]],
-                                      items['offset'][pairs[i, 1]]),
-                              UserWarning)
-            try:
-                if normalize is not None : 
-                    if normalize==1:
-                        normalize=True
-                    elif normalize==0:
-                        normalize=False
-                    else:
-                        print('normalized parameter neither 1 nor 0,'
-                        'using normalization')
-                        normalize=True
-                    dis[i,0] = distance(dataA, dataB, normalized=normalize)
-                else:
-                    dis[i, 0] = distance(dataA, dataB)
-            except:
-                sys.stderr.write(
-                    'Error when calculating the distance between item {}, {} - {} '
-                    'and item {}, {} - {}\n'
-                    .format(items['file'][pairs[i, 0]],
-                            items['onset'][pairs[i, 0]],
-                            items['offset'][pairs[i, 0]],
-                            items['file'][pairs[i, 1]],
-                            items['onset'][pairs[i, 1]],
-                            items['offset'][pairs[i, 1]]),
-                )
-                raise
-        if synchronize:
-            distance_file_lock.acquire()
+    if shard_file is None:
+        out_file = h5py.File(distance_file)
+        out = out_file['distances/data']
+    else:
+        n_dist = np.sum(np.int64(job_description['stop']) -
+                        np.int64(job_description['start']))
+        out_file = h5py.File(shard_file, 'w')
+        out = out_file.create_dataset('distances', shape=(n_dist, 1),
+                                      dtype=np.float)
+    position = 0
+    by_name = None
+    try:
+        for b in range(n_blocks):
+            print('Job %d: computing distances for block %d on %d' % (
+                job_id, b, n_blocks))
+            # get block spec
+            by = job_description['by'][b]
+            start = job_description['start'][b]
+            stop = job_description['stop'][b]
+            if splitted_features:
+                # FIXME modify feature_file/feature_group to adapt to 'by'
+                # FIXME any change needed when several feature files before
+                # splitting ?
+                times = {}
+                features = {}
+                for feature_file, feature_group in zip(feature_files,
+                                                       feature_groups):
+                    t, f = h5features.read(feature_file, feature_group)
+                    assert not(set(times.keys()).intersection(
+                        t.keys())), ("The same file is indexed by (at least) "
+                                     "two different feature files")
+                    times.update(t)
+                    features.update(f)
+                accessor = Features_Accessor(times, features)
+                get_features = accessor.get_features_from_splitted
+            # load pandas dataframe containing info for loading the features
+            # (consecutive blocks of a job often share their 'by')
+            if by != by_name:
+                store = pandas.HDFStore(pair_file, mode='r')
+                by_db = store['feat_dbs/' + by]
+                store.close()
+                by_name = by
+            # load pairs to be computed
+            # indexed relatively to the above dataframe
+            with h5py.File(pair_file, 'r') as fh:
+                attrs = fh['unique_pairs'].attrs[by]
+                pair_list = fh['unique_pairs/data'][
+                    attrs[1]+start:attrs[1]+stop, 0]
+                base = attrs[0]
+
+            A = np.mod(pair_list, base)
+            B = pair_list // base
+            pairs = np.column_stack([A, B])
+            n_pairs = pairs.shape[0]
+            # get dataframe with one entry by item involved in this block
+            # indexed by its 'by'-specific index
+            by_inds = np.unique(np.concatenate([A, B]))
+            items = by_db.iloc[by_inds]
+            # get a dictionary whose keys are the 'by' indices
+            features = get_features(items)
+            dis = np.empty(shape=(n_pairs, 1))
+            # FIXME: second dim is 1 because of the way it is stored to disk,
+            # but ultimately it shouldn't be necessary anymore
+            # (if using axis arg in np2h5, h52np and h5io...)
+            for ix in by_inds:
+                if features[ix].shape[0] == 0:
+                    warnings.warn('No features found for file {}, {} - {}'
+                                  .format(items['file'][ix],
+                                          items['onset'][ix],
+                                          items['offset'][ix]),
+                                  UserWarning)
+            kwargs = {} if normalize is None else {'normalized': normalize}
+            if distance_many is None:
+                for i in range(n_pairs):
+                    dataA = features[pairs[i, 0]]
+                    dataB = features[pairs[i, 1]]
+                    try:
+                        dis[i, 0] = distance(dataA, dataB, **kwargs)
+                    except:
+                        sys.stderr.write(
+                            'Error when calculating the distance between '
+                            'item {}, {} - {} and item {}, {} - {}\n'
+                            .format(items['file'][pairs[i, 0]],
+                                    items['onset'][pairs[i, 0]],
+                                    items['offset'][pairs[i, 0]],
+                                    items['file'][pairs[i, 1]],
+                                    items['onset'][pairs[i, 1]],
+                                    items['offset'][pairs[i, 1]]),
+                        )
+                        raise
+            elif n_pairs > 0:
+                # one call for each run of consecutive pairs sharing their X
+                run_starts = np.concatenate(
+                    ([0], np.flatnonzero(np.diff(pairs[:, 1])) + 1))
+                run_stops = np.append(run_starts[1:], n_pairs)
+                for run_start, run_stop in zip(run_starts, run_stops):
+                    x = pairs[run_start, 1]
+                    ys = [features[y] for y in pairs[run_start:run_stop, 0]]
+                    try:
+                        dis[run_start:run_stop, 0] = distance_many(
+                            features[x], ys, **kwargs)
+                    except:
+                        sys.stderr.write(
+                            'Error when calculating the distances between '
+                            'item {}, {} - {} and {} other items\n'
+                            .format(items['file'][x], items['onset'][x],
+                                    items['offset'][x], run_stop - run_start),
+                        )
+                        raise
+            if shard_file is None:
+                out[attrs[1]+start:attrs[1]+stop, :] = dis
+            else:
+                out[position:position+n_pairs, :] = dis
+                position = position + n_pairs
+    finally:
+        out_file.close()
+    return shard_file
+
+
+def merge_distance_shard(job_description, shard_file, distance_file):
+    """Copy the distances of a job from its shard to the distance file
+
+    The shard contains the distances of the blocks of the job, in the
+    order of the blocks (see run_distance_job).
+
+    """
+    with h5py.File(job_description['pair_file'], 'r') as fh:
+        offsets = {by: fh['unique_pairs'].attrs[by][1]
+                   for by in set(job_description['by'])}
+    with h5py.File(shard_file, 'r') as shard:
+        dis = shard['distances']
         with h5py.File(distance_file) as fh:
-            fh['distances/data'][attrs[1]+start:attrs[1]+stop, :] = dis
-        if synchronize:
-            distance_file_lock.release()
+            out = fh['distances/data']
+            position = 0
+            for by, start, stop in zip(job_description['by'],
+                                       job_description['start'],
+                                       job_description['stop']):
+                out[offsets[by]+start:offsets[by]+stop, :] = \
+                    dis[position:position+stop-start, :]
+                position = position + stop - start
 
 
 # mem in megabytes
@@ -274,7 +372,19 @@ def run_distance_job(job_description, distance_file, distance,
 # get rid of the group in feature file (never used ?)
 def compute_distances(feature_file, feature_group, pair_file, distance_file,
                       distance, normalized, n_cpu=None, mem=1000,
-                      feature_file_as_list=False):
+                      feature_file_as_list=False, storage='lzf',
+                      tmpdir=None):
+    """Compute the distances of the unique pairs of a task file
+
+    feature_file can also be a FeatureStore directory, whose features are
+    then memory mapped instead of read from h5features files. Otherwise,
+    with n_cpu > 1, the features are first written to a FeatureStore in
+    a temporary directory (in tmpdir if specified), which the worker
+    processes memory map instead of each one reading the features files.
+    The processes write their distances to shards in the same temporary
+    directory, which are merged in distance_file as they are completed.
+
+    """
     #with h5py.File(distance_file) as fh:
     #    fh.attrs.create('distance', pickle.dumps(distance))
 
@@ -286,35 +396,96 @@ def compute_distances(feature_file, feature_group, pair_file, distance_file,
     else:
         feature_files = feature_file
         feature_groups = feature_group
+    if len(feature_files) == 1 and FeatureStore.is_store(feature_files[0]):
+        store_dir = feature_files[0]
+        converted = False
+    else:
+        store_dir = None
+        converted = n_cpu > 1
     # FIXME if there are other datasets in feature_file this is not accurate
+    # (the features are shared by the processes, see FeatureStore)
     mem_needed = 0
     for feature_file in feature_files:
-        feature_size = os.path.getsize(feature_file) / float(2 ** 20)
-        mem_needed = feature_size * n_cpu + mem_needed
+        if store_dir is None:
+            feature_size = os.path.getsize(feature_file) / float(2 ** 20)
+            mem_needed = feature_size + mem_needed
     splitted_features = False
     #splitted_features = mem_needed > mem
     # if splitted_features:
     #    split_feature_file(feature_file, feature_group, pair_file)
-    jobs = create_distance_jobs(pair_file, distance_file, n_cpu)
+    jobs = create_distance_jobs(pair_file, distance_file, n_cpu,
+                                storage=storage)
     # results = []
     if n_cpu > 1:
-        # use of a manager seems necessary because we're using a Pool...
-        distance_file_lock = multiprocessing.Manager().Lock()
-        pool = multiprocessing.Pool(n_cpu)
-        args = [(job, distance_file, distance, feature_files, feature_groups,
-                 splitted_features, i, normalized, distance_file_lock)
-                for i, job in enumerate(jobs)]
-        pool.map(worker, args)
+        # the workers only read the pair file and each write to its own
+        # shard, which are copied to distance_file by this process only
+        work_dir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            if converted:
+                store_dir = os.path.join(work_dir, 'features')
+                FeatureStore.convert(feature_files, feature_groups,
+                                     store_dir)
+            args = [(job, distance_file, distance, feature_files,
+                     feature_groups, splitted_features, i, normalized,
+                     os.path.join(work_dir, 'shard_{}.h5'.format(i)),
+                     store_dir)
+                    for i, job in enumerate(jobs)]
+            pool = multiprocessing.Pool(n_cpu)
+            try:
+                # the jobs are pulled one by one by idle workers, and
+                # their shards merged as soon as they are done
+                for i, shard_file in pool.imap_unordered(
+                        worker, enumerate(args), chunksize=1):
+                    merge_distance_shard(jobs[i], shard_file, distance_file)
+                    os.remove(shard_file)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(work_dir)
     else:
         run_distance_job(jobs[0], distance_file, distance,
-                         feature_files, feature_groups, splitted_features, 1, normalized)
-        with h5py.File(distance_file) as fh:
-            fh.attrs.modify('done', True)
+                         feature_files, feature_groups, splitted_features, 1,
+                         normalized, feature_store=store_dir)
+    with h5py.File(distance_file) as fh:
+        fh.attrs.modify('done', True)
 
 
 # hack, external function for visibility reasons
 def worker(args):
-    return run_distance_job(*args)
+    i, args = args
+    return i, run_distance_job(*args)
+
+
+def read_feature_times(feature_file, feature_group):
+    """Times of the frames of each file of a features file
+
+    feature_file can also be a FeatureStore directory.
+
+    """
+    if FeatureStore.is_store(feature_file):
+        return FeatureStore.load(feature_file).file_times()
+    times, _ = h5features.read(feature_file, feature_group)
+    return times
+
+
+def item_frames(items, times):
+    """Number of frames of each item
+
+    items is a pandas.DataFrame with 'file', 'onset' and 'offset' columns
+    and times a dict from the files to the sorted times of their frames
+    (see read_feature_times). The frames of an item are those whose time
+    is between its onset and offset, as in
+    Features_Accessor.get_features_from_raw.
+
+    """
+    frames = np.zeros(len(items), dtype=np.int64)
+    for i, (f, on, off) in enumerate(zip(items['file'], items['onset'],
+                                         items['offset'])):
+        t = times[str(f)]
+        frames[i] = max(0, np.searchsorted(t, off, side='right') -
+                        np.searchsorted(t, on, side='left'))
+    return frames
 
 
 class Features_Accessor(object):
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Features of all the files of a features file in contiguous arrays
+
+The frames of all the files are concatenated in a single 2D array, along
+with their times, the frames of each file being delimited by offsets. A
+feature store is saved in a directory as .npy files, which can be memory
+mapped: processes loading the same store then share its pages instead of
+each one holding its own copy of the features.
+
+A store converted once from h5features files can be given directly to the
+distance computation instead of the features file, for instance:
+
+    abx-features-store data.features data.store --float32
+    abx-distance data.store data.abx data.distance -n 1
+
+The times of the frames of each file are sorted, so that the frames of an
+item are found by binary search.
+"""
+
+import argparse
+import os
+import sys
+
+import h5py
+import numpy as np
+try:
+    import h5features
+except ImportError:
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.realpath(__file__))))), 'h5features'))
+    import h5features
+
+
+class FeatureStore(object):
+    """Features of several files in contiguous arrays
+
+    Parameters
+    ----------
+    files : numpy.array
+        The names of the files.
+    offsets : numpy.array
+        The len(files) + 1 boundaries of the frames of each file.
+    times : numpy.array
+        The time of each frame.
+    features : numpy.array
+        The features of each frame, one line per frame.
+
+    """
+    def __init__(self, files, offsets, times, features):
+        self.files = files
+        self.offsets = offsets
+        self.times = times
+        self.features = features
+        self.file_index = {str(f): i for i, f in enumerate(files)}
+
+    @staticmethod
+    def is_store(path):
+        """True if path is a feature store directory"""
+        return os.path.isfile(os.path.join(path, 'features.npy'))
+
+    @classmethod
+    def convert(cls, feature_files, feature_groups, path, dtype=None):
+        """Write the features of h5features files to a store directory
+
+        The size of the store is first found from the shapes of the
+        'times' and 'features' datasets of the files, without reading
+        them. The features are then read one file at a time, the frames
+        of each of its files being sorted by time and written to the
+        memory mapped arrays of the store as soon as they are read. The
+        store is returned. dtype is the type of the stored features (for
+        instance np.float32 to halve the size of a store of double
+        precision features), by default the type of the features.
+
+        """
+        n_frames, dim = 0, 0
+        time_types, feature_types = [], []
+        for feature_file, feature_group in zip(feature_files,
+                                               feature_groups):
+            with h5py.File(feature_file, 'r') as fh:
+                group = fh[feature_group]
+                n_frames += len(group['times'])
+                dim = group['features'].shape[1]
+                time_types.append(group['times'].dtype)
+                feature_types.append(group['features'].dtype)
+        time_type = (np.result_type(*time_types) if time_types
+                     else np.float64)
+        if dtype is None:
+            dtype = feature_types[0] if feature_types else np.float64
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        times = np.lib.format.open_memmap(
+            os.path.join(path, 'times.npy'), mode='w+',
+            dtype=time_type, shape=(n_frames,))
+        features = np.lib.format.open_memmap(
+            os.path.join(path, 'features.npy'), mode='w+', dtype=dtype,
+            shape=(n_frames, dim))
+        files = []
+        offsets = [0]
+        for feature_file, feature_group in zip(feature_files,
+                                               feature_groups):
+            t, f = h5features.read(feature_file, feature_group)
+            assert not(set(files).intersection(t.keys())), (
+                "The same file is indexed by (at least) two "
+                "different feature files")
+            for name in t:
+                order = np.argsort(t[name], kind='mergesort')
+                start, stop = offsets[-1], offsets[-1] + len(order)
+                times[start:stop] = t[name][order]
+                features[start:stop] = f[name][order]
+                files.append(name)
+                offsets.append(stop)
+            del t, f
+        assert offsets[-1] == n_frames
+        times.flush()
+        features.flush()
+        del times, features
+
+        np.save(os.path.join(path, 'files.npy'), np.array(files, dtype=str))
+        np.save(os.path.join(path, 'offsets.npy'),
+                np.array(offsets, dtype=np.int64))
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load a store directory, memory mapping its arrays by default"""
+        arrays = [np.load(os.path.join(path, name + '.npy'),
+                          mmap_mode=mmap_mode)
+                  for name in ['offsets', 'times', 'features']]
+        files = np.load(os.path.join(path, 'files.npy'))
+        return cls(files, *arrays)
+
+    def file_times(self):
+        """Dict from the files to the times of their frames"""
+        return {str(f): self.times[start:stop]
+                for f, start, stop in zip(self.files, self.offsets[:-1],
+                                          self.offsets[1:])}
+
+    def get_features_from_raw(self, items):
+        """Features of some items, as Features_Accessor.get_features_from_raw
+
+        Returns a dict from the index of the items to their features, the
+        frames whose time is between the onset and the offset of the item.
+        These are a contiguous slice of the store, found by binary search
+        in the sorted times of the file.
+
+        """
+        features = {}
+        for ix, f, on, off in zip(items.index, items['file'],
+                                  items['onset'], items['offset']):
+            i = self.file_index[str(f)]
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            t = self.times[start:stop]
+            first = start + np.searchsorted(t, on, side='left')
+            last = start + np.searchsorted(t, off, side='right')
+            features[ix] = np.asarray(
+                self.features[first:max(first, last), :])
+        return features
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert h5features files to a feature store directory, '
+        'which can be given in place of the features to abx-distance')
+
+    parser.add_argument(
+        'features', help='h5features file to convert')
+
+    parser.add_argument(
+        'output', help='feature store directory to create')
+
+    parser.add_argument(
+        '-g', '--group', default='features',
+        help='group to read in the h5features file, default is %(default)s')
+
+    parser.add_argument(
+        '-f', '--float32', action='store_true',
+        help='store the features in single precision')
+
+    args = parser.parse_args()
+
+    if FeatureStore.is_store(args.output):
+        sys.exit("ERROR : feature store {} already exists"
+                 .format(args.output))
+
+    FeatureStore.convert([args.features], [args.group], args.output,
+                         dtype=np.float32 if args.float32 else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -34,7 +34,9 @@ class H5IO(object):
     # 'language', 'age1': None, 'age2': None}, {'talker': ['t1', 't2', 't3'],
     # 'language': ['French', 'English']}, {'talkers': ['talker1', 'talker2']})
 
-    def __init__(self, filename, datasets=None, indexes=None, fused=None, group='/'):
+    # storage: storage profile of the created datasets (see
+    # np2h5.storage_options)
+    def __init__(self, filename, datasets=None, indexes=None, fused=None, group='/', storage=None):
 
         # format and check inputs
         if indexes is None:
@@ -126,6 +128,7 @@ class H5IO(object):
 
         # instantiate h5io runtime object from (possibly newly created) file
         self.filename = filename
+        self.storage = storage
         self.group = group
         self.__load__()
 
@@ -266,7 +269,7 @@ class H5IO(object):
             if not(group):
                 group = '/'
             self.out[dset] = self.np2h5.add_dataset(group, dataset, n_columns=dims[dset], item_type=dtypes[
-                                                    dset], fixed_size=False)  # FIXME at some point should become super.add_dataset(...)
+                                                    dset], fixed_size=False, storage=self.storage)  # FIXME at some point should become super.add_dataset(...)
         # init not fused indexed datasets, in this implementation they are all
         # encoded in the same matrix
         if self.non_fused_datasets:
@@ -280,7 +283,7 @@ class H5IO(object):
                 max(indexed_levels), is_signed=False)
             # FIXME at some point should become super.add_dataset(...)
             self.out['indexed'] = self.np2h5.add_dataset(
-                self.group, 'indexed_data', n_columns=dim, item_type=d_type, fixed_size=False)
+                self.group, 'indexed_data', n_columns=dim, item_type=d_type, fixed_size=False, storage=self.storage)
             with h5py.File(self.filename) as f:
                 # necessary to access the part of the data corresponding to a
                 # particular dataset
@@ -300,7 +303,7 @@ class H5IO(object):
             d_type = type_fitting.fit_integer_type(max_key, is_signed=False)
             # FIXME at some point should become super.add_dataset(...)
             self.out[fused_dset] = self.np2h5.add_dataset(
-                self.group, fused_dset, n_columns=1, item_type=d_type, fixed_size=False)
+                self.group, fused_dset, n_columns=1, item_type=d_type, fixed_size=False, storage=self.storage)
             nb_levels_with_multiplicity = np.concatenate([np.array(
                 n, dtype=d_type) * np.ones(d, dtype=d_type) for n, d in zip(self.nb_levels[fused_dset], fused_dims)])
             self.key_weights[fused_dset] = np.concatenate(
@@ -14,12 +14,99 @@ Buffer size should be chosen according to speed/memory trade-off. Due to cache i
 
 The size of the dataset to be written must be known in advance, excepted when overwriting an existing dataset. 
 Not writing exactly the expected amount of data causes an Exception to be thrown excepted is the fixed_size option was set to False when adding the dataset.
+
+The storage of the datasets (compression filter, shuffle filter and chunk size) is specified with a storage profile, see storage_options.
 """
 
 import numpy as np
 import h5py
 
 
+# Named storage profiles. A profile is a dict with the keys 'compression'
+# (None, 'lzf' or 'gzip'), 'level' (gzip level, from 0 to 9), 'shuffle'
+# (whether to use the shuffle filter) and 'chunk_rows' (number of rows in a
+# chunk, None to use a default depending on the size of the rows).
+STORAGE_PROFILES = {
+    'none': {'compression': None, 'shuffle': False},
+    'lzf': {'compression': 'lzf', 'shuffle': True},
+    'gzip': {'compression': 'gzip', 'level': 4, 'shuffle': True},
+}
+
+# default chunk size (in kilobytes) of compressed datasets, compression
+# working poorly with small chunks
+COMPRESSED_CHUNK_SIZE = 256
+
+
+def storage_options(storage, item_type, n_columns, n_rows=None,
+                    chunk_size=10):
+    """h5py dataset creation keywords corresponding to a storage profile
+
+    Parameters
+    ----------
+    storage : None, str or dict
+        None for the default storage (uncompressed), the name of a
+        profile of STORAGE_PROFILES, 'gzip-<level>' for a gzip profile
+        with a specific level, or a profile dict (missing keys take the
+        values of the 'none' profile).
+    item_type : numpy dtype
+        The type of the items of the dataset
+    n_columns : int
+        The number of columns of the dataset
+    n_rows : int, optional
+        If specified, the size of a dataset that will not be resized, the
+        chunks cannot be larger than that.
+    chunk_size : int, optional
+        Chunk size in kilobytes of uncompressed datasets, when the
+        profile does not specify 'chunk_rows'.
+
+    Returns
+    -------
+    options : dict
+        The 'chunks', 'compression', 'compression_opts' and 'shuffle'
+        keywords for h5py create_dataset. 'chunks' is None for contiguous
+        datasets (only possible if n_rows is specified). Empty datasets
+        (n_rows is 0) are contiguous and uncompressed, as h5py cannot
+        chunk them.
+
+    """
+    profile = dict(STORAGE_PROFILES['none'])
+    if isinstance(storage, basestring):
+        if storage.startswith('gzip-'):
+            profile.update(STORAGE_PROFILES['gzip'])
+            profile['level'] = int(storage[len('gzip-'):])
+        elif storage in STORAGE_PROFILES:
+            profile.update(STORAGE_PROFILES[storage])
+        else:
+            raise ValueError('Unknown storage profile: {}'.format(storage))
+    elif storage is not None:
+        profile.update(storage)
+    if profile['compression'] not in (None, 'lzf', 'gzip'):
+        raise ValueError(
+            'Unsupported compression: {}'.format(profile['compression']))
+    if n_rows == 0:
+        return {'chunks': None, 'compression': None, 'shuffle': False}
+
+    compressed = profile['compression'] is not None or profile['shuffle']
+    chunk_rows = profile.get('chunk_rows')
+    if chunk_rows is None and (compressed or n_rows is None):
+        if compressed:
+            chunk_size = max(chunk_size, COMPRESSED_CHUNK_SIZE)
+        chunk_rows = nb_lines(
+            np.dtype(item_type).itemsize, n_columns, chunk_size)
+    if chunk_rows is not None:
+        chunk_rows = max(1, chunk_rows)
+        if n_rows is not None:
+            chunk_rows = max(1, min(chunk_rows, n_rows))
+        chunks = (chunk_rows, n_columns)
+    else:
+        chunks = None
+    options = {'chunks': chunks, 'compression': profile['compression'],
+               'shuffle': profile['shuffle']}
+    if profile['compression'] == 'gzip':
+        options['compression_opts'] = profile.get('level', 4)
+    return options
+
+
 class NP2H5(object):
 
     # sink is the name of the HDF5 file to which to write, buffer size is in
@@ -80,13 +167,14 @@ class NP2H5(object):
             else:
                 raise
 
-    def add_dataset(self, group, dataset, n_rows=0, n_columns=None, chunk_size=10, buf_size=100, item_type=np.int64, overwrite=False, fixed_size=True):
+    # see storage_options for the storage argument
+    def add_dataset(self, group, dataset, n_rows=0, n_columns=None, chunk_size=10, buf_size=100, item_type=np.int64, overwrite=False, fixed_size=True, storage=None):
         if n_columns is None:
             raise ValueError(
                 'You have to specify the number of columns of the dataset.')
         if self.file_open:
             buf = NP2H5buffer(self, group, dataset, n_rows, n_columns,
-                              chunk_size, buf_size, item_type, overwrite, fixed_size)
+                              chunk_size, buf_size, item_type, overwrite, fixed_size, storage)
             self.buffers.append(buf)
             return buf
         else:
@@ -98,7 +186,7 @@ class NP2H5buffer(object):
 
     # buf_size in Ko
 
-    def __init__(self, parent, group, dataset, n_rows, n_columns, chunk_size, buf_size, item_type, overwrite, fixed_size):
+    def __init__(self, parent, group, dataset, n_rows, n_columns, chunk_size, buf_size, item_type, overwrite, fixed_size, storage=None):
 
         assert parent.file_open
 
@@ -143,15 +231,18 @@ class NP2H5buffer(object):
                 g = parent.file[group]
             except KeyError:
                 g = parent.file.create_group(group)
-            # create dataset
+            # create dataset, fixed size datasets are contiguous unless the
+            # storage profile requires chunks
             if self.fixed_size:
-                # would it be useful to chunk here?
-                g.create_dataset(dataset, (n_rows, n_columns), dtype=self.type)
+                options = storage_options(
+                    storage, self.type, n_columns, n_rows, chunk_size)
+                g.create_dataset(
+                    dataset, (n_rows, n_columns), dtype=self.type, **options)
             else:
-                chunk_lines = nb_lines(
-                    self.type.itemsize, n_columns, chunk_size)
-                g.create_dataset(dataset, (n_rows, n_columns), dtype=self.type, chunks=(
-                    chunk_lines, n_columns), maxshape=(None, n_columns))
+                options = storage_options(
+                    storage, self.type, n_columns, chunk_size=chunk_size)
+                g.create_dataset(dataset, (n_rows, n_columns), dtype=self.type,
+                                 maxshape=(None, n_columns), **options)
             self.dataset = parent.file[group][dataset]
 
         # store useful parameters
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of task files
+
+A task file is stored in the cache directory under a key computed from the
+content of the item files and from the task parameters, so that generating
+the same task again only requires to link or copy the cached file. The
+least recently used entries are removed when the cache grows larger than a
+given size.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+
+# to be incremented when the content of the task files changes, so that
+# the entries generated by previous versions are not used anymore
+CACHE_VERSION = 2
+
+# extension of the cached task files
+EXTENSION = '.abx'
+
+# permissions of the cached task files
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def file_digest(filename, block_size=2 ** 20):
+    """sha1 digest of the content of a file"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fid:
+        for block in iter(lambda: fid.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(files, parameters):
+    """Key of a task in the cache
+
+    Parameters
+    ----------
+    files : list
+        The item file and its auxiliary files, the key depends on their
+        content but not on their names.
+    parameters : dict
+        The parameters of the task, they must be serializable in json.
+
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps(
+        {'version': CACHE_VERSION,
+         'files': [file_digest(filename) for filename in files],
+         'parameters': parameters},
+        sort_keys=True))
+    return digest.hexdigest()
+
+
+def entry(cache_dir, key):
+    """Name of the cached task file of a key"""
+    return os.path.join(cache_dir, key + EXTENSION)
+
+
+def fetch(cache_dir, key, output):
+    """Put the cached task file of a key at output
+
+    The cached file is hard-linked to output when possible and copied
+    otherwise. A hard-linked output shares its storage with the cache
+    entry and is read-only, like the entry (see store). The entry is
+    marked as recently used.
+
+    Returns
+    -------
+    found : bool
+        False if the key is not in the cache.
+
+    """
+    cached = entry(cache_dir, key)
+    try:
+        os.utime(cached, None)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return False
+        raise
+    try:
+        os.link(cached, output)
+    except OSError:
+        shutil.copyfile(cached, output)
+    return True
+
+
+def store(cache_dir, key, filename, max_size=None):
+    """Add a task file to the cache
+
+    The file is hard-linked in the cache when possible and copied
+    otherwise. The entry is made read-only, and so is the file when it
+    is hard-linked: h5py then opens them in read-only mode by default,
+    so that they cannot be modified through one of their links. The
+    least recently used entries are then evicted so that the cache is
+    not larger than max_size bytes (the new entry is always kept).
+
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # the entry is created under a temporary name and renamed, so that
+    # concurrent processes never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        os.remove(tmp)
+        try:
+            os.link(filename, tmp)
+        except OSError:
+            shutil.copyfile(filename, tmp)
+        os.chmod(tmp, READ_ONLY)
+        os.rename(tmp, entry(cache_dir, key))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if max_size is not None:
+        evict(cache_dir, max_size, keep=[key])
+
+
+def evict(cache_dir, max_size, keep=()):
+    """Remove the least recently used entries until the cache is not
+    larger than max_size bytes
+
+    Returns
+    -------
+    removed : list
+        The keys of the removed entries.
+
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(EXTENSION):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append(
+                (stat.st_mtime, name[:-len(EXTENSION)], stat.st_size))
+    size = sum(entry_size for _, _, entry_size in entries)
+    removed = []
+    for _, key, entry_size in sorted(entries):
+        if size <= max_size:
+            break
+        if key in keep:
+            continue
+        try:
+            os.remove(entry(cache_dir, key))
+        except OSError as error:
+            # already removed by a concurrent process
+            if error.errno != errno.ENOENT:
+                raise
+        size -= entry_size
+        removed.append(key)
+    return removed
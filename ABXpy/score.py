@@ -55,13 +55,14 @@ package_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 if not(package_path in sys.path):
     sys.path.append(package_path)
 
-import ABXpy.h5tools.h52np as h52np
 import ABXpy.h5tools.np2h5 as np2h5
 import ABXpy.misc.type_fitting as type_fitting
+from ABXpy.task import pair_codes, read_triplets
 
 
 # FIXME: include distance computation here
-def score(task_file, distance_file, score_file=None, score_group='scores'):
+def score(task_file, distance_file, score_file=None, score_group='scores',
+          storage='lzf'):
     """Calculate the score of a task and put the results in a hdf5 file.
 
     Parameters
@@ -73,6 +74,9 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
         The hdf5 file containing the distances between the pairs
     score_file : string, optional
         The hdf5 file that will contain the results
+    storage : None, str or dict, optional
+        The storage profile of the scores (see
+        ABXpy.h5tools.np2h5.storage_options)
     """
     if score_file is None:
         (basename_task, _) = os.path.splitext(task_file)
@@ -91,9 +95,15 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
     with h5py.File(task_file) as t:
         bys = t['bys'][...]
         # bys = t['feat_dbs'].keys()
-        n_triplets = t['triplets']['data'].shape[0]
+        # the triplets may not be stored explicitly (see read_triplets)
+        n_triplets = t['triplets']['by_index'][-1, 1]
+        # task files generated before the symmetric pairs option did not
+        # record the pairs encoding
+        symmetric = t.attrs.get('symmetric_pairs', False)
     with h5py.File(score_file) as s:
-        s.create_dataset('scores', (n_triplets, 1), dtype=np.int8)
+        s.create_dataset('scores', (n_triplets, 1), dtype=np.int8,
+                         **np2h5.storage_options(storage, np.int8, 1,
+                                                 n_triplets))
         for n_by, by in enumerate(bys):
             with h5py.File(task_file) as t, h5py.File(distance_file) as d:
                 trip_attrs = t['triplets']['by_index'][n_by]
@@ -108,18 +118,16 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
                 base = pair_attrs[0]
                 pair_key_type = type_fitting.fit_integer_type((base) ** 2 - 1,
                                                               is_signed=False)
-            with h52np.H52NP(task_file) as t:
-                inp = t.add_subdataset('triplets', 'data', indexes=trip_attrs)
+            with h5py.File(task_file, 'r') as t:
                 idx_start = trip_attrs[0]
-                for triplets in inp:
+                for triplets in read_triplets(t, n_by):
                     triplets = pair_key_type(triplets)
                     idx_end = idx_start + triplets.shape[0]
 
-                    pairs_AX = triplets[:, 0] + base * triplets[:, 2]
-                    # FIXME change the encoding (and type_fitting) so that
-                    # A,B and B,A have the same code ... (take a=min(a,b),
-                    # b=max(a,b))
-                    pairs_BX = triplets[:, 1] + base * triplets[:, 2]
+                    pairs_AX = pair_codes(
+                        triplets[:, 0], triplets[:, 2], base, symmetric)
+                    pairs_BX = pair_codes(
+                        triplets[:, 1], triplets[:, 2], base, symmetric)
                     dis_AX = dis[np.searchsorted(pairs, pairs_AX)]
 
                     dis_BX = dis[np.searchsorted(pairs, pairs_BX)]
@@ -148,12 +156,15 @@ def main():
         package, containing the distance between the pairs of a task')
     g1.add_argument('score', nargs='?', default=None, help='optional: score \
         file, where the results of the computation will be put')
+    parser.add_argument('--storage', default='lzf', help='storage profile \
+        of the scores: none, lzf, gzip or gzip-<level>, default is \
+        %(default)s')
     args = parser.parse_args()
 
     if os.path.exists(args.score):
         print("Warning: overwriting score file {}".format(args.score))
         os.remove(args.score)
-    score(args.task, args.distance, args.score)
+    score(args.task, args.distance, args.score, storage=args.storage)
 
 
 # FIXME write command-line interface
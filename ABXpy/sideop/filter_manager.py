@@ -26,9 +26,10 @@ class FilterManager(side_operations_manager.SideOperationsManager):
     """Manage the filters on attributes (on, across, by) or elements (A, B, X)
     for further processing"""
 
-    def __init__(self, db_hierarchy, on, across, by, filters):
+    def __init__(self, db_hierarchy, on, across, by, filters,
+                 code_tables=None):
         side_operations_manager.SideOperationsManager.__init__(
-            self, db_hierarchy, on, across, by)
+            self, db_hierarchy, on, across, by, code_tables)
         # this case is specific to filters, it applies a generic filter to the
         # database before considering A, B and X stuff.
         self.generic = []
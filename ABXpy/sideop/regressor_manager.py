@@ -25,9 +25,10 @@ class RegressorManager(side_operations_manager.SideOperationsManager):
     X) for further processing
     """
 
-    def __init__(self, db, db_hierarchy, on, across, by, regressors):
+    def __init__(self, db, db_hierarchy, on, across, by, regressors,
+                 code_tables=None):
         side_operations_manager.SideOperationsManager.__init__(
-            self, db_hierarchy, on, across, by)
+            self, db_hierarchy, on, across, by, code_tables)
         # add column functions for the default regressors: on_AB, on_X,
         # across_AX(s), across_B(s) (but not the by(s))
         default_regressors = [on[0] + '_1', on[0] + '_2']
@@ -44,17 +45,35 @@ class RegressorManager(side_operations_manager.SideOperationsManager):
         # reg can be: the name of a column of the database (possibly extended),
         # the name of lookup file, the name of a script, a script under the
         # form of a string (that doesnt end by .dbfun...)
+        db_funs = []
         for reg in regressors:
             # instantiate appropriate dbfun
             if reg in self.extended_cols:  # column already in db
                 col, _ = self.parse_extended_column(reg)
-                db_fun = dbfun_column.DBfun_Column(reg, db, col, indexed=True)
+                db_fun = dbfun_column.DBfun_Column(
+                    reg, db, col, indexed=True,
+                    table=self.code_tables.get(col))
             elif len(reg) >= 6 and reg[-6:] == '.dbfun':  # lookup table
                 # ask for re-interpreted indexed outputs
                 db_fun = dbfun_lookuptable.DBfun_LookupTable(reg, indexed=True)
             else:  # on the fly computation
                 db_fun = dbfun_compute.DBfun_Compute(reg, self.extended_cols)
             self.add(db_fun)
+            db_funs.append(db_fun)
+
+        # the codes of a coded column are the positions of its values in
+        # the index of its column regressors, which can use them directly
+        # unless another regressor needs the values of the column
+        coded = [db_fun for db_fun in db_funs
+                 if isinstance(db_fun, dbfun_column.DBfun_Column) and
+                 self.parse_extended_column(
+                     db_fun.input_names[0])[0] in self.code_tables]
+        other_inputs = {name for db_fun in db_funs if db_fun not in coded
+                        for name in db_fun.input_names}
+        for db_fun in coded:
+            if db_fun.input_names[0] not in other_inputs:
+                db_fun.coded = True
+                self.coded_variables.add(db_fun.input_names[0])
 
         # regressor names and regressor index if needed
 
@@ -24,7 +24,15 @@ import numpy as np
 
 class SideOperationsManager(object):
 
-    def __init__(self, db_hierarchy, on, across, by):
+    def __init__(self, db_hierarchy, on, across, by, code_tables=None):
+
+        # columns stored as integer codes in the databases and values
+        # given to the side-operations, with the table of the values of
+        # their codes (see database.encode_columns). They are decoded
+        # when setting up the contexts, except for the context variables
+        # in coded_variables, which are given as codes
+        self.code_tables = {} if code_tables is None else code_tables
+        self.coded_variables = set()
 
         # all columns
         self.extensions = ['', '_A', '_B', '_X', '_AB', '_AX', '_1', '_2']
@@ -308,10 +316,19 @@ class SideOperationsManager(object):
                 if elements:
                     self.classify_ABX(elements, db_fun, db_variables)
 
+    def decode(self, radical, extension, values):
+        """Values of a context variable from the values of its column,
+        decoded if the column is stored as integer codes"""
+        if (radical in self.code_tables and
+                radical + extension not in self.coded_variables):
+            return list(self.code_tables[radical][np.asarray(values)])
+        return list(values)
+
     # could use arrays instead of lists for speed ?
     def set_by_context(self, context, stage, by_values):
         for radical, extension in self.by_context[stage]:
-            context[radical + extension] = [by_values[radical]]
+            context[radical + extension] = self.decode(
+                radical, extension, [by_values[radical]])
         return context
 
     # could use arrays instead of lists for speed ?
@@ -319,15 +336,18 @@ class SideOperationsManager(object):
         for radical, extension in self.generic_context[stage]:
             # note that in the current implementation the extension is
             # always ''
-            context[radical + extension] = list(db[radical])
+            context[radical + extension] = self.decode(
+                radical, extension, db[radical])
         return context
 
     def set_on_across_context(self, context, stage, on_across_values):
         # this list contains 0 or 1 elements
         for radical, extension in self.on_context[stage]:
-            context[radical + extension] = [on_across_values[radical]]
+            context[radical + extension] = self.decode(
+                radical, extension, [on_across_values[radical]])
         for radical, extension in self.across_context[stage]:
-            context[radical + extension] = [on_across_values[radical]]
+            context[radical + extension] = self.decode(
+                radical, extension, [on_across_values[radical]])
         return context
     # FIXME use a single function for set_by and set_on and set_across ?
 
@@ -335,7 +355,8 @@ class SideOperationsManager(object):
         field = getattr(self, context_field)
         for radical, extension in field[stage]:
             # FIXME might be faster to index once for all the columns?
-            context[radical + extension] = list(db[radical][indices])
+            context[radical + extension] = self.decode(
+                radical, extension, db[radical][indices])
         return context
 
     def set_ABX_context(self, context, db, triplets):
@@ -62,7 +62,11 @@ attribute; A,B and X share the same 'by' attribute
 """
 
 import argparse
+import functools
+import multiprocessing
 import os
+import pickle
+import shutil
 import sys
 import tempfile
 
@@ -79,21 +83,17 @@ import warnings
 
 import ABXpy.database.database as database
 import ABXpy.h5tools.np2h5 as np2h5
-import ABXpy.h5tools.h52np as h52np
-import ABXpy.h5tools.h5_handler as h5_handler
 import ABXpy.h5tools.h5io as h5io
 import ABXpy.sampling.sampler as sampler
 import ABXpy.sideop.filter_manager as filter_manager
 import ABXpy.sideop.regressor_manager as regressor_manager
 import ABXpy.misc.progress_display as progress_display
+import ABXpy.misc.task_cache as task_cache
 from ABXpy.misc.type_fitting import fit_integer_type
 
 # FIXME many of the fixmes should be presented as feature requests in
 # a github instead of fixmes
 #
-# FIXME get a memory and speed efficient mechanism for storing a task
-# on disk and loading it back (pickling doesn't work well)
-#
 # FIXME filter out empty 'on-across-by' blocks and empty 'by' blocks
 # as soon as possible (i.e. when computing stats)
 #
@@ -102,8 +102,6 @@ from ABXpy.misc.type_fitting import fit_integer_type
 # FIXME find a better scheme for naming 'by' datasets in HDF5 files
 # (to remove the current warning)
 #
-# FIXME efficiently dealing with case where there is no across
-#
 # FIXME syntax to specify names for side-ops when computing them on
 # the fly or at the very least number of output (default is one)
 #
@@ -186,9 +184,23 @@ class Task(object):
     verbose : bool, optional
         display additionnal information is set to True.
 
+    sidecar : bool, optional
+        if set to True, the parsed item file is cached in a binary
+        sidecar file next to it, making the next loadings much faster
+        (see ABXpy.database.database.read_table).
+
+    lazy_stats : bool, optional
+        if set to True and A, B, X or ABX filters are specified, the
+        exact number of triplets is not computed at initialization,
+        since this requires to generate all the triplets. The
+        statistics are then approximate (the number of triplets being
+        an upper bound) until generate_triplets, which collects the exact
+        size of each block while writing it.
+
     """
     def __init__(self, db_name, on, across=None, by=None,
-                 filters=None, regressors=None, verbose=False):
+                 filters=None, regressors=None, verbose=False,
+                 sidecar=False, lazy_stats=False):
         # check the item file is here
         if not os.path.isfile(db_name):
             raise AssertionError('item file {} not found'.format(db_name))
@@ -204,11 +216,26 @@ class Task(object):
         self.across = self._init_as_list(across)
         self.by = self._init_as_list(by)
 
+        # specification of the task, identifying it in the task cache
+        self.spec = {'on': self.on, 'across': list(self.across),
+                     'by': list(self.by),
+                     'filters': [] if filters is None else list(filters),
+                     'regressors': ([] if regressors is None
+                                    else list(regressors))}
+
         # load the item database and check it
         self.db, self.db_hierarchy, feat_db = database.load(
-            self.database, features_info=True)
+            self.database, features_info=True, sidecar=sidecar)
         self._init_check_database()
 
+        # the auxiliary files merged with the item file (see
+        # database.load_aux_dbs)
+        basename = os.path.splitext(self.database)[0]
+        self.aux_files = [
+            basename + '.' + col for col in self.db.columns
+            if os.path.isfile(basename + '.' + col) and
+            basename + '.' + col != self.database]
+
         # if 'by' or 'across' are empty create appropriate dummy
         # columns. '#' is forbidden in user names for columns. Note
         # that this additional columns are not in the db_hierarchy,
@@ -221,21 +248,30 @@ class Task(object):
             self.db['#across'] = range(len(self.db))
             self.across = ['#across']
 
+        # the 'on', 'across' and 'by' columns are stored as integer codes
+        # (see database.encode_columns), their values being decoded only
+        # by the filters and regressors
+        codes, self.code_tables = database.encode_columns(
+            self.db, self.on + self.across + self.by)
+        for col, col_codes in codes.iteritems():
+            self.db[col] = col_codes
+
         # setup filters
         self.filters = filter_manager.FilterManager(
             self.db_hierarchy, self.on, self.across, self.by,
-            [] if filters is None else filters)
+            [] if filters is None else filters, self.code_tables)
 
         # setup regressors
         self.regressors = regressor_manager.RegressorManager(
             self.db, self.db_hierarchy, self.on, self.across, self.by,
-            [] if regressors is None else regressors)
+            [] if regressors is None else regressors, self.code_tables)
 
         # some other attributes that are populated during the database
         # preparation below
         self.by_dbs = {}
         self.types = {}
         self.feat_dbs = {}
+        self.by_rows = {}
         self.on_blocks = {}
         self.across_blocks = {}
         self.on_across_blocks = {}
@@ -246,7 +282,7 @@ class Task(object):
         self._init_prepare_types()
 
         # compute some statistics about the task
-        self.compute_statistics()
+        self.compute_statistics(approximate=lazy_stats)
 
     @staticmethod
     def _init_as_list(arg):
@@ -287,8 +323,15 @@ class Task(object):
             print("input database verified")
 
     def _init_prepare_database(self, feat_db):
-        """Prepare the database for triplet generation"""
+        """Prepare the database for triplet generation
+
+        The database of each 'by' level keeps the integer codes of the
+        'on', 'across' and 'by' columns, from which its on, across and
+        on/across blocks are computed.
+
+        """
         by_groups = self.db.groupby(self.by)
+        positions = self.db.index.get_indexer
 
         if self.verbose:
             display = progress_display.ProgressDisplay()
@@ -298,6 +341,7 @@ class Task(object):
             if self.verbose:
                 display.update('block', 1)
                 display.display()
+            by_key = self._decode_key(self.by, by_key)
 
             # allow to get by values as well as values of other variables
             # that are determined by these
@@ -307,6 +351,7 @@ class Task(object):
             if self.filters.by_filter(by_values):
                 # get analogous feat_db
                 by_feat_db = feat_db.iloc[by_frame.index]
+                by_rows = positions(by_frame.index)
 
                 # drop indexes
                 by_frame = by_frame.reset_index(drop=True)
@@ -323,20 +368,56 @@ class Task(object):
                 self.by_dbs[by_key] = by_frame
                 self.feat_dbs[by_key] = by_feat_db
 
-                def _by_dbs(l): return self.by_dbs[by_key].groupby(l)
-                self.on_blocks[by_key] = _by_dbs(self.on)
-                self.across_blocks[by_key] = _by_dbs(self.across)
-                self.on_across_blocks[by_key] = _by_dbs(self.on + self.across)
-
-                if len(self.across) > 1:
-                    self.antiacross_blocks[by_key] = dict()
-                    for across_key in (self.across_blocks[by_key]
-                                       .groups.iterkeys()):
-                        b = True
-                        for i, col in enumerate(self.across):
-                            b = b * (by_frame[col] != across_key[i])
-                        self.antiacross_blocks[by_key][across_key] = (
-                            by_frame[b].index)
+                # position in self.db of the remaining items
+                self.by_rows[by_key] = by_rows[by_frame.index.values]
+
+                self._init_blocks(by_key, by_frame.index,
+                                  self._by_codes(by_key))
+
+    def _decode_key(self, columns, key):
+        """Values of a groupby key of some coded columns"""
+        if len(columns) == 1:
+            return self.code_tables[columns[0]][key]
+        return tuple(self.code_tables[col][code]
+                     for col, code in zip(columns, key))
+
+    def _by_codes(self, by):
+        """Codes of the 'on' and 'across' columns of the items of a 'by'
+        level"""
+        return {col: self.by_dbs[by][col].values
+                for col in self.on + self.across}
+
+    def _column_values(self, by, col):
+        """Decoded values of a coded column of the items of a 'by' level,
+        as a pandas.Series"""
+        codes = self.by_dbs[by][col]
+        return pd.Series(self.code_tables[col][codes.values],
+                         index=codes.index)
+
+    def _init_blocks(self, by, index, by_codes, group_codes=None):
+        """Compute the on, across, on/across and antiacross blocks of a
+        'by' level from the codes of its items
+
+        index is the index of by_dbs[by] and by_codes the codes of its
+        'on' and 'across' columns (see _by_codes). group_codes, if
+        specified, gives the already known group of each item for 'on',
+        'across' and 'on_across' (see Task.load).
+
+        """
+        if group_codes is None:
+            group_codes = {}
+
+        def _by_dbs(name, l): return database.CodedGroups(
+            index, by_codes, self.code_tables, l,
+            group_codes.get(name))
+        self.on_blocks[by] = _by_dbs('on', self.on)
+        self.across_blocks[by] = _by_dbs('across', self.across)
+        self.on_across_blocks[by] = _by_dbs(
+            'on_across', self.on + self.across)
+
+        if len(self.across) > 1:
+            self.antiacross_blocks[by] = database.AntiacrossIndex(
+                index, by_codes, self.code_tables, self.across)
 
     def _init_prepare_types(self):
         """Determining appropriate numeric type to represent index
@@ -403,6 +484,10 @@ class Task(object):
                 'block', 'Computing statistics for by/on/across block',
                 self.stats['nb_blocks'])
 
+        need_approx = approximate or not(
+            self.filters.A or self.filters.B or
+            self.filters.X or self.filters.ABX)
+
         for by, db in self.by_dbs.iteritems():
             stats = self.by_stats[by]
             stats['block_sizes'] = {}
@@ -410,6 +495,20 @@ class Task(object):
             stats['nb_across_pairs'] = 0
             stats['nb_on_pairs'] = 0
 
+            if self.across == ['#across'] and (
+                    need_approx or not self.filters.ABX):
+                self._no_across_statistics(by, not need_approx)
+                if self.verbose:
+                    display.update('block', stats['nb_on_across_levels'])
+                    display.display()
+                continue
+
+            # with several across columns, the number of possible X for
+            # a block is read from the antiacross index rather than
+            # from the 'on' block sizes
+            if len(self.across) > 1 and need_approx:
+                antiacross_on_counts = self._antiacross_on_counts(by)
+
             # iterate over on/across blocks
             for block_key, count in stats['on_across_levels'].iteritems():
                 if self.verbose:
@@ -435,22 +534,19 @@ class Task(object):
                     else:
                         n_B = stats['across_levels'][across] - n_A
 
-                    n_X = n_X - n_A
+                    if isinstance(across, tuple) and need_approx:
+                        n_X = antiacross_on_counts[across][on]
+                    else:
+                        n_X = n_X - n_A
                     stats['nb_across_pairs'] += n_A * n_B
                     stats['nb_on_pairs'] += n_A * n_X
 
-                    need_approx = approximate or not(
-                        self.filters.A or self.filters.B
-                        or self.filters.X or self.filters.ABX)
-
-                    if need_approx and not isinstance(across, tuple):
+                    if need_approx:
                         stats['nb_triplets'] += n_A * n_B * n_X
                         stats['block_sizes'][block_key] = n_A * n_B * n_X
                     else:
-                        # count exact number of triplets, could be further
-                        # optimized because it isn't necessary to do the whole
-                        # triplet generation, in particular in the case where
-                        # there are no ABX filters
+                        # count exact number of triplets in presence of
+                        # A, B, X or ABX filters
                         nb_triplets = self.on_across_triplets(
                             by, on, across, block, on_across_by_values,
                             with_regressors=False).shape[0]
@@ -467,69 +563,95 @@ class Task(object):
         # blocks here, also reset self.n_blocks in consequence
         self.n_blocks = self.stats['nb_blocks']
 
-    def on_across_triplets(self, by, on, across,
-                           on_across_block, on_across_by_values,
-                           with_regressors=True):
-        """Generate all possible triplets for a given by block.
+    def _no_across_statistics(self, by, exact):
+        """Statistics of the on/across blocks of a 'by' level without
+        'across'
 
-        Given an on_across_block of the database and the parameters of the
-        task, this function will generate the complete set of triplets and
-        the regressors.
+        Counterpart of the block by block loop of compute_statistics,
+        computed once per 'on' level (see _no_across_items). If exact, the
+        numbers of triplets take the A, B and X filters into account.
+
+        """
+        stats = self.by_stats[by]
+        across_values = self._column_values(by, '#across')
+        for on, on_items, _, items in self._no_across_items(by, exact):
+            keys = [(on, across)
+                    for across in across_values.loc[on_items].values]
+            if items is None:
+                stats['block_sizes'].update(dict.fromkeys(keys, 0))
+                continue
+            n_on = len(on_items)
+            stats['nb_across_pairs'] += n_on * (stats['nb_items'] - n_on)
+            stats['nb_on_pairs'] += n_on * (n_on - 1)
+
+            # each item of A is a block whose X are the other items of X
+            A, B, X = items
+            in_A = np.in1d(on_items, A)
+            sizes = np.zeros(n_on, dtype=np.int64)
+            sizes[in_A] = len(B) * (len(X) - np.in1d(on_items[in_A], X))
+            stats['block_sizes'].update(zip(keys, sizes))
+            stats['nb_triplets'] += int(sizes.sum())
+
+    def _antiacross_on_counts(self, by):
+        """Count the items of each 'on' level in the antiacross blocks
+
+        Only used when there are several 'across' columns.
 
         Parameters
         ----------
 
-        by : int
-            The block index
-
-        on, across : int
-            The task attributes
-
-        on_across_block : list
-            the block
-
-        on_across_by_values : dict
-            the actual values
-
-        with_regressors : bool, optional
-            By default, true
+        by : tuple
+            The by key
 
         Returns
         -------
 
-        triplets : numpy.Array
-            the set of triplets generated
+        counts : dict
+            For each across key, a pandas.Series giving, for each 'on'
+            level, the number of items with this 'on' value whose
+            'across' values are all different from the across key.
 
-        regressors : numpy.Array
-            the regressors generated
+        """
+        on_levels = self.on_blocks[by].size()
+        across_keys = self.across_blocks[by].keys()
+        counts = self.antiacross_blocks[by].group_counts(
+            across_keys, self.on_blocks[by])
+        return {across: pd.Series(across_counts, index=on_levels.index)
+                for across, across_counts in zip(across_keys, counts)}
+
+    def _on_across_items(self, by, on, across,
+                         on_across_block, on_across_by_values):
+        """Candidate A, B and X items of an on/across block
+
+        The A, B and X filters are applied, the returned arrays contain
+        indexes in by_dbs[by].
 
         """
         # find all possible A, B, X where A and X have the 'on'
         # feature of the block and A and B have the 'across' feature
-        # of the block
+        # of the block (using sorted arrays rather than python sets)
         A = np.array(on_across_block, dtype=self.types[by])
-        on_set = set(self.on_blocks[by].groups[on])
+        on_items = np.asarray(self.on_blocks[by].groups[on])
 
         # FIXME quick fix to process case with no across, but better
         # done in a separate loop...
         if self.across == ['#across']:
             # in this case A is a singleton and B can be anything in
             # the by block that doesn't have the same 'on' as A
-            B = np.array(
-                list(set(self.by_dbs[by].index).difference(on_set)),
-                dtype=self.types[by])
+            B = np.setdiff1d(self.by_dbs[by].index.values, on_items)
         else:
             # remove B with the same 'on' than A
-            B = np.array(
-                list(set(self.across_blocks[by].groups[across]).difference(A)),
-                dtype=self.types[by])
+            B = np.setdiff1d(
+                np.asarray(self.across_blocks[by].groups[across]), A)
+        B = B.astype(self.types[by])
 
         # remove X with the same 'across' than A
         if type(across) is tuple:
-            antiacross_set = set(self.antiacross_blocks[by][across])
-            X = np.array(list(antiacross_set & on_set), dtype=self.types[by])
+            X = on_items[self.antiacross_blocks[by].mask(
+                across, self.by_dbs[by].index.get_indexer(on_items))]
         else:
-            X = np.array(list(on_set.difference(A)), dtype=self.types[by])
+            X = np.setdiff1d(on_items, A)
+        X = X.astype(self.types[by])
 
         # apply singleton filters
         db = self.by_dbs[by]
@@ -543,11 +665,73 @@ class Task(object):
             iX = self.filters.X_filter(on_across_by_values, db, X)
             X = X[iX]
 
+        return A, B, X
+
+    def on_across_triplets(self, by, on, across,
+                           on_across_block, on_across_by_values,
+                           with_regressors=True, items=None,
+                           item_regressors=None, sample=None):
+        """Generate all possible triplets for a given by block.
+
+        Given an on_across_block of the database and the parameters of the
+        task, this function will generate the complete set of triplets and
+        the regressors.
+
+        Parameters
+        ----------
+
+        by : int
+            The block index
+
+        on, across : int
+            The task attributes
+
+        on_across_block : list
+            the block
+
+        on_across_by_values : dict
+            the actual values
+
+        with_regressors : bool, optional
+            By default, true
+
+        items : tuple, optional
+            the candidate A, B and X items of the block, as returned by
+            _on_across_items, computed if not specified
+
+        item_regressors : dict, optional
+            the regressors of the A, B and X items, as returned by
+            _item_regressors, computed if not specified
+
+        sample : numpy.Array, optional
+            the sorted indices of the triplets to generate in the A x B x
+            X product of the block (see _sample_triplets), all the
+            triplets of the block are generated if not specified
+
+        Returns
+        -------
+
+        triplets : numpy.Array
+            the set of triplets generated
+
+        regressors : numpy.Array
+            the regressors generated
+
+        """
+        if items is None:
+            items = self._on_across_items(
+                by, on, across, on_across_block, on_across_by_values)
+        A, B, X = items
+        db = self.by_dbs[by]
+
         # instantiate A, B, X regressors here
         if with_regressors:
-            self.regressors.set_A_regressors(on_across_by_values, db, A)
-            self.regressors.set_B_regressors(on_across_by_values, db, B)
-            self.regressors.set_X_regressors(on_across_by_values, db, X)
+            if item_regressors is None:
+                self._item_regressors(on_across_by_values, db, A, B, X)
+            else:
+                self.regressors.A_regressors = item_regressors['A']
+                self.regressors.B_regressors = item_regressors['B']
+                self.regressors.X_regressors = item_regressors['X']
 
         # A, B, X can then be combined efficiently in a full (or
         # randomly sampled) factorial design
@@ -556,7 +740,12 @@ class Task(object):
 
         if size > 0:
             ind_type = fit_integer_type(size, is_signed=False)
-            indices = np.arange(size, dtype=ind_type)
+            if sample is None:
+                indices = np.arange(size, dtype=ind_type)
+            else:
+                assert sample[-1] < size, "sample out of the block"
+                indices = sample.astype(ind_type)
+                size = indices.shape[0]
 
             # generate triplets from indices
             iX = np.mod(indices, len(X))
@@ -609,7 +798,9 @@ class Task(object):
                     for i in range(1, len(n_regs)):
                         new_index = regs[:, i] + n_regs[i] * new_index
 
-                    permut = np.argsort(new_index)
+                    # stable, so that the triplets of a cell stay in
+                    # the order of the A x B x X product
+                    permut = np.argsort(new_index, kind='mergesort')
 
                     # the organization should be revamped: the real
                     # sorting is done by the line just above, while
@@ -620,8 +811,8 @@ class Task(object):
                     # function...
                     thr_sort_permut, on_across_block_index = (
                         sort_and_threshold(
-                            permut, new_index, reg_ind_type,
-                            threshold=self.threshold))
+                            permut, new_index, threshold=self.threshold,
+                            random_state=self.random_state))
                     triplets = triplets[thr_sort_permut]
                 else:
                     # FIXME was a bug breaking tests -> variable need
@@ -645,6 +836,9 @@ class Task(object):
 
             thr_sort_permut = np.empty(shape=0, dtype=np.uint8)
 
+        # number of triplets of the block, before thresholding
+        self.n_block_triplets = size
+
         if not with_regressors:
             return triplets
         else:
@@ -667,16 +861,201 @@ class Task(object):
                     regressors,
                     np.array(on_across_block_index)[:, None])
 
-    # FIXME add a mechanism to allow the specification of a random seed in a
-    # way that would produce reliably the same triplets on different machines
-    # (means cross-platform random number generator + having its state so as
-    # to be sure that no other random number generation calls to it are
-    # altering the sequence).
-    #
-    # FIXME use an object that guarantees that the stream will not be
-    # perturbed by external codes calls to np.random.
-    def generate_triplets(self, output=None,
-                          threshold=None, tmpdir=None, seed=None):
+    def _stream_triplets(self, by, A, B, X, item_regressors,
+                         on_across_by_values, out, out_regs,
+                         out_block_index):
+        """Write the triplets of an on/across block by chunks
+
+        Counterpart of on_across_triplets for blocks with more than
+        self.chunk_size triplets: the triplets, their regressors and the
+        block index are written to the output buffers in chunks of at
+        most self.chunk_size triplets, so that the memory used does not
+        depend on the size of the block.
+
+        The B and X items are first grouped by regressor values. The
+        triplets are then enumerated cell by cell, a cell being a group
+        of B items and a group of X items, so that they come out sorted
+        by regressors without having to sort the whole block. When
+        thresholding, the cells larger than the threshold are sampled
+        with sample_cell, which gives the same triplets as
+        sort_and_threshold in on_across_triplets. Without ABX filters,
+        only the sampled triplets of these cells are enumerated. With
+        ABX filters, the size of the cells after filtering is counted in
+        a first pass over the block, and the triplets are kept in a
+        second pass according to their rank in their filtered cell.
+
+        Parameters
+        ----------
+
+        by : tuple
+            The by key
+
+        A, B, X : numpy.Array
+            The candidate A, B and X items of the block (indexes in
+            by_dbs[by])
+
+        item_regressors : dict
+            For 'A', 'B' and 'X', the regressors of the items, in the
+            format of self.regressors.A_regressors
+
+        on_across_by_values : dict
+            the actual values
+
+        Returns
+        -------
+
+        n_triplets : int
+            the number of triplets written
+
+        """
+        db = self.by_dbs[by]
+        B_order, B_bounds = regressors_groups(item_regressors['B'], len(B))
+        X_order, X_bounds = regressors_groups(item_regressors['X'], len(X))
+        B_sizes = np.diff(B_bounds)
+        X_sizes = np.diff(X_bounds)
+        cell_B = np.repeat(np.arange(len(B_sizes)), len(X_sizes))
+        cell_X = np.tile(np.arange(len(X_sizes)), len(B_sizes))
+        cell_sizes = len(A) * B_sizes[cell_B] * X_sizes[cell_X]
+        cell_offsets = cumulated_bounds(cell_sizes)
+
+        def chunks(offsets):
+            # cell and index in the cell of the enumerated triplets
+            for start in range(0, offsets[-1], self.chunk_size):
+                stop = min(start + self.chunk_size, offsets[-1])
+                cell = np.searchsorted(
+                    offsets, np.arange(start, stop), side='right') - 1
+                yield cell, np.arange(start, stop) - offsets[cell]
+
+        def decode(cell, local):
+            # A, B and X positions of the triplets from their index in
+            # their cell
+            n_X = X_sizes[cell_X[cell]]
+            iX = X_order[X_bounds[cell_X[cell]] + local % n_X]
+            local = local // n_X
+            n_B = B_sizes[cell_B[cell]]
+            iB = B_order[B_bounds[cell_B[cell]] + local % n_B]
+            return local // n_B, iB, iX
+
+        # size of the cells before thresholding and offsets of the
+        # enumerated triplets
+        filter_first = self.threshold and self.filters.ABX
+        if filter_first:
+            kept_sizes = np.zeros(len(cell_sizes), dtype=np.int64)
+            for cell, local in chunks(cell_offsets):
+                iA, iB, iX = decode(cell, local)
+                keep = self.filters.ABX_filter(
+                    on_across_by_values, db,
+                    np.column_stack((A[iA], B[iB], X[iX])))
+                kept_sizes += np.bincount(
+                    cell[keep], minlength=len(cell_sizes))
+            kept_offsets = cumulated_bounds(kept_sizes)
+            enumerated_offsets = cell_offsets
+        elif self.threshold:
+            kept_sizes, kept_offsets = cell_sizes, cell_offsets
+            enumerated_offsets = cumulated_bounds(
+                np.minimum(cell_sizes, self.threshold))
+        else:
+            enumerated_offsets = cell_offsets
+
+        scalar_names = (
+            self.regressors.by_names + self.regressors.on_across_by_names)
+        scalar_regressors = (
+            self.regressors.by_regressors +
+            self.regressors.on_across_by_regressors)
+
+        samples = {}
+        last_cell = -1
+        n_seen = 0
+        n_written = 0
+        for cell, local in chunks(enumerated_offsets):
+            # samples of the oversized cells of this chunk, drawn in the
+            # order of the cells
+            if self.threshold:
+                first, last = cell[0], cell[-1]
+                oversized = first + np.flatnonzero(
+                    kept_sizes[first:last + 1] > self.threshold)
+                for c in oversized:
+                    if c not in samples:
+                        samples[c] = sample_cell(
+                            kept_sizes[c], self.threshold,
+                            random_state=self.random_state,
+                            chunk_size=self.chunk_size)
+
+            # replace the enumeration of the sampled cells by their sample
+            if self.threshold and not filter_first:
+                for c in oversized:
+                    lo, hi = np.searchsorted(cell, [c, c + 1])
+                    local[lo:hi] = samples[c][local[lo:hi]]
+
+            iA, iB, iX = decode(cell, local)
+            triplets = np.column_stack((A[iA], B[iB], X[iX]))
+
+            if self.filters.ABX:
+                keep = self.filters.ABX_filter(
+                    on_across_by_values, db, triplets)
+                triplets, cell = triplets[keep], cell[keep]
+                iA, iB, iX = iA[keep], iB[keep], iX[keep]
+
+            # boundaries of the cells starting in this chunk, in the
+            # block before thresholding
+            new_cells = np.flatnonzero(np.concatenate(
+                (cell[:1] != last_cell, cell[1:] != cell[:-1])))
+            if self.threshold:
+                boundaries = kept_offsets[cell[new_cells]]
+            else:
+                boundaries = n_seen + new_cells
+
+            # keep the sampled triplets of the oversized cells from their
+            # rank in their cell after filtering
+            if filter_first:
+                rank = n_seen + np.arange(cell.size) - kept_offsets[cell]
+                selected = kept_sizes[cell] <= self.threshold
+                for c in oversized:
+                    lo, hi = np.searchsorted(cell, [c, c + 1])
+                    selected[lo:hi] = np.in1d(rank[lo:hi], samples[c])
+            if cell.size > 0:
+                last_cell = cell[-1]
+            n_seen += cell.size
+            if filter_first:
+                triplets = triplets[selected]
+                iA, iB, iX = iA[selected], iB[selected], iX[selected]
+            if self.threshold:
+                samples = {c: sample for c, sample in samples.iteritems()
+                           if c == last}
+
+            regressors = {}
+            for names, regs in zip(scalar_names, scalar_regressors):
+                for name, reg in zip(names, regs):
+                    regressors[name] = np.tile(
+                        np.array(reg), (triplets.shape[0], 1))
+            for stage, items in zip(['A', 'B', 'X'], [iA, iB, iX]):
+                for names, regs in zip(
+                        getattr(self.regressors, stage + '_names'),
+                        item_regressors[stage]):
+                    for name, reg in zip(names, regs):
+                        regressors[name] = np.asarray(reg)[items]
+
+            out.write(triplets)
+            out_regs.write(regressors, indexed=True)
+            out_block_index.write(boundaries[:, None])
+            n_written += triplets.shape[0]
+            if not self._pairs_from_items():
+                self._add_triplets_pairs(triplets)
+
+        # end of the last cell, which is also the number of triplets of
+        # the block before thresholding
+        if self.threshold:
+            self.n_block_triplets = kept_offsets[-1]
+        else:
+            self.n_block_triplets = n_seen
+        out_block_index.write(np.array([[self.n_block_triplets]]))
+        return n_written
+
+    def generate_triplets(self, output=None, threshold=None, tmpdir=None,
+                          seed=None, n_jobs=1, memory=1000,
+                          symmetric_pairs=False, layout='explicit',
+                          storage='lzf', cache_dir=None, cache_size=None,
+                          n_samples=None):
         """Generate all possible triplets for the whole task
 
         Generate the triplets and the pairs for an ABXpy.Task and
@@ -695,14 +1074,81 @@ class Task(object):
            where to write temporary files
 
         seed : int, optional
-           seed for initializing the random number generator
+           seed for initializing the random number generator. The random
+           numbers are drawn from a numpy.random.RandomState rather than
+           from the global state of numpy.random, so that they are not
+           perturbed by other codes. When a seed is specified, each 'by'
+           level gets its own RandomState, seeded from the seed and the
+           position of the 'by' level, so that the output does not
+           depend on n_jobs.
+
+        n_jobs : int, optional
+           number of processes used to generate the task. With n_jobs >
+           1 the 'by' levels are distributed among the processes, each
+           one writing to a temporary shard file, and the shards are
+           then merged into the output file.
+
+        memory : float, optional
+           approximate amount of memory (in Mo) that can be used to
+           generate triplets. Blocks of triplets that would need more
+           than this are generated by chunks. With n_jobs > 1, it is
+           shared among the processes.
+
+        symmetric_pairs : bool, optional
+           if True, the pairs (a, b) and (b, a) are stored only once in
+           the task file, so that their distance is computed only once.
+           This is only valid for symmetric distances. The choice is
+           recorded in the 'symmetric_pairs' attribute of the task file.
+
+        layout : 'explicit' or 'virtual', optional
+           how the triplets are stored in the task file. The explicit
+           layout stores each triplet and its regressors. The virtual
+           layout only stores the A, B and X items of each on/across
+           block and the regressors of these items, the triplets being
+           the product A x B x X of each block (see
+           _add_virtual_datasets). It is much more compact but is not
+           possible with ABX filters, ABX regressors, non-indexed
+           regressors, a threshold or n_samples, in which case the
+           explicit layout
+           is used instead. Use read_triplets to read the triplets of a
+           task file whatever its layout.
+
+        storage : None, str or dict, optional
+           storage profile (compression, shuffle filter and chunk size)
+           of the triplets, pairs and regressors datasets, see
+           ABXpy.h5tools.np2h5.storage_options. Defaults to lzf
+           compression, which is fast and shrinks these integer datasets
+           severalfold. Use 'none' for uncompressed datasets.
+
+        cache_dir : directory, optional
+           if specified, the task file is looked up in this cache
+           directory before being generated, and stored in it after. The
+           cache key depends on the content of the item file and of its
+           auxiliary files and on the task parameters (see
+           ABXpy.misc.task_cache). On a hit, the cached file is hard-linked
+           (or copied) to output. The cached files are read-only, as well
+           as the task files linked to them.
+           Tasks sampled with a threshold or n_samples but no seed are
+           not cached.
+
+        cache_size : float, optional
+           maximal size of the cache directory (in Mo), the least
+           recently used task files being removed when it is exceeded.
+           Unlimited by default.
+
+        n_samples : int, optional
+           if specified (at least 1), only n_samples triplets drawn
+           uniformly without replacement from the whole task are
+           generated (all of them if the task has fewer triplets),
+           without enumerating the other ones (see _sample_triplets).
+           This requires the exact number of triplets of each block, so
+           it is not possible with ABX filters or approximate
+           statistics, nor together with a threshold.
 
         """
-        # reinitialize the random generator with the provided seed
-        # (TODO this is only used for sampling, so it should be moved
-        # out during code refactoring -> put that in main(), or in
-        # sampling module?)
-        np.random.seed(seed)
+        # random state used to allocate the samples among the blocks
+        # (see _sample_triplets), the 'by' levels have their own
+        self.random_state = sampler.check_random_state(seed)
 
         # check we have triplets in the database
         if self.stats['nb_triplets'] == 0:
@@ -711,8 +1157,42 @@ class Task(object):
             return
         self.total_n_triplets = self.stats['nb_triplets']
 
-        # setup threshold
+        # with lazy statistics, the number of triplets is only an upper
+        # bound used to size the datasets, the exact block sizes are
+        # collected during the generation
+        self._collect_block_sizes = self.stats['approximate_nb_triplets']
+
+        # setup threshold and pairs encoding
         self.threshold = threshold if threshold is not None else False
+        self.symmetric_pairs = symmetric_pairs
+
+        if n_samples is not None:
+            if n_samples < 1:
+                raise ValueError(
+                    'The number of samples must be positive: {}'
+                    .format(n_samples))
+            if threshold is not None:
+                raise ValueError('A threshold and a number of samples '
+                                 'cannot be specified together')
+            if self.filters.ABX or self.stats['approximate_nb_triplets']:
+                raise ValueError(
+                    'Sampling triplets requires the exact number of '
+                    'triplets of each block, which is not known with ABX '
+                    'filters or approximate statistics')
+        self.n_samples = n_samples
+
+        if layout not in ('explicit', 'virtual'):
+            raise ValueError('Unknown triplets layout: {}'.format(layout))
+        if layout == 'virtual' and not self._virtual_layout_allowed():
+            warnings.warn(
+                'The virtual layout is not possible with ABX filters, ABX '
+                'regressors, non-indexed regressors, a threshold or a '
+                'number of samples, using the explicit layout', UserWarning)
+            layout = 'explicit'
+        self.layout = layout
+        # fail early on invalid storage profiles
+        np2h5.storage_options(storage, np.int64, 1)
+        self.storage = storage
 
         # setup output file, raise an error if the file already exists
         if output is None:
@@ -720,46 +1200,215 @@ class Task(object):
         if os.path.exists(output):
             raise ValueError(
                 'The output file already exists: {}'.format(output))
+        # reuse a previously generated task file if possible
+        cache_key = None
+        if cache_dir is not None:
+            cache_key = self._cache_key(
+                threshold, seed, symmetric_pairs, layout, storage,
+                n_samples)
+        if cache_key is not None and task_cache.fetch(
+                cache_dir, cache_key, output):
+            if self.verbose:
+                print('using cached task file for {}'.format(output))
+            with h5py.File(output, 'r') as fh:
+                bys = set(fh['bys'][...])
+            for by in list(self.by_dbs):
+                if str(by) not in bys:
+                    del self.by_dbs[by]
+            return
+
         if self.verbose:
             print('writing output to {}'.format(output))
 
         self.n_triplets = self.total_n_triplets
+        if n_samples is not None:
+            self.samples = self._sample_triplets(n_samples)
+            self.n_triplets = min(n_samples, self.total_n_triplets)
+
+        # maximal number of triplets generated at once, from a rough
+        # estimate of the memory used for each triplet (indexes, sort
+        # keys and regressors, including temporary copies)
+        n_regressors = len(self.regressors.get_regressor_info()[0])
+        bytes_per_triplet = 128 + 16 * n_regressors
+        self.chunk_size = max(1, int(
+            memory * 1e6 / (bytes_per_triplet * max(1, n_jobs))))
+
+        # each 'by' level gets its own seed, derived from its position
+        # in the task, so that the sampled triplets do not depend on
+        # the way 'by' levels are distributed among processes
+        all_bys = list(self.by_dbs)
+        if seed is None:
+            seeds = [None] * len(all_bys)
+        else:
+            seeds = [(seed, n_by) for n_by in range(len(all_bys))]
+
+        if n_jobs > 1 and len(all_bys) > 1:
+            bys = self._generate_shards(
+                output, all_bys, seeds, n_jobs, tmpdir=tmpdir)
+        else:
+            display = None
+            if self.verbose:
+                display = progress_display.ProgressDisplay()
+                display.add(
+                    'block', 'Computing triplets for by/on/across block',
+                    self.n_blocks)
+                display.add(
+                    'triplets', 'Triplets considered:',
+                    self.total_n_triplets)
+
+            bys = self._generate_task_file(
+                output, all_bys, seeds, display=display)
+
+        if self._collect_block_sizes:
+            self._update_statistics()
+
+        # the upper bound of lazy statistics can be positive although
+        # the filters leave no triplets
+        if not bys:
+            os.remove(output)
+            warnings.warn('There are no possible ABX triplets'
+                          ' in the specified task', UserWarning)
+            return
+
+        # deleting empty by blocks
+        for by in set(all_bys).difference(bys):
+            del self.by_dbs[by]
+
+        self._write_feat_dbs(output, bys)
+        with h5py.File(output) as fh:
+            fh.attrs['symmetric_pairs'] = symmetric_pairs
+            fh.attrs['triplets_layout'] = layout
+
+        if cache_key is not None:
+            task_cache.store(
+                cache_dir, cache_key, output,
+                None if cache_size is None else cache_size * 1e6)
 
-        display = None
         if self.verbose:
-            display = progress_display.ProgressDisplay()
-            display.add(
-                'block', 'Computing triplets for by/on/across block',
-                self.n_blocks)
-            display.add(
-                'triplets', 'Triplets considered:', self.total_n_triplets)
+            print('done.')
+
+    def _update_statistics(self):
+        """Update the number of triplets from the block sizes collected
+        during the generation (see lazy_stats)"""
+        for stats in self.by_stats.values():
+            stats['nb_triplets'] = sum(stats['block_sizes'].values())
+        self.stats['nb_triplets'] = sum(
+            [stats['nb_triplets'] for stats in self.by_stats.values()])
+        self.stats['approximate_nb_triplets'] = False
+
+    def _cache_key(self, threshold, seed, symmetric_pairs, layout, storage,
+                   n_samples=None):
+        """Key of the task file in the task cache, None if the task
+        cannot be cached"""
+        # without seed, sampled triplets are not reproducible
+        sampled = threshold is not None or n_samples is not None
+        # memory and n_jobs are not part of the key: the task file,
+        # including its sampled triplets, does not depend on them
+        if sampled and seed is None:
+            return None
+        return task_cache.cache_key(
+            [self.database] + self.aux_files,
+            dict(self.spec, threshold=threshold, seed=seed,
+                 symmetric_pairs=symmetric_pairs, layout=layout,
+                 storage=storage, n_samples=n_samples))
+
+    def _sample_triplets(self, n_samples):
+        """Draw triplets uniformly without replacement from the whole task
+
+        The n_samples triplets are allocated among the 'by' levels, and
+        then among the on/across blocks of each 'by' level, from the
+        block sizes of the statistics: an IncrementalSampler goes through
+        the 'by' levels in turn, drawing the sampled positions in the
+        concatenation of their blocks, so that the triplets are never
+        enumerated. Only the sampled triplets of each block are then
+        decoded from their index in the block (see on_across_triplets).
 
+        Returns
+        -------
+
+        samples : dict
+            For each 'by' level, a dict from the keys of its blocks with
+            sampled triplets to the sorted indices of these triplets in
+            the A x B x X product of the block.
+
+        """
+        n_total = self.total_n_triplets
+        incremental = sampler.IncrementalSampler(
+            n_total, min(n_samples, n_total), step=n_total,
+            random_state=self.random_state)
+        samples = {}
+        for by in self.by_dbs:
+            samples[by] = {}
+            block_sizes = self.by_stats[by]['block_sizes']
+            keys = self.on_across_blocks[by].keys()
+            bounds = cumulated_bounds(
+                [block_sizes.get(key, 0) for key in keys])
+            if bounds[-1] == 0:
+                continue
+            sample = np.sort(incremental.sample(bounds[-1]))
+            starts = np.searchsorted(sample, bounds)
+            for block in np.flatnonzero(np.diff(starts)):
+                samples[by][keys[block]] = (
+                    sample[starts[block]:starts[block + 1]] - bounds[block])
+        return samples
+
+    def _generate_task_file(self, output, bys, seeds, display=None):
+        """Write the triplets and pairs of some 'by' levels to a task file
+
+        Parameters
+        ----------
+
+        output : filename
+            The task file to write, it must not exist.
+
+        bys : list
+            The 'by' levels to process, in the order they are written.
+
+        seeds : list
+            For each 'by' level, the seed of the random state used to
+            process it, or None to use the global random state of
+            numpy.random.
+
+        Returns
+        -------
+
+        bys : list
+            The 'by' levels for which triplets were found.
+
+        """
         by_block_indices = [0]
         self.current_index = 0
-
-        # fill output file with list of needed ABX triplets, it is done
-        # independently for each 'by' value
+        n_pairs = 0
+        virtual = self.layout == 'virtual'
+        datasets, indexes = self.regressors.get_regressor_info()
+        if virtual:
+            # the regressors are the same for all the 'by' levels, their
+            # description is stored only once
+            columns = h5io.H5IO(
+                filename=output, datasets=datasets, indexes=indexes,
+                group='/virtual/regressors/').non_fused_datasets
+            virtual_block_indices = [0]
+            self.current_block = 0
+            self.current_item = 0
+
+        # fill output file with list of needed ABX triplets and of the
+        # associated AX/BX pairs, it is done independently for each
+        # 'by' value
         with np2h5.NP2H5(h5file=output) as fh:
-            # FIXME test if not fixed size impacts performance a lot
-            out = fh.add_dataset(
-                group='triplets',
-                dataset='data',
-                n_rows=self.n_triplets,
-                n_columns=3,
-                item_type=fit_integer_type(self.total_n_triplets),
-                fixed_size=False)
-
-            out_block_index = fh.add_dataset(
-                group='triplets',
-                dataset='on_across_block_index',
-                n_rows=self.stats['nb_blocks'],
-                n_columns=1,
-                item_type=fit_integer_type(self.stats['nb_blocks']),
-                fixed_size=False)
-
-            empty_by_blocks = []
-            bys = []
-            for by, db in self.by_dbs.iteritems():
+            if virtual:
+                out = self._add_virtual_datasets(fh, columns, indexes)
+            else:
+                out, out_block_index = self._add_triplets_datasets(fh)
+            out_pairs = fh.add_dataset(
+                'unique_pairs', 'data', n_columns=1,
+                item_type=np.int64, fixed_size=False,
+                storage=self.storage)
+
+            non_empty_bys = []
+            for by, by_seed in zip(bys, seeds):
+                self.random_state = sampler.check_random_state(by_seed)
+
+                db = self.by_dbs[by]
                 # class for efficiently writing to datasets of the output file
                 # (using a buffer under the hood)
                 if self.verbose:
@@ -769,55 +1418,518 @@ class Task(object):
                 # variables that are determined by these
                 by_values = dict(db.iloc[0])
 
-                datasets, indexes = self.regressors.get_regressor_info()
-                with h5io.H5IO(
-                        filename=output,
-                        datasets=datasets,
-                        indexes=indexes,
-                        group='/regressors/{}/'.format(str(by))) as out_regs:
-                    self._compute_triplets(
-                        by, out, out_block_index, out_regs, db, fh,
-                        by_values, display=display)
-
-                    # if no triplets found: delete by block
-                    if self.current_index == by_block_indices[-1]:
-                        empty_by_blocks.append(by)
-                    else:
-                        by_block_indices.append(self.current_index)
-                        bys.append(by)
-
-            # saving by index, deleting empty by blocks:
-            aux = np.array(
-                by_block_indices,
-                dtype=fit_integer_type(by_block_indices[-1]))
-            by_block_indices = np.hstack((aux[:-1, None], aux[1:, None]))
-            for by in empty_by_blocks:
-                del self.by_dbs[by]
-
-            fh.file.create_dataset(
-                'bys', (aux.shape[0] - 1,),
-                dtype=h5py.special_dtype(vlen=unicode))
-            fh.file['bys'][:] = [str(by) for by in bys]
-
-            fh.file['triplets'].create_dataset(
-                'by_index', data=by_block_indices)
-            fh.file['triplets/data'].resize(aux[-1], axis=0)
+                # pairs are encoded as A + base * X (see pair_codes)
+                self._pairs = []
+                self._pairs_base = np.max(db.index.values) + 1
 
-        if self.verbose:
-            print('done.')
+                if virtual:
+                    self._compute_virtual_triplets(
+                        by, out, columns, db, by_values, display=display)
+                else:
+                    with h5io.H5IO(
+                            filename=output,
+                            datasets=datasets,
+                            indexes=indexes,
+                            group='/regressors/{}/'.format(str(by)),
+                            storage=self.storage
+                    ) as out_regs:
+                        self._compute_triplets(
+                            by, out, out_block_index, out_regs, db, fh,
+                            by_values, display=display)
+
+                # if no triplets found: delete by block
+                if self.current_index != by_block_indices[-1]:
+                    by_block_indices.append(self.current_index)
+                    non_empty_bys.append(by)
+                    if virtual:
+                        virtual_block_indices.append(self.current_block)
+
+                    if self.verbose:
+                        print("Writing AX/BX pairs to task file...")
+                    pairs = merge_unique(self._pairs)
+                    out_pairs.write(pairs[:, None])
+                    fh.file['unique_pairs'].attrs[str(by)] = (
+                        self._pairs_base, n_pairs,
+                        n_pairs + pairs.shape[0])
+                    n_pairs += pairs.shape[0]
+                self._pairs = []
+
+            if virtual:
+                self._write_virtual_index(fh.file, virtual_block_indices)
+            else:
+                # the block index was preallocated from the stats, trim it
+                out_block_index.flush()
+                fh.file['triplets/on_across_block_index'].resize(
+                    out_block_index.dataset_ix, axis=0)
+
+            self._write_by_index(fh.file, non_empty_bys, by_block_indices)
+
+        return non_empty_bys
+
+    def _virtual_layout_allowed(self):
+        """True if the triplets can be stored with the virtual layout
+
+        The triplets of each on/across block must be the full product of
+        its A, B and X items, and the regressors of a triplet must be
+        obtainable from those of its block and of its items, which
+        excludes ABX filters, ABX regressors, thresholding and sampling.
+        All the regressors must also be indexed.
 
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore', tables.NaturalNameWarning)
-            self._generate_pairs(output, tmpdir=tmpdir)
+        """
+        if (self.filters.ABX or self.regressors.ABX or self.threshold or
+                self.n_samples is not None):
+            return False
+        datasets, indexes = self.regressors.get_regressor_info()
+        return set(datasets) == set(indexes)
+
+    def _add_virtual_datasets(self, fh, columns, indexes):
+        """Create the datasets of the virtual triplets layout
+
+        In this layout the triplets of an on/across block are not stored,
+        they are the product A x B x X of its items, enumerated with X
+        varying fastest, then B, then A. The datasets, in the 'virtual'
+        group, are:
+
+        - blocks: for each non-empty block, the position of its first
+          item in items and its numbers of A, B and X items
+        - items: the A, then B, then X items of each block
+        - item_codes: the indexed A, B or X regressors of each item of
+          items, the other columns being 0
+        - block_codes: the indexed by and on_across_by regressors of each
+          block, the other columns being 0
+        - by_index: the range of blocks of each 'by' level (written by
+          _write_virtual_index)
+
+        The columns of the codes are the regressors in the order of the
+        'non_fused_datasets' of virtual/regressors, as in indexed_data
+        with the explicit layout, so that the codes of a triplet are the
+        sum of the codes of its block and of its A, B and X items.
+
+        """
+        max_item = max(np.max(db.index.values) for db in self.by_dbs.values())
+        code_type = fit_integer_type(
+            max([len(indexes[column]) for column in columns] + [1]),
+            is_signed=False)
+        out = {}
+        out['blocks'] = fh.add_dataset(
+            'virtual', 'blocks', n_columns=4, item_type=np.int64,
+            fixed_size=False, storage=self.storage)
+        out['items'] = fh.add_dataset(
+            'virtual', 'items', n_columns=1,
+            item_type=fit_integer_type(max_item), fixed_size=False,
+            storage=self.storage)
+        for name in ['item_codes', 'block_codes']:
+            out[name] = fh.add_dataset(
+                'virtual', name, n_columns=max(1, len(columns)),
+                item_type=code_type, fixed_size=False,
+                storage=self.storage)
+        return out
+
+    @staticmethod
+    def _write_virtual_index(fh, virtual_block_indices):
+        """Save the range of blocks of each 'by' level in a task file"""
+        aux = np.array(virtual_block_indices, dtype=np.int64)
+        fh['virtual'].create_dataset(
+            'by_index', data=np.column_stack((aux[:-1], aux[1:])))
+
+    def _write_virtual_block(self, out, columns, A, B, X, item_regressors,
+                             block_regressors):
+        """Write a non-empty on/across block with the virtual layout
+
+        Parameters
+        ----------
+
+        A, B, X : numpy.Array
+            The items of the block
+
+        item_regressors : dict
+            For 'A', 'B' and 'X', the indexed regressors of the items, as
+            a dict mapping regressor names to arrays of codes
+
+        block_regressors : dict
+            The indexed by and on_across_by regressors of the block,
+            mapping regressor names to codes
+
+        """
+        n_items = len(A) + len(B) + len(X)
+        n_columns = max(1, len(columns))
+        item_codes = np.zeros((n_items, n_columns), dtype=np.int64)
+        block_codes = np.zeros((1, n_columns), dtype=np.int64)
+        start = 0
+        for stage, items in zip(['A', 'B', 'X'], [A, B, X]):
+            for name, reg in item_regressors[stage].iteritems():
+                item_codes[start:start + len(items), columns.index(name)] = (
+                    np.reshape(reg, -1))
+            start += len(items)
+        for name, reg in block_regressors.iteritems():
+            block_codes[0, columns.index(name)] = np.reshape(reg, -1)[0]
+
+        out['blocks'].write(np.array(
+            [[self.current_item, len(A), len(B), len(X)]], dtype=np.int64))
+        out['items'].write(np.concatenate((A, B, X))[:, None])
+        out['item_codes'].write(item_codes)
+        out['block_codes'].write(block_codes)
+        self.current_item += n_items
+        self.current_block += 1
+        self.current_index += len(A) * len(B) * len(X)
+
+    def _compute_virtual_triplets(self, by, out, columns, db, by_values,
+                                  display=None):
+        """Write the on/across blocks of a 'by' level with the virtual layout
+
+        Counterpart of _compute_triplets for the virtual layout: only the
+        items of the blocks and their regressors are computed, using
+        _block_structure when _whole_by_generation_allowed is True and
+        _on_across_items otherwise.
+
+        """
+        self.regressors.set_by_regressors(by_values)
+        by_regressors = named_regressors(
+            self.regressors.by_names, self.regressors.by_regressors)
+
+        if self._whole_by_generation_allowed():
+            blocks = self._block_structure(by)
+            index = db.index.values
+            columns_names = list(db.columns)
+            values = db.values
+            stage_regressors = {}
+            for stage in ['A', 'B', 'X']:
+                stage_regressors[stage] = named_regressors(
+                    getattr(self.regressors, stage + '_names'),
+                    getattr(self.regressors, 'evaluate_' + stage)(
+                        by_values, db, index))
+            for block, row in enumerate(blocks['first']):
+                if self.verbose:
+                    display.update('block', 1)
+                on_across_by_values = dict(zip(columns_names, values[row]))
+                if not self.filters.on_across_by_filter(on_across_by_values):
+                    continue
+                positions = {}
+                for name in ['A', 'B', 'X']:
+                    bounds = blocks[name + '_bounds']
+                    positions[name] = blocks[name][
+                        bounds[block]:bounds[block + 1]]
+                A, B, X = [index[positions[name]].astype(self.types[by])
+                           for name in ['A', 'B', 'X']]
+                if len(A) * len(B) * len(X) == 0:
+                    continue
+                block_regressors = dict(by_regressors)
+                block_regressors.update(named_regressors(
+                    self.regressors.on_across_by_names,
+                    self.regressors.evaluate_on_across_by(
+                        on_across_by_values)))
+                self._add_items_pairs(A, B, X)
+                self._write_virtual_block(
+                    out, columns, A, B, X,
+                    {stage: {name: np.reshape(reg, -1)[positions[stage]]
+                             for name, reg in regs.iteritems()}
+                     for stage, regs in stage_regressors.iteritems()},
+                    block_regressors)
+                if self.verbose:
+                    display.update('triplets', len(A) * len(B) * len(X))
+                    display.display()
+            return
+
+        for block_key, block in self.on_across_blocks[by].groups.iteritems():
+            if self.verbose:
+                display.update('block', 1)
+            on_across_by_values = dict(db.ix[block[0]])
+            if not self.filters.on_across_by_filter(on_across_by_values):
+                continue
+            on, across = on_across_from_key(block_key)
+            A, B, X = self._on_across_items(
+                by, on, across, block, on_across_by_values)
+            if len(A) * len(B) * len(X) == 0:
+                continue
+            self.regressors.set_on_across_by_regressors(on_across_by_values)
+            block_regressors = dict(by_regressors)
+            block_regressors.update(named_regressors(
+                self.regressors.on_across_by_names,
+                self.regressors.on_across_by_regressors))
+            item_regressors = {}
+            for stage, items in zip(['A', 'B', 'X'], [A, B, X]):
+                getattr(self.regressors, 'set_{}_regressors'.format(stage))(
+                    on_across_by_values, db, items)
+                item_regressors[stage] = named_regressors(
+                    getattr(self.regressors, stage + '_names'),
+                    getattr(self.regressors, stage + '_regressors'))
+            self._add_items_pairs(A, B, X)
+            self._write_virtual_block(
+                out, columns, np.asarray(A), np.asarray(B), np.asarray(X),
+                item_regressors, block_regressors)
+            if self.verbose:
+                display.update(
+                    'triplets', self.by_stats[by]['block_sizes'][block_key])
+                display.display()
+
+    def _pairs_from_items(self):
+        """True if the pairs of a block can be derived from its A, B and X
+
+        Without ABX filters, threshold nor n_samples, the AX/BX pairs used
+        by the triplets of an on/across block are all the pairs in A x X
+        and B x X (as long as the block is not empty). Otherwise they are
+        computed from the triplets themselves.
+
+        """
+        return not(self.filters.ABX or self.threshold or
+                   self.n_samples is not None)
+
+    def _add_pairs(self, codes):
+        """Add AX/BX pair codes to the pairs of the current 'by' level"""
+        self._pairs.append(np.unique(codes))
+        # merge the accumulated pairs when they get too numerous, the
+        # already merged ones being at the beginning of the list
+        n_merged = self._pairs[0].shape[0]
+        n_pending = sum(pairs.shape[0] for pairs in self._pairs[1:])
+        if n_pending > max(self.chunk_size, n_merged):
+            self._pairs = [merge_unique(self._pairs)]
+
+    def _add_items_pairs(self, A, B, X):
+        """Add the pairs A x X and B x X of a non-empty on/across block"""
+        A, B, X = [np.asarray(items, dtype=np.int64) for items in (A, B, X)]
+        self._add_pairs(np.concatenate(
+            [pair_codes(items[:, None], X[None, :], self._pairs_base,
+                        self.symmetric_pairs).ravel()
+             for items in (A, B)]))
+
+    def _add_triplets_pairs(self, triplets):
+        """Add the pairs AX and BX of some triplets"""
+        triplets = triplets.astype(np.int64)
+        self._add_pairs(np.concatenate(
+            [pair_codes(triplets[:, i], triplets[:, 2], self._pairs_base,
+                        self.symmetric_pairs)
+             for i in (0, 1)]))
+
+    def _add_triplets_datasets(self, fh):
+        """Create the triplets datasets of a task file opened with NP2H5"""
+        # FIXME test if not fixed size impacts performance a lot
+        out = fh.add_dataset(
+            group='triplets',
+            dataset='data',
+            n_rows=self.n_triplets,
+            n_columns=3,
+            item_type=fit_integer_type(self.total_n_triplets),
+            fixed_size=False,
+            storage=self.storage)
+
+        out_block_index = fh.add_dataset(
+            group='triplets',
+            dataset='on_across_block_index',
+            n_rows=self.stats['nb_blocks'],
+            n_columns=1,
+            item_type=fit_integer_type(self.stats['nb_blocks']),
+            fixed_size=False,
+            storage=self.storage)
+
+        return out, out_block_index
+
+    @staticmethod
+    def _write_by_index(fh, bys, by_block_indices):
+        """Save the 'by' levels and their triplets index in a task file"""
+        aux = np.array(
+            by_block_indices,
+            dtype=fit_integer_type(by_block_indices[-1]))
+        by_block_indices = np.hstack((aux[:-1, None], aux[1:, None]))
+
+        fh.create_dataset(
+            'bys', (aux.shape[0] - 1,),
+            dtype=h5py.special_dtype(vlen=unicode))
+        fh['bys'][:] = [str(by) for by in bys]
+
+        # with the virtual layout, only the number of triplets of each
+        # 'by' level is stored in the triplets group
+        fh.require_group('triplets').create_dataset(
+            'by_index', data=by_block_indices)
+        if 'triplets/data' in fh:
+            fh['triplets/data'].resize(aux[-1], axis=0)
+
+    def _generate_shards(self, output, bys, seeds, n_jobs, tmpdir=None):
+        """Generate the task in parallel and merge the results in output
+
+        The 'by' levels are split into contiguous groups of similar
+        numbers of triplets, each group is written to a shard file by
+        a worker process and the shards are concatenated in order, so
+        that the result is the same as with a single process.
+
+        Returns
+        -------
+
+        bys : list
+            The 'by' levels for which triplets were found.
+
+        """
+        if self.n_samples is None:
+            costs = [self.by_stats[by]['nb_triplets'] for by in bys]
+        else:
+            costs = [sum(len(sample) for sample in self.samples[by].values())
+                     for by in bys]
+        bounds = balanced_bounds(costs, min(len(bys), 4 * n_jobs))
+
+        shard_dir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            jobs = [(os.path.join(shard_dir, 'shard{}.abx'.format(i)),
+                     bys[start:stop], seeds[start:stop])
+                    for i, (start, stop) in enumerate(zip(bounds[:-1],
+                                                          bounds[1:]))]
+
+            if self.verbose:
+                print('Computing triplets with {} processes in {} shards...'
+                      .format(n_jobs, len(jobs)))
+
+            # the worker processes access the task through a module
+            # variable inherited when forking, rather than by pickling it
+            global _shard_task
+            _shard_task = self
+            try:
+                pool = multiprocessing.Pool(n_jobs)
+                try:
+                    results = pool.map(_shard_worker, jobs, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                _shard_task = None
+
+            shard_bys = [result[0] for result in results]
+            if self._collect_block_sizes:
+                for _, block_sizes in results:
+                    for by, sizes in block_sizes.iteritems():
+                        self.by_stats[by]['block_sizes'] = sizes
+
+            if self.verbose:
+                print('Merging shards...')
+            self._merge_shards(output, [job[0] for job in jobs], shard_bys)
+        finally:
+            shutil.rmtree(shard_dir)
+
+        return [by for non_empty_bys in shard_bys for by in non_empty_bys]
+
+    def _merge_shards(self, output, shards, shard_bys, buffer_size=10 ** 6):
+        """Concatenate shard task files in a single task file
+
+        Parameters
+        ----------
+
+        output : filename
+            The task file to write.
+
+        shards : list
+            The shard files, in the order of their 'by' levels.
+
+        shard_bys : list
+            For each shard, the list of its non-empty 'by' levels.
+
+        """
+        def copy_rows(source, out):
+            for i in range(0, source.shape[0], buffer_size):
+                out.write(source[i:i + buffer_size])
+
+        bys = []
+        by_block_indices = [0]
+        pair_index = 0
+        n_pairs = 0
+        for shard in shards:
+            with h5py.File(shard, 'r') as fh:
+                if 'unique_pairs/data' in fh:
+                    n_pairs += fh['unique_pairs/data'].shape[0]
+
+        virtual = self.layout == 'virtual'
+        if virtual:
+            datasets, indexes = self.regressors.get_regressor_info()
+            columns = h5io.H5IO(
+                filename=output, datasets=datasets, indexes=indexes,
+                group='/virtual/regressors/').non_fused_datasets
+            virtual_block_indices = [0]
+            n_items = 0
+
+        with np2h5.NP2H5(h5file=output) as fh:
+            if virtual:
+                out = self._add_virtual_datasets(fh, columns, indexes)
+            else:
+                out, out_block_index = self._add_triplets_datasets(fh)
+            out_pairs = fh.add_dataset(
+                'unique_pairs', 'data', n_rows=n_pairs, n_columns=1,
+                item_type=np.int64, fixed_size=False,
+                storage=self.storage)
+
+            for shard, non_empty_bys in zip(shards, shard_bys):
+                with h5py.File(shard, 'r') as sh:
+                    if virtual:
+                        # the items of the blocks are offset by those of
+                        # the previous shards
+                        blocks = sh['virtual/blocks'][...]
+                        blocks[:, 0] += n_items
+                        out['blocks'].write(blocks)
+                        for name in ['items', 'item_codes', 'block_codes']:
+                            copy_rows(sh['virtual'][name], out[name])
+                        n_items += sh['virtual/items'].shape[0]
+                        offset = virtual_block_indices[-1]
+                        virtual_block_indices.extend(
+                            offset + int(stop)
+                            for stop in sh['virtual/by_index'][:, 1])
+                    else:
+                        copy_rows(sh['triplets/data'], out)
+                        copy_rows(sh['triplets/on_across_block_index'],
+                                  out_block_index)
+                        regressors = fh.file.require_group('regressors')
+                        for by in sh['regressors']:
+                            fh.file.copy(sh['regressors'][by], regressors, by)
+                    offset = by_block_indices[-1]
+                    by_block_indices.extend(
+                        offset + int(stop)
+                        for stop in sh['triplets/by_index'][:, 1])
+
+                    if non_empty_bys:
+                        copy_rows(sh['unique_pairs/data'], out_pairs)
+                        for by in non_empty_bys:
+                            base, start, stop = (
+                                sh['unique_pairs'].attrs[str(by)])
+                            fh.file['unique_pairs'].attrs[str(by)] = (
+                                base, pair_index + start, pair_index + stop)
+                        pair_index += sh['unique_pairs/data'].shape[0]
+                    bys.extend(non_empty_bys)
+
+            if virtual:
+                self._write_virtual_index(fh.file, virtual_block_indices)
+            else:
+                out_block_index.flush()
+                fh.file['triplets/on_across_block_index'].resize(
+                    out_block_index.dataset_ix, axis=0)
+
+            self._write_by_index(fh.file, bys, by_block_indices)
 
     def _compute_triplets(self, by, out, out_block_index,
                           out_regs, db, fh, by_values, display=None):
         # instantiate by regressors here
         self.regressors.set_by_regressors(by_values)
 
+        if self._whole_by_generation_allowed():
+            self._compute_by_triplets(
+                by, out, out_block_index, out_regs, db, by_values,
+                display=display)
+            return
+
+        if self._collect_block_sizes:
+            # the size of the blocks that are written is collected
+            # below, the other ones are empty
+            stats = self.by_stats[by]
+            stats['block_sizes'] = dict.fromkeys(stats['block_sizes'], 0)
+
+        if self.across == ['#across']:
+            self._compute_no_across_triplets(
+                by, out, out_block_index, out_regs, db, display=display)
+            return
+
         # iterate over on/across blocks
-        on_across_blocks = self.on_across_blocks[by].groups.iteritems()
-        for block_key, block in on_across_blocks:
+        on_across_blocks = self.on_across_blocks[by].groups
+        if self.n_samples is None:
+            block_keys = on_across_blocks.keys()
+        else:
+            # only the blocks with sampled triplets are generated
+            block_keys = [key for key in self.on_across_blocks[by].keys()
+                          if key in self.samples[by]]
+        for block_key in block_keys:
+            block = on_across_blocks[block_key]
             if self.verbose:
                 display.update('block', 1)
 
@@ -831,14 +1943,12 @@ class Task(object):
 
                 on, across = on_across_from_key(block_key)
 
-                triplets, regressors, on_across_block_index = (
-                    self.on_across_triplets(
-                        by, on, across, block, on_across_by_values))
-
-                out.write(triplets)
-                out_regs.write(regressors, indexed=True)
-                out_block_index.write(on_across_block_index)
-                self.current_index += triplets.shape[0]
+                items = self._on_across_items(
+                    by, on, across, block, on_across_by_values)
+                self._write_block_triplets(
+                    by, on, across, block, on_across_by_values, items,
+                    out, out_regs, out_block_index,
+                    sample=self._block_sample(by, block_key))
 
                 if self.verbose:
                     display.update(
@@ -848,147 +1958,590 @@ class Task(object):
             if self.verbose:
                 display.display()
 
-    # FIXME clean this function (maybe do a few well-separated sub-functions
-    # for getting the pairs and unique them)
-    def _generate_pairs(self, output=None, tmpdir=None):
-        """Generate the pairs associated to the triplet list"""
+    def _item_regressors(self, on_across_by_values, db, A, B, X):
+        """A, B and X regressors of the candidate items of a block"""
+        self.regressors.set_A_regressors(on_across_by_values, db, A)
+        self.regressors.set_B_regressors(on_across_by_values, db, B)
+        self.regressors.set_X_regressors(on_across_by_values, db, X)
+        return {'A': self.regressors.A_regressors,
+                'B': self.regressors.B_regressors,
+                'X': self.regressors.X_regressors}
+
+    def _block_sample(self, by, block_key):
+        """Sampled triplets of an on/across block (see _sample_triplets),
+        None if all the triplets of the block are generated"""
+        if self.n_samples is None:
+            return None
+        return self.samples[by].get(block_key, np.zeros(0, dtype=np.int64))
+
+    def _write_block_triplets(self, by, on, across, block,
+                              on_across_by_values, items, out, out_regs,
+                              out_block_index, item_regressors=None,
+                              sample=None):
+        """Write the triplets of an on/across block and collect its pairs
+
+        items are the candidate A, B and X items of the block (see
+        _on_across_items) and item_regressors their regressors (see
+        _item_regressors), computed if not specified. Blocks larger than
+        self.chunk_size are streamed with _stream_triplets. If sample is
+        specified, only the sampled triplets of the block are generated
+        (see on_across_triplets), all at once.
 
-        # FIXME change this to a random file name to avoid overwriting problems
-        # default name for output file
-        if output is None:
-            (basename, _) = os.path.splitext(self.database)
-            output = basename + '.abx'
-        # list all pairs
-        n_pairs_dict = {}
-        max_ind_dict = {}
-        try:
-            _, output_tmp = tempfile.mkstemp(dir=tmpdir)
-            for n_by, (by, db) in enumerate(self.by_dbs.iteritems()):
-                if self.verbose > 0:
-                    print("Writing AX/BX pairs to task file...")
-                with h5py.File(output) as fh:
-                    triplets_attrs = fh['/triplets']['by_index'][n_by][...]
-                max_ind = np.max(db.index.values)
-                max_ind_dict[by] = max_ind
-                pair_key_type = fit_integer_type(
-                    (max_ind + 1) ** 2 - 1, is_signed=False)
-                with h52np.H52NP(output) as f_in:
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        inp = f_in.add_subdataset('triplets', 'data',
-                                                  indexes=triplets_attrs)
-                        out = f_out.add_dataset(
-                            'pairs', str(by), n_columns=1,
-                            item_type=pair_key_type, fixed_size=False)
-                        for data in inp:
-                            triplets = pair_key_type(data)
-                            n = triplets.shape[0]
-                            ind = np.arange(n)
-                            i1 = 2 * ind
-                            i2 = 2 * ind + 1
-
-                            pairs = np.empty(
-                                shape=(2 * n, 1),
-                                dtype=pair_key_type)
-
-                            # FIXME change the encoding (and type_fitting)
-                            # so that A,B and B,A have the same code ...
-                            # (take a=min(a,b), b=max(a,b))
-                            # FIXME but allow a flag to control the
-                            # behavior to be able to enforce A,X and B,X
-                            # order when using assymetrical distance
-                            # functions
-                            pairs[i1, 0] = triplets[:, 0] + (
-                                max_ind + 1) * triplets[:, 2]  # AX
-                            pairs[i2, 0] = triplets[:, 1] + (
-                                max_ind + 1) * triplets[:, 2]  # BX
-
-                            # FIXME do a unique here already? Do not store
-                            # the inverse mapping ? (could sort triplets on
-                            # pair1, complete pair1, sort on pair2,
-                            # complete pair 2 and shuffle ?)
-                            out.write(pairs)
-
-                    sort_pairs(output_tmp, by, tmpdir=tmpdir)
-
-                    # counting unique
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        with h52np.H52NP(output_tmp) as f_in:
-                            inp = f_in.add_dataset('pairs', str(by))
-                            n_pairs = 0
-                            last = -1
-                            for pairs in inp:
-                                # unique alters the shape
-                                pairs = np.reshape(pairs, (pairs.shape[0], 1))
-                                n_pairs += np.unique(pairs).size
-                                if pairs[0, 0] == last:
-                                    n_pairs -= 1
-                                if pairs.size > 0:
-                                    last = pairs[-1, 0]
-                        n_pairs_dict[by] = n_pairs
-
-                    # FIXME should have a unique function directly instead of
-                    # sorting + unique ?
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        with h52np.H52NP(output_tmp) as f_in:
-                            inp = f_in.add_dataset('pairs', str(by))
-                            out = f_out.add_dataset(
-                                'unique_pairs', str(by),
-                                n_rows=n_pairs,
-                                n_columns=1,
-                                item_type=pair_key_type,
-                                fixed_size=False)
-
-                            # out = out_unique_pairs
-                            last = -1
-                            for pairs in inp:
-                                pairs = np.unique(pairs)
-                                # unique alters the shape
-                                pairs = np.reshape(pairs, (pairs.shape[0], 1))
-                                if pairs[0, 0] == last:
-                                    pairs = pairs[1:]
-                                if pairs.size > 0:
-                                    last = pairs[-1, 0]
-                                    out.write(pairs)
-
-                        # store for ulterior decoding
-                        store = pd.HDFStore(output)
-
-                        # use append to make use of table format,
-                        # which is better at handling strings without
-                        # much space (fixed-size format)
-                        store.append('/feat_dbs/' + str(by), self.feat_dbs[by],
-                                     expectedrows=len(self.feat_dbs[by]))
-                        store.close()
-                        # FIXME generate inverse mapping to triplets
-                        # (1 and 2) ?
-
-            # Now merge all datasets
-            by_index = 0
-            with np2h5.NP2H5(output) as f_out:
-                n_rows = sum(n_pairs_dict.itervalues())
-                out_unique_pairs = f_out.add_dataset(
-                    'unique_pairs', 'data', n_rows=n_rows, n_columns=1,
-                    item_type=np.int64, fixed_size=False)
-                for n_by, (by, db) in enumerate(self.by_dbs.iteritems()):
-                    triplets_attrs = f_out.file['/triplets']['by_index'][n_by]
-                    if triplets_attrs[0] == triplets_attrs[1]:
-                        # subdataset is empty
-                        continue
-
-                    with h52np.H52NP(output_tmp) as f_in:
-                        inp = f_in.add_dataset('unique_pairs', str(by))
-                        for pairs in inp:
-                            out_unique_pairs.write(pairs)
-
-                    with h5py.File(output) as fh:
-                        fh['/unique_pairs'].attrs[str(by)] = (
-                            max_ind_dict[by] + 1,
-                            by_index, by_index + n_pairs_dict[by])
-                    by_index += n_pairs_dict[by]
-        finally:
-            os.remove(output_tmp)
-        if self.verbose:
-            print("done.")
+        """
+        A, B, X = items
+        size = len(A) * len(B) * len(X)
+        if size > 0 and self._pairs_from_items():
+            self._add_items_pairs(A, B, X)
+        if sample is None and size > self.chunk_size:
+            if item_regressors is None:
+                item_regressors = self._item_regressors(
+                    on_across_by_values, self.by_dbs[by], A, B, X)
+            self.current_index += self._stream_triplets(
+                by, A, B, X, item_regressors, on_across_by_values,
+                out, out_regs, out_block_index)
+        else:
+            triplets, regressors, on_across_block_index = (
+                self.on_across_triplets(
+                    by, on, across, block, on_across_by_values,
+                    items=items, item_regressors=item_regressors,
+                    sample=sample))
+
+            out.write(triplets)
+            out_regs.write(regressors, indexed=True)
+            out_block_index.write(on_across_block_index)
+            self.current_index += triplets.shape[0]
+            if not self._pairs_from_items():
+                self._add_triplets_pairs(triplets)
+
+        if self._collect_block_sizes:
+            self.by_stats[by]['block_sizes'][
+                on_across_key(on, across)] = self.n_block_triplets
+
+    def _no_across_items(self, by, filtered=True):
+        """Candidate items of the 'on' levels of a 'by' level without
+        'across'
+
+        Without 'across', each item is its own on/across block, whose
+        possible B are all the items with another 'on' value and whose
+        possible X are the other items with the same 'on' value. As the
+        on/across/by filters and the A, B and X filters and regressors
+        only depend on the 'on' and 'by' values of a block, they are
+        evaluated once per 'on' level rather than once per item. The A, B
+        and X filters are not applied if filtered is False.
+
+        Yields
+        ------
+
+        on : the 'on' level
+
+        on_items : numpy.Array
+            The items of the 'on' level.
+
+        on_across_by_values : dict
+            The values of the first item of the 'on' level.
+
+        items : tuple
+            The A, B and X items of the 'on' level, after filtering, or
+            None if the 'on' level is removed by the on/across/by
+            filters. The candidate X of an item a of A are then the items
+            of X other than a.
+
+        """
+        db = self.by_dbs[by]
+        index = db.index.values
+        on_blocks = self.on_blocks[by]
+        for on in on_blocks.keys():
+            on_items = np.asarray(on_blocks.groups[on]).astype(
+                self.types[by])
+            on_across_by_values = dict(db.ix[on_items[0]])
+            if not self.filters.on_across_by_filter(on_across_by_values):
+                yield on, on_items, on_across_by_values, None
+                continue
+            A = on_items
+            B = np.setdiff1d(index, on_items).astype(self.types[by])
+            X = on_items
+            if filtered and self.filters.A:
+                A = A[self.filters.A_filter(on_across_by_values, db, A)]
+            if filtered and self.filters.B:
+                B = B[self.filters.B_filter(on_across_by_values, db, B)]
+            if filtered and self.filters.X:
+                X = X[self.filters.X_filter(on_across_by_values, db, X)]
+            yield on, on_items, on_across_by_values, (A, B, X)
+
+    def _compute_no_across_triplets(self, by, out, out_block_index,
+                                    out_regs, db, display=None):
+        """Generate the triplets of a 'by' level without 'across'
+
+        Counterpart of the block by block loop in _compute_triplets
+        where the candidate items and their regressors are computed once
+        per 'on' level (see _no_across_items), each item of the 'on'
+        level then being a block whose A is the item itself. The blocks
+        of an 'on' level are generated together by
+        _write_no_across_batch, in batches of about self.chunk_size
+        triplets, blocks larger than this being streamed with
+        _stream_triplets.
+
+        """
+        across_values = self._column_values(by, '#across')
+        for on, on_items, on_across_by_values, items in (
+                self._no_across_items(by)):
+            if self.verbose:
+                display.update('block', len(on_items))
+            if items is None:
+                continue
+            self.regressors.set_on_across_by_regressors(on_across_by_values)
+            A, B, X = items
+            regressors = self._item_regressors(
+                on_across_by_values, db, A, B, X)
+            block_keys = [(on, across)
+                          for across in across_values.ix[A].values]
+
+            # position of each item of A in X, len(X) if it is not in X
+            A_in_X = np.repeat(len(X), len(A))
+            if len(X) > 0:
+                X_order = np.argsort(X, kind='mergesort')
+                found = X_order[np.minimum(
+                    np.searchsorted(X, A, sorter=X_order), len(X) - 1)]
+                A_in_X[X[found] == A] = found[X[found] == A]
+            sizes = len(B) * (len(X) - (A_in_X < len(X)))
+
+            # blocks without sampled triplets are not generated
+            if self.n_samples is None:
+                samples = None
+                blocks = np.arange(len(A))
+                n_triplets = sizes
+            else:
+                samples = [self._block_sample(by, key) for key in block_keys]
+                n_triplets = np.array([sample.shape[0] for sample in samples],
+                                      dtype=np.int64)
+                blocks = np.flatnonzero(n_triplets > 0)
+                n_triplets = n_triplets[blocks]
+
+            # split the blocks in batches of about chunk_size triplets,
+            # blocks that are streamed being alone in their batch
+            for start, stop in batch_bounds(n_triplets, self.chunk_size,
+                                            samples is None):
+                batch = blocks[start:stop]
+
+                if samples is None and sizes[batch[0]] > self.chunk_size:
+                    i = batch[0]
+                    keep = X != A[i]
+                    item_regressors = {
+                        'A': [[np.asarray(reg)[i:i + 1] for reg in regs]
+                              for regs in regressors['A']],
+                        'B': regressors['B'],
+                        'X': [[np.asarray(reg)[keep] for reg in regs]
+                              for regs in regressors['X']]}
+                    self._write_block_triplets(
+                        by, on, block_keys[i][1], [A[i]],
+                        on_across_by_values, (A[i:i + 1], B, X[keep]),
+                        out, out_regs, out_block_index, item_regressors)
+                    block_sizes = [self.n_block_triplets]
+                else:
+                    block_sizes = self._write_no_across_batch(
+                        by, on_across_by_values, A, B, X, A_in_X,
+                        regressors, batch, samples, out, out_regs,
+                        out_block_index)
+                    if self._collect_block_sizes:
+                        for i, size in zip(batch, block_sizes):
+                            self.by_stats[by]['block_sizes'][
+                                block_keys[i]] = size
+                if self.verbose:
+                    display.update('triplets', np.sum(block_sizes))
+            if self.verbose:
+                display.display()
+
+    def _write_no_across_batch(self, by, on_across_by_values, A, B, X,
+                               A_in_X, regressors, batch, samples, out,
+                               out_regs, out_block_index):
+        """Write the triplets of some blocks of an 'on' level without
+        'across' at once
+
+        The blocks are the items of A at the positions batch (see
+        _compute_no_across_triplets). A_in_X is the position of each item
+        of A in X (len(X) if it is not in X), regressors the regressors of
+        A, B and X (see _item_regressors) and samples the sampled
+        triplets of the block of each item of A, or None. The output is
+        the same as writing each block with on_across_triplets.
+
+        Returns
+        -------
+
+        n_block_triplets : numpy.Array
+            the number of triplets of each block, before thresholding
+
+        """
+        db = self.by_dbs[by]
+        n_X = len(X) - (A_in_X[batch] < len(X))
+        if samples is None:
+            size = len(B) * n_X
+            triplet_block = np.repeat(np.arange(len(batch)), size)
+            local = (np.arange(np.sum(size), dtype=np.int64) -
+                     np.repeat(cumulated_bounds(size)[:-1], size))
+        else:
+            triplet_block = np.repeat(
+                np.arange(len(batch)),
+                [samples[i].shape[0] for i in batch])
+            local = np.concatenate(
+                [samples[i] for i in batch]).astype(np.int64)
+
+        # decode the index of each triplet in the B x X product of its
+        # block, whose X are the items of X other than its A
+        n_X = n_X[triplet_block]
+        iA = batch[triplet_block]
+        iB = local // n_X
+        iX = local % n_X
+        iX += iX >= A_in_X[iA]
+        triplets = np.column_stack((A[iA], B[iB], X[iX]))
+
+        if self.filters.ABX:
+            keep = self.filters.ABX_filter(on_across_by_values, db, triplets)
+            triplets, triplet_block = triplets[keep], triplet_block[keep]
+            iA, iB, iX = iA[keep], iB[keep], iX[keep]
+        n_block_triplets = np.bincount(triplet_block, minlength=len(batch))
+
+        # sort triplets by block, then by B and X regressors
+        keys = [np.asarray(reg)[items]
+                for stage, items in [('B', iB), ('X', iX)]
+                for regs in regressors[stage] for reg in regs]
+        thr_sort_permut, block_index = sort_and_threshold_blocks(
+            triplet_block, keys, cumulated_bounds(n_block_triplets),
+            threshold=self.threshold, random_state=self.random_state)
+        triplets = triplets[thr_sort_permut]
+
+        regressors_out = {}
+        scalar_names = (
+            self.regressors.by_names + self.regressors.on_across_by_names)
+        scalar_regressors = (
+            self.regressors.by_regressors +
+            self.regressors.on_across_by_regressors)
+        for names, regs in zip(scalar_names, scalar_regressors):
+            for name, reg in zip(names, regs):
+                regressors_out[name] = np.tile(
+                    np.array(reg), (triplets.shape[0], 1))
+        for stage, items in zip(['A', 'B', 'X'], [iA, iB, iX]):
+            for names, regs in zip(
+                    getattr(self.regressors, stage + '_names'),
+                    regressors[stage]):
+                for name, reg in zip(names, regs):
+                    regressors_out[name] = np.asarray(reg)[
+                        items[thr_sort_permut]]
+
+        out.write(triplets)
+        out_regs.write(regressors_out, indexed=True)
+        out_block_index.write(block_index[:, None])
+        self.current_index += triplets.shape[0]
+        if not self._pairs_from_items():
+            self._add_triplets_pairs(triplets)
+        else:
+            # AX pairs of the non-empty blocks, and BX pairs with the X
+            # of at least one of them
+            first = A[batch[n_block_triplets > 0]].astype(np.int64)
+            if first.shape[0] > 0:
+                X = np.asarray(X, dtype=np.int64)
+                AX = pair_codes(first[:, None], X[None, :],
+                                self._pairs_base, self.symmetric_pairs)
+                AX = AX[first[:, None] != X[None, :]]
+                X = X[first.shape[0] - np.in1d(X, first) > 0]
+                BX = pair_codes(
+                    np.asarray(B, dtype=np.int64)[:, None], X[None, :],
+                    self._pairs_base, self.symmetric_pairs)
+                self._add_pairs(np.concatenate((AX, BX.ravel())))
+        return n_block_triplets
+
+    def _whole_by_generation_allowed(self):
+        """True if the triplets of a 'by' level can be generated for all its
+        on/across blocks at once
+
+        This requires that no A, B, X or ABX filters are specified and that
+        the A, B and X regressors only depend on the item they are computed
+        for (and possibly on the 'by' level), so that they can be evaluated
+        once for all the items of the 'by' level. Sampled tasks (see
+        n_samples) are generated block by block.
+
+        """
+        if (self.filters.A or self.filters.B or self.filters.X or
+                self.filters.ABX or self.regressors.ABX or
+                self.n_samples is not None):
+            return False
+        for stage in ['A', 'B', 'X']:
+            if (self.regressors.on_context[stage] or
+                    self.regressors.across_context[stage]):
+                return False
+        return True
+
+    def _block_structure(self, by):
+        """Candidate A, B and X items for all the on/across blocks of a 'by'
+        level
+
+        The 'on' and 'across' columns of by_dbs[by] are encoded once as
+        integer codes. The A, B and X items of every block are then
+        obtained as slices of the items sorted by (on, across) codes and
+        by (across, on) codes, without building any python set.
+
+        Returns
+        -------
+
+        blocks : dict
+            'first' contains the position in by_dbs[by] of the first item
+            of each on/across block. 'A', 'B' and 'X' contain the
+            concatenated positions of the candidate items for all the
+            blocks and 'A_bounds', 'B_bounds' and 'X_bounds' the
+            n_blocks + 1 boundaries of each block in them.
+
+        """
+        db = self.by_dbs[by]
+        n = len(db)
+        if n == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            bounds = np.zeros(1, dtype=np.int64)
+            return {'first': empty, 'A': empty, 'B': empty, 'X': empty,
+                    'A_bounds': bounds, 'B_bounds': bounds,
+                    'X_bounds': bounds}
+
+        on_codes = self.on_blocks[by].ngroup().values
+        on_across_codes = self.on_across_blocks[by].ngroup().values
+        n_on = on_codes.max() + 1
+        n_blocks = on_across_codes.max() + 1
+
+        # A: items sorted by (on, across), the on/across codes being
+        # ordered lexicographically, each 'on' level is also contiguous
+        on_across_order = np.argsort(on_across_codes, kind='mergesort')
+        A_bounds = cumulated_bounds(
+            np.bincount(on_across_codes, minlength=n_blocks))
+        first = on_across_order[A_bounds[:-1]]
+        block_on = on_codes[first]
+        on_bounds = cumulated_bounds(np.bincount(on_codes, minlength=n_on))
+        on_start = on_bounds[block_on]
+        on_stop = on_bounds[block_on + 1]
+
+        # X: same 'on' as A, but not in the block of A
+        X = on_across_order[concatenated_ranges(
+            np.column_stack((on_start, A_bounds[1:])).ravel(),
+            np.column_stack((A_bounds[:-1], on_stop)).ravel())]
+        X_sizes = (on_stop - on_start) - np.diff(A_bounds)
+        if len(self.across) > 1:
+            # remove X sharing the value of any of the 'across' columns
+            # with A
+            X_block = np.repeat(np.arange(n_blocks), X_sizes)
+            keep = np.ones(X.shape[0], dtype=bool)
+            for col in self.across:
+                codes = self.by_dbs[by][col].values
+                keep &= codes[X] != codes[first][X_block]
+            X = X[keep]
+            X_sizes = np.bincount(X_block[keep], minlength=n_blocks)
+
+        # B: different 'on' than A and same 'across'
+        if self.across == ['#across']:
+            # no across: B can be anything in the by block that doesn't
+            # have the same 'on' as A
+            starts = np.column_stack((np.zeros_like(on_stop), on_stop))
+            stops = np.column_stack((on_start, np.zeros_like(on_stop) + n))
+            B = on_across_order[concatenated_ranges(
+                starts.ravel(), stops.ravel())]
+            B_sizes = n - (on_stop - on_start)
+        else:
+            across_codes = self.across_blocks[by].ngroup().values
+            n_across = across_codes.max() + 1
+            across_on_order = np.lexsort((on_codes, across_codes))
+            across_bounds = cumulated_bounds(
+                np.bincount(across_codes, minlength=n_across))
+            block_across = across_codes[first]
+            # position of each block in the (across, on) order
+            position = np.empty(n, dtype=np.int64)
+            position[across_on_order] = np.arange(n)
+            block_start = np.minimum.reduceat(
+                position[on_across_order], A_bounds[:-1])
+            block_stop = block_start + np.diff(A_bounds)
+            starts = np.column_stack(
+                (across_bounds[block_across], block_stop))
+            stops = np.column_stack(
+                (block_start, across_bounds[block_across + 1]))
+            B = across_on_order[concatenated_ranges(
+                starts.ravel(), stops.ravel())]
+            B_sizes = (across_bounds[block_across + 1] -
+                       across_bounds[block_across]) - np.diff(A_bounds)
+
+        return {'first': first,
+                'A': on_across_order, 'A_bounds': A_bounds,
+                'B': B, 'B_bounds': cumulated_bounds(B_sizes),
+                'X': X, 'X_bounds': cumulated_bounds(X_sizes)}
+
+    def _compute_by_triplets(self, by, out, out_block_index, out_regs,
+                             db, by_values, display=None):
+        """Generate the triplets of all the on/across blocks of a 'by' level
+
+        Vectorized counterpart of the block by block loop in
+        _compute_triplets, used when _whole_by_generation_allowed is
+        True. The blocks are processed in batches of about
+        self.chunk_size triplets, blocks larger than this being streamed
+        with _stream_triplets. The output is the same as with
+        on_across_triplets (up to the order of triplets sharing the same
+        regressors).
+
+        """
+        blocks = self._block_structure(by)
+        index = db.index.values
+        labels = {name: index[blocks[name]].astype(np.int64)
+                  for name in ['A', 'B', 'X']}
+        columns = list(db.columns)
+        values = db.values
+
+        # A, B and X regressors for all the items of the 'by' level
+        item_regressors = {}
+        for stage in ['A', 'B', 'X']:
+            results = getattr(self.regressors, 'evaluate_' + stage)(
+                by_values, db, index)
+            item_regressors[stage] = [[np.asarray(reg) for reg in result]
+                                      for result in results]
+
+        # on/across filters and regressors are evaluated block by block,
+        # or 'on' level by 'on' level without 'across' since each block
+        # is then a single item
+        if self.across == ['#across']:
+            block_levels = self.on_blocks[by].group_codes[blocks['first']]
+        else:
+            block_levels = np.arange(len(blocks['first']))
+        levels, level_blocks = np.unique(block_levels, return_index=True)
+        level_regressors = {}
+        for level, block in zip(levels, level_blocks):
+            on_across_by_values = dict(
+                zip(columns, values[blocks['first'][block]]))
+            if self.filters.on_across_by_filter(on_across_by_values):
+                level_regressors[level] = [
+                    result for result in
+                    self.regressors.evaluate_on_across_by(
+                        on_across_by_values)]
+        kept = []
+        on_across_by_regressors = []
+        for block, level in enumerate(block_levels):
+            if level in level_regressors:
+                kept.append(block)
+                on_across_by_regressors.append(level_regressors[level])
+        if not kept:
+            return
+        kept = np.array(kept, dtype=np.int64)
+        sizes = {}
+        for name in ['A', 'B', 'X']:
+            sizes[name] = np.diff(blocks[name + '_bounds'])[kept]
+        n_triplets = sizes['A'] * sizes['B'] * sizes['X']
+
+        # split the kept blocks in batches of about chunk_size triplets,
+        # blocks larger than that being alone in their batch
+        for start, stop in batch_bounds(n_triplets, self.chunk_size):
+            batch = np.arange(start, stop)
+
+            if n_triplets[batch[0]] > self.chunk_size:
+                block = kept[batch[0]]
+                items = {}
+                for name in ['A', 'B', 'X']:
+                    bounds = blocks[name + '_bounds']
+                    items[name] = blocks[name][
+                        bounds[block]:bounds[block + 1]]
+                A, B, X = [index[items[name]].astype(self.types[by])
+                           for name in ['A', 'B', 'X']]
+                on_across_by_values = dict(
+                    zip(columns, values[blocks['first'][block]]))
+                self.regressors.set_on_across_by_regressors(
+                    on_across_by_values)
+                if self._pairs_from_items():
+                    self._add_items_pairs(A, B, X)
+                self.current_index += self._stream_triplets(
+                    by, A, B, X,
+                    {stage: [[reg[items[stage]] for reg in regs]
+                             for regs in item_regressors[stage]]
+                     for stage in ['A', 'B', 'X']},
+                    on_across_by_values, out, out_regs, out_block_index)
+                if self.verbose:
+                    display.update('block', 1)
+                    display.update('triplets', n_triplets[batch[0]])
+                    display.display()
+                continue
+            size = n_triplets[batch]
+            offsets = cumulated_bounds(size)
+            total = offsets[-1]
+
+            # decode the flat index of each triplet in its block
+            triplet_block = np.repeat(np.arange(len(batch)), size)
+            local = np.arange(total) - np.repeat(offsets[:-1], size)
+            positions = {}
+            for name in ['X', 'B', 'A']:
+                n_items = sizes[name][batch][triplet_block]
+                start = blocks[name + '_bounds'][kept[batch]][triplet_block]
+                if name == 'A':
+                    positions[name] = blocks[name][start + local]
+                else:
+                    positions[name] = blocks[name][start + local % n_items]
+                    local = local // n_items
+
+            # sort triplets by block, then by B and X regressors
+            keys = [reg[positions[stage]] for stage in ['B', 'X']
+                    for regs in item_regressors[stage] for reg in regs]
+            thr_sort_permut, block_index = sort_and_threshold_blocks(
+                triplet_block, keys, offsets, threshold=self.threshold,
+                random_state=self.random_state)
+
+            triplets = np.column_stack(
+                [index[positions[name][thr_sort_permut]]
+                 for name in ['A', 'B', 'X']]).astype(self.types[by])
+            triplet_block = triplet_block[thr_sort_permut]
+
+            regressors = {}
+            for names, regs in zip(self.regressors.by_names,
+                                   self.regressors.by_regressors):
+                for name, reg in zip(names, regs):
+                    regressors[name] = np.tile(
+                        np.array(reg), (triplets.shape[0], 1))
+            for j, names in enumerate(self.regressors.on_across_by_names):
+                for k, name in enumerate(names):
+                    reg = np.array([on_across_by_regressors[b][j][k]
+                                    for b in batch])
+                    regressors[name] = np.reshape(
+                        reg[triplet_block], (-1, 1))
+            for stage in ['A', 'B', 'X']:
+                for names, regs in zip(
+                        getattr(self.regressors, stage + '_names'),
+                        item_regressors[stage]):
+                    for name, reg in zip(names, regs):
+                        regressors[name] = reg[
+                            positions[stage][thr_sort_permut]]
+
+            out.write(triplets)
+            out_regs.write(regressors, indexed=True)
+            out_block_index.write(block_index[:, None])
+            self.current_index += triplets.shape[0]
+            if not self._pairs_from_items():
+                self._add_triplets_pairs(triplets)
+            elif total > 0:
+                # AX and BX pairs of the non-empty blocks of the batch
+                non_empty = batch[size > 0]
+                for name in ['A', 'B']:
+                    first, second = product_pairs(
+                        labels[name], blocks[name + '_bounds'],
+                        labels['X'], blocks['X_bounds'], kept[non_empty])
+                    self._add_pairs(pair_codes(
+                        first, second, self._pairs_base,
+                        self.symmetric_pairs))
+
+            if self.verbose:
+                display.update('block', len(batch))
+                display.update('triplets', total)
+                display.display()
+
+    def _write_feat_dbs(self, output, bys):
+        """Store the items of each 'by' level for ulterior decoding"""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', tables.NaturalNameWarning)
+            store = pd.HDFStore(output)
+            try:
+                # use append to make use of table format, which is
+                # better at handling strings without much space
+                # (fixed-size format)
+                for by in bys:
+                    store.append('/feat_dbs/' + str(by), self.feat_dbs[by],
+                                 expectedrows=len(self.feat_dbs[by]))
+            finally:
+                store.close()
 
     # number of triplets when triplets with same on, across, by are
     # counted as one
@@ -1069,6 +2622,333 @@ class Task(object):
         self.stats['nb_levels'] = sum(
             stats['nb_levels'] for stats in self.by_stats.values())
 
+    # attributes of a prepared task saved as such by Task.save, the
+    # databases and blocks being saved as numpy arrays
+    _saved_attributes = ['database', 'verbose', 'on', 'across', 'by', 'spec',
+                         'aux_files', 'db_hierarchy', 'types', 'stats',
+                         'by_stats', 'n_blocks']
+
+    def save(self, path):
+        """Save the prepared task in a directory
+
+        The task can then be loaded back with Task.load, without loading
+        the item file and preparing the database again. The databases are
+        encoded as numpy arrays (see database.encode_frame) and stored in
+        .npy files along with the positions of the items, the codes of
+        their 'on' and 'across' columns and the blocks of each 'by' level,
+        and with the tables of the coded columns. The other attributes
+        (statistics, types, task specification...) are pickled in a
+        'task.pickle' file.
+
+        The task must be saved before generating its triplets.
+
+        Parameters
+        ----------
+
+        path : directory
+            The directory to create.
+
+        """
+        if os.path.exists(path):
+            raise ValueError(
+                'The output directory already exists: {}'.format(path))
+        os.makedirs(path)
+
+        def save_arrays(prefix, arrays):
+            for name, array in arrays.iteritems():
+                np.save(os.path.join(path, '{}_{}.npy'.format(prefix, name)),
+                        array)
+
+        def concatenate(arrays):
+            return np.concatenate([np.zeros(0, dtype=np.int64)] + arrays)
+
+        bys = list(self.by_dbs)
+        feat_dbs = [self.feat_dbs[by] for by in bys]
+        coded_columns = list(self.code_tables)
+        if self.db is None:
+            # loaded task: the database is still encoded
+            db_arrays = self._db_arrays
+        else:
+            db_arrays = database.encode_frame(self.db)
+        save_arrays('db', db_arrays)
+        save_arrays('feat', database.encode_frame(
+            pd.concat(feat_dbs, ignore_index=True) if feat_dbs
+            else pd.DataFrame()))
+        save_arrays('by', {
+            'rows': concatenate([self.by_rows[by] for by in bys]),
+            'index': concatenate([self.by_dbs[by].index.values
+                                  for by in bys]),
+            'bounds': cumulated_bounds([len(self.by_dbs[by]) for by in bys]),
+            'feat_bounds': cumulated_bounds([len(db) for db in feat_dbs]),
+            'on': concatenate([self.on_blocks[by].group_codes
+                               for by in bys]),
+            'across': concatenate([self.across_blocks[by].group_codes
+                                   for by in bys]),
+            'on_across': concatenate([self.on_across_blocks[by].group_codes
+                                      for by in bys])})
+        save_arrays('codes', {
+            str(i): np.concatenate(
+                [np.zeros(0, dtype=fit_integer_type(
+                    len(self.code_tables[col]), is_signed=True))] +
+                [self.by_dbs[by][col].values for by in bys])
+            for i, col in enumerate(self.on + self.across)})
+        save_arrays('table', {
+            str(i): database.encode_table(self.code_tables[col])
+            for i, col in enumerate(coded_columns)})
+
+        attributes = {attr: getattr(self, attr)
+                      for attr in self._saved_attributes}
+        attributes['bys'] = bys
+        attributes['coded_columns'] = coded_columns
+        with open(os.path.join(path, 'task.pickle'), 'wb') as fid:
+            pickle.dump(attributes, fid, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """Load a task saved by Task.save
+
+        The arrays are memory-mapped and the blocks are set up from the
+        saved codes, so that nothing is decoded when loading: the
+        databases of the 'by' levels are only decoded when first
+        accessed, task.db being None. The filters and regressors are set
+        up again from the task specification.
+
+        Parameters
+        ----------
+
+        path : directory
+            The directory written by Task.save.
+
+        Returns
+        -------
+
+        task : Task
+            The prepared task, as it was when saved.
+
+        """
+        with open(os.path.join(path, 'task.pickle'), 'rb') as fid:
+            attributes = pickle.load(fid)
+        bys = attributes.pop('bys')
+        coded_columns = attributes.pop('coded_columns')
+        task = cls.__new__(cls)
+        for attr, value in attributes.iteritems():
+            setattr(task, attr, value)
+
+        def load_arrays(prefix):
+            return {name[len(prefix) + 1:-len('.npy')]:
+                    np.load(os.path.join(path, name), mmap_mode='r')
+                    for name in os.listdir(path)
+                    if name.startswith(prefix + '_') and
+                    name.endswith('.npy')}
+
+        db_arrays = load_arrays('db')
+        feat_arrays = load_arrays('feat')
+        arrays = load_arrays('by')
+        codes = load_arrays('codes')
+        tables = load_arrays('table')
+        task.code_tables = {
+            col: database.decode_table(tables[str(i)])
+            for i, col in enumerate(coded_columns)}
+        task.db = None
+        task._db_arrays = db_arrays
+
+        # the regressors only read the columns of the database whose
+        # values they index
+        def decode_column(col):
+            return database.decode_frame(db_arrays, columns=[col])[col]
+
+        task.regressors = regressor_manager.RegressorManager(
+            database.LazyDict({
+                col: functools.partial(decode_column, col)
+                for col in db_arrays['columns'].tolist()}),
+            task.db_hierarchy, task.on, task.across, task.by,
+            task.spec['regressors'], task.code_tables)
+        task.filters = filter_manager.FilterManager(
+            task.db_hierarchy, task.on, task.across, task.by,
+            task.spec['filters'], task.code_tables)
+        def decode_by_db(start, stop):
+            by_db = database.decode_frame(db_arrays,
+                                          arrays['rows'][start:stop])
+            by_db.index = pd.Index(arrays['index'][start:stop])
+            return by_db
+
+        def decode_feat_db(start, stop):
+            return database.decode_frame(
+                feat_arrays, slice(start, stop)).reset_index(drop=True)
+
+        task.by_rows = {}
+        task.on_blocks = {}
+        task.across_blocks = {}
+        task.on_across_blocks = {}
+        task.antiacross_blocks = {}
+        bounds, feat_bounds = arrays['bounds'], arrays['feat_bounds']
+        for i, by in enumerate(bys):
+            start, stop = bounds[i], bounds[i + 1]
+            task.by_rows[by] = arrays['rows'][start:stop]
+            task._init_blocks(
+                by, pd.Index(arrays['index'][start:stop]),
+                {col: codes[str(j)][start:stop]
+                 for j, col in enumerate(task.on + task.across)},
+                {name: arrays[name][start:stop]
+                 for name in ['on', 'across', 'on_across']})
+        task.by_dbs = database.LazyDict({
+            by: functools.partial(decode_by_db, bounds[i], bounds[i + 1])
+            for i, by in enumerate(bys)})
+        task.feat_dbs = database.LazyDict({
+            by: functools.partial(decode_feat_db, feat_bounds[i],
+                                  feat_bounds[i + 1])
+            for i, by in enumerate(bys)})
+        return task
+
+    def estimate_costs(self, features=None, feature_group='features'):
+        """Estimate the size of the task and the cost of the next steps of
+        the ABX pipeline, without generating anything
+
+        The numbers of unique AX and BX pairs, which are the distances to
+        compute, are obtained from the sizes of the on, across and
+        on/across blocks (see _pairs_weight). They are exact without
+        filters and upper bounds otherwise. The sizes of the files are
+        those of their main datasets before compression.
+
+        Parameters
+        ----------
+
+        features : h5features file, optional
+            if specified, the number of frame cells is also estimated: the
+            sum over the unique pairs of the product of the numbers of
+            frames of their items, to which the cost of DTW distances is
+            proportional.
+
+        feature_group : str, optional
+            the group to read in the features file
+
+        Returns
+        -------
+
+        costs : dict
+            'nb_triplets', 'nb_unique_pairs', 'nb_frame_cells' (only with
+            features), 'task_bytes', 'distance_bytes' and 'score_bytes',
+            'approximate' being True if these are upper bounds.
+
+        """
+        if features is not None:
+            import ABXpy.distances.distances as distances
+            times = distances.read_feature_times(features, feature_group)
+
+        n_pairs = 0
+        n_cells = 0
+        for by, db in self.by_dbs.iteritems():
+            n_pairs += self._pairs_weight(by, np.ones(len(db)))
+            if features is not None:
+                frames = distances.item_frames(
+                    self.feat_dbs[by].loc[db.index], times)
+                n_cells += self._pairs_weight(by, frames)
+
+        n_triplets = self.stats['nb_triplets']
+        n_blocks = self.stats['nb_blocks']
+        n_regressors = len(self.regressors.get_regressor_info()[0])
+        costs = {
+            'approximate': self.stats['approximate'],
+            'nb_triplets': n_triplets,
+            'nb_unique_pairs': int(n_pairs),
+            # triplets, their regressors (at most 8 bytes each), the
+            # block index and the pairs
+            'task_bytes': int(
+                n_triplets * (
+                    3 * np.dtype(fit_integer_type(n_triplets)).itemsize +
+                    8 * n_regressors) +
+                n_blocks * np.dtype(fit_integer_type(n_blocks)).itemsize +
+                8 * n_pairs),
+            # one float64 distance per pair and one int8 score per triplet
+            'distance_bytes': int(8 * n_pairs),
+            'score_bytes': n_triplets}
+        if features is not None:
+            costs['nb_frame_cells'] = int(n_cells)
+        return costs
+
+    def _pairs_weight(self, by, weights):
+        """Total weight of the unique AX and BX pairs of a 'by' level
+
+        The weight of a pair is the product of the weights of its items,
+        given for the items of by_dbs[by] in order, so that this is the
+        number of unique pairs with unit weights. An AX pair belongs to
+        the block of its A, and a BX pair to the block with the 'on' of its
+        X and the 'across' of its B, so that the pairs are counted from
+        the total weights of the on, across and on/across blocks, only the
+        blocks with triplets being considered. The A, B, X and ABX filters
+        are ignored.
+
+        """
+        block_sizes = self.by_stats[by]['block_sizes']
+        on_blocks = self.on_blocks[by]
+        on_weights = np.bincount(on_blocks.group_codes, weights,
+                                 minlength=len(on_blocks))
+
+        if self.across == ['#across']:
+            # each item is a block, whose X are the other items of its
+            # 'on' level and whose B are the items of the other 'on' levels
+            on_keys = on_blocks.keys()
+            kept = np.array(
+                [block_sizes.get((on_keys[on], across), 0) > 0
+                 for on, across in zip(
+                     on_blocks.group_codes,
+                     self._column_values(by, '#across').values)],
+                dtype=bool)
+            AX = np.sum(kept * weights *
+                        (on_weights[on_blocks.group_codes] - weights))
+            # the X of an 'on' level are all its items, except if a
+            # single one of them is an A
+            n_kept = np.bincount(on_blocks.group_codes, kept,
+                                 minlength=len(on_blocks))
+            kept_weights = np.bincount(on_blocks.group_codes, kept * weights,
+                                       minlength=len(on_blocks))
+            X_weights = np.where(
+                n_kept > 1, on_weights,
+                np.where(n_kept == 1, on_weights - kept_weights, 0))
+            BX = np.sum(X_weights * (np.sum(weights) - on_weights))
+            return AX + BX
+
+        blocks = self.on_across_blocks[by]
+        across_blocks = self.across_blocks[by]
+        first = blocks.order[blocks.bounds[:-1]]
+        block_on = on_blocks.group_codes[first]
+        block_across = across_blocks.group_codes[first]
+        kept = np.array([block_sizes.get(key, 0) > 0 for key in blocks.keys()],
+                        dtype=bool)
+        A_weights = np.bincount(blocks.group_codes, weights,
+                                minlength=len(blocks))
+        B_weights = np.bincount(across_blocks.group_codes, weights,
+                                minlength=len(across_blocks))[block_across]
+        B_weights = B_weights - A_weights
+        if len(self.across) > 1:
+            X_weights = self.antiacross_blocks[by].group_counts(
+                across_blocks.keys(), on_blocks,
+                weights)[block_across, block_on]
+        else:
+            X_weights = on_weights[block_on] - A_weights
+        return np.sum(kept * (A_weights + B_weights) * X_weights)
+
+    def print_estimate(self, features=None, feature_group='features',
+                       filename=None):
+        """Write the costs estimated by estimate_costs"""
+        costs = self.estimate_costs(features, feature_group)
+        lines = ['nb_triplets: %d' % costs['nb_triplets'],
+                 'nb_unique_pairs: %d' % costs['nb_unique_pairs']]
+        if 'nb_frame_cells' in costs:
+            lines.append('nb_frame_cells: %d' % costs['nb_frame_cells'])
+        for ext in ['task', 'distance', 'score']:
+            lines.append('%s_size: %.1f Mo' % (
+                ext, costs[ext + '_bytes'] / 1e6))
+        if costs['approximate']:
+            lines.append('(upper bounds, the filters are not taken into '
+                         'account)')
+        text = '\n'.join(lines) + '\n'
+        if filename is None:
+            sys.stdout.write(text)
+        else:
+            with open(filename, 'w') as h:
+                h.write(text)
+
     def print_stats(self, filename=None, summarized=True):
         if filename is None:
             self.print_stats_to_stream(sys.stdout, summarized)
@@ -1144,7 +3024,7 @@ class Task(object):
                 regressors[name] = reg[iA]
                 if self.filters.ABX:
                     regressors[name] = regressors[name][ABX_filter_ind]
-                    regressors[name] = regressors[name][thr_sort_permut]
+                regressors[name] = regressors[name][thr_sort_permut]
 
         for names, regs in zip(self.regressors.B_names,
                                self.regressors.B_regressors):
@@ -1183,8 +3063,306 @@ def on_across_from_key(key):
     return on, across
 
 
-def sort_and_threshold(permut, new_index, ind_type,
-                       threshold=None, count_only=False):
+def on_across_key(on, across):
+    """Key of an on/across block, inverse of on_across_from_key"""
+    if isinstance(across, tuple):
+        return (on,) + across
+    return (on, across)
+
+
+def cumulated_bounds(sizes):
+    """Boundaries [0, s0, s0+s1, ...] of consecutive segments of the
+    specified sizes"""
+    return np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+
+
+def concatenated_ranges(starts, stops):
+    """Vectorized equivalent of np.concatenate([np.arange(start, stop) for
+    start, stop in zip(starts, stops)])"""
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(stops, dtype=np.int64) - starts
+    offsets = np.cumsum(lengths) - lengths
+    return (np.repeat(starts - offsets, lengths) +
+            np.arange(np.sum(lengths), dtype=np.int64))
+
+
+def batch_bounds(n_triplets, chunk_size, isolate_oversized=True):
+    """Boundaries of batches of consecutive blocks of about chunk_size
+    triplets
+
+    n_triplets is the number of triplets of each block. If
+    isolate_oversized is True, the blocks with more than chunk_size
+    triplets are alone in their batch. Returns the list of the (start,
+    stop) positions of the blocks of each batch.
+
+    """
+    n_triplets = np.asarray(n_triplets, dtype=np.int64)
+    batch_id = (np.cumsum(n_triplets) - n_triplets) // chunk_size
+    if isolate_oversized:
+        oversized = np.flatnonzero(n_triplets > chunk_size)
+    else:
+        oversized = np.zeros(0, dtype=np.int64)
+    batch_ends = np.union1d(
+        np.concatenate((np.flatnonzero(np.diff(batch_id)) + 1,
+                        oversized, oversized + 1)),
+        [len(n_triplets)])
+    batch_ends = batch_ends[batch_ends > 0]
+    return zip(np.concatenate(([0], batch_ends[:-1])), batch_ends)
+
+
+def balanced_bounds(costs, n):
+    """Boundaries of at most n contiguous segments of similar total cost
+
+    Parameters
+    ----------
+
+    costs : list
+        the cost of each element
+
+    n : int
+        the number of segments
+
+    Returns
+    -------
+
+    bounds : list
+        increasing positions, starting at 0 and ending at len(costs),
+        segment i is costs[bounds[i]:bounds[i+1]]
+
+    """
+    # each element costs at least 1 so that empty elements are spread too
+    cumulated = np.cumsum(np.asarray(costs, dtype=np.float64) + 1)
+    targets = cumulated[-1] * np.arange(1, n) / float(n)
+    inner = np.searchsorted(cumulated, targets, side='right')
+    return sorted(set([0, len(costs)] + [int(i) for i in inner]))
+
+
+# hack, external function for visibility reasons: the task is inherited
+# from the parent process when the pool is forked
+_shard_task = None
+
+
+def _shard_worker(args):
+    shard, bys, seeds = args
+    task = _shard_task
+    # progress is only displayed by the parent process
+    task.verbose = False
+    # without a seed, make sure the workers don't share the random
+    # state of the parent process
+    if all(seed is None for seed in seeds):
+        np.random.seed()
+    non_empty_bys = task._generate_task_file(shard, bys, seeds)
+    # the block sizes collected with lazy statistics are sent back to
+    # the parent process
+    block_sizes = {}
+    if task._collect_block_sizes:
+        block_sizes = {by: task.by_stats[by]['block_sizes'] for by in bys}
+    return non_empty_bys, block_sizes
+
+
+def read_triplets(fh, n_by, chunk_size=10 ** 6, regressors=False):
+    """Read the triplets of a 'by' level of a task file by chunks
+
+    Works with both the explicit and the virtual layouts (see
+    Task.generate_triplets), the triplets being read in the same order
+    as their scores are stored.
+
+    Parameters
+    ----------
+
+    fh : h5py.File
+        The opened task file
+
+    n_by : int
+        The position of the 'by' level in fh['bys']
+
+    chunk_size : int, optional
+        The maximal number of triplets in a chunk
+
+    regressors : bool, optional
+        If True, the indexed regressors of the triplets are also read,
+        their columns being the 'non_fused_datasets' of
+        regressors_group(fh, by).
+
+    Yields
+    ------
+
+    triplets : numpy.Array
+        A n x 3 array of A, B, X items, or a (triplets, regressors) tuple
+        if regressors is True
+
+    """
+    if fh.attrs.get('triplets_layout', 'explicit') != 'virtual':
+        start, stop = fh['triplets/by_index'][n_by]
+        if regressors:
+            codes = regressors_group(fh, fh['bys'][n_by])['indexed_data']
+        for i in range(start, stop, chunk_size):
+            j = min(i + chunk_size, stop)
+            triplets = fh['triplets/data'][i:j]
+            if regressors:
+                yield triplets, codes[i - start:j - start]
+            else:
+                yield triplets
+        return
+
+    block_start, block_stop = fh['virtual/by_index'][n_by]
+    blocks = fh['virtual/blocks'][block_start:block_stop]
+    item_start = blocks[0, 0]
+    item_stop = blocks[-1, 0] + np.sum(blocks[-1, 1:])
+    items = fh['virtual/items'][item_start:item_stop, 0]
+    if regressors:
+        item_codes = fh['virtual/item_codes'][item_start:item_stop]
+        block_codes = fh['virtual/block_codes'][block_start:block_stop]
+    first = blocks[:, 0] - item_start
+    n_A, n_B, n_X = blocks[:, 1], blocks[:, 2], blocks[:, 3]
+    offsets = cumulated_bounds(n_A * n_B * n_X)
+    for i in range(0, offsets[-1], chunk_size):
+        flat = np.arange(i, min(i + chunk_size, offsets[-1]))
+        block = np.searchsorted(offsets, flat, side='right') - 1
+        # decode the index of each triplet in its block, X varying fastest
+        local = flat - offsets[block]
+        iX = first[block] + n_A[block] + n_B[block] + local % n_X[block]
+        local = local // n_X[block]
+        iB = first[block] + n_A[block] + local % n_B[block]
+        iA = first[block] + local // n_B[block]
+        triplets = np.column_stack((items[iA], items[iB], items[iX]))
+        if regressors:
+            yield triplets, (block_codes[block] + item_codes[iA] +
+                             item_codes[iB] + item_codes[iX])
+        else:
+            yield triplets
+
+
+def regressors_group(fh, by):
+    """The group describing the regressors of a 'by' level in a task file"""
+    if fh.attrs.get('triplets_layout', 'explicit') == 'virtual':
+        return fh['virtual/regressors']
+    return fh['regressors'][by]
+
+
+def named_regressors(names, regressors):
+    """Map regressor names to values, from the nested lists of names and
+    values of the regressor manager"""
+    return {name: reg for name_list, regs in zip(names, regressors)
+            for name, reg in zip(name_list, regs)}
+
+
+def regressors_groups(regressors, n):
+    """Group items sharing the same regressors values
+
+    Parameters
+    ----------
+
+    regressors : list
+        the regressors of the items, in the format of
+        RegressorManager.A_regressors
+
+    n : int
+        the number of items
+
+    Returns
+    -------
+
+    order, bounds : numpy.Array
+        items order[bounds[i]:bounds[i+1]] share the same regressors
+        values, groups being in increasing lexicographic order of these
+
+    """
+    keys = [np.asarray(reg) for regs in regressors for reg in regs]
+    if n == 0 or not keys:
+        return np.arange(n), cumulated_bounds([n])
+    order = np.lexsort(keys[::-1])
+    change = np.zeros(n - 1, dtype=bool)
+    for key in keys:
+        sorted_key = key[order]
+        change |= sorted_key[1:] != sorted_key[:-1]
+    return order, np.concatenate(([0], np.flatnonzero(change) + 1, [n]))
+
+
+def pair_codes(first, second, base, symmetric=False):
+    """Integer keys of the pairs (first, second) of items of a 'by' level
+
+    The key of a pair is first + base * second, base being larger than any
+    item index. With symmetric set to True, the pairs (a, b) and (b, a)
+    share the key min(a, b) + base * max(a, b).
+
+    """
+    if symmetric:
+        first, second = (np.minimum(first, second),
+                         np.maximum(first, second))
+    return first + base * second
+
+
+def product_pairs(left, left_bounds, right, right_bounds, segments):
+    """Pairs in the cartesian products of some segments of two arrays
+
+    Segment s of left (resp. right) is left[left_bounds[s]:left_bounds[s +
+    1]]. The pairs of all the specified segments are concatenated and
+    returned as two arrays of left and right items.
+
+    """
+    left_start = left_bounds[segments]
+    n_left = left_bounds[segments + 1] - left_start
+    right_start = right_bounds[segments]
+    n_right = right_bounds[segments + 1] - right_start
+    sizes = n_left * n_right
+    offsets = cumulated_bounds(sizes)
+    segment = np.repeat(np.arange(len(segments)), sizes)
+    local = np.arange(offsets[-1]) - offsets[:-1][segment]
+    n_right = n_right[segment]
+    return (left[left_start[segment] + local // n_right],
+            right[right_start[segment] + local % n_right])
+
+
+def merge_unique(arrays):
+    """Sorted unique values of a list of arrays"""
+    if not arrays:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(arrays))
+
+
+def sample_cell(size, threshold, random_state=None, chunk_size=10 ** 6):
+    """Sorted indices of threshold triplets of a cell of size triplets
+
+    Each triplet of the cell gets a random key drawn from random_state
+    (see sampler.check_random_state), and the threshold triplets with
+    the lowest keys are kept, as in sort_and_threshold. The keys are
+    drawn by chunks of chunk_size, so that the memory used does not
+    depend on the size of the cell.
+
+    """
+    random_state = sampler.check_random_state(random_state)
+    keys = np.empty(0)
+    indices = np.empty(0, dtype=np.int64)
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        keys = np.concatenate((keys, random_state.rand(stop - start)))
+        indices = np.concatenate((indices, np.arange(start, stop)))
+        if keys.shape[0] > threshold:
+            lowest = np.argpartition(keys, threshold - 1)[:threshold]
+            keys, indices = keys[lowest], indices[lowest]
+    return np.sort(indices)
+
+
+def sort_and_threshold(permut, new_index, threshold=None, count_only=False,
+                       random_state=None):
+    """Sort triplets by regressor cell and sample the cells larger than
+    threshold
+
+    permut sorts the triplets by their cell, new_index. The triplets of
+    the cells with more than threshold triplets are replaced by
+    threshold of them, drawn uniformly without replacement and kept in
+    sorted order. All the cells are sampled at once: each triplet of
+    these cells gets a random key, and the threshold triplets with the
+    lowest keys of each cell are kept. The keys are drawn from
+    random_state (see sampler.check_random_state) in the order of the
+    sorted triplets, so that the sample of each cell is the same as
+    with sample_cell.
+
+    Returns the sampled permutation and the boundaries of the cells in
+    the sorted triplets, before thresholding.
+
+    """
     sorted_index = new_index[permut]
     flag = np.concatenate(
         ([True], sorted_index[1:] != sorted_index[:-1], [True]))
@@ -1196,64 +3374,59 @@ def sort_and_threshold(permut, new_index, ind_type,
         return new_index.shape[0] - np.sum(counts[sampled]) + \
             threshold * np.sum(sampled)
 
-    new_permut = []
-    i = 0
-    for c in counts:
-        if threshold and c > threshold:
-            sampled_idx = sampler.sample_without_replacement(
-                threshold, c, dtype=ind_type)
-            sampled_idx += i
-            new_permut.append(permut[sampled_idx])
-        else:
-            new_permut.append(permut[i:i+c])
-        i += c
-    return np.concatenate(new_permut), unique_idx
-
-
-def sort_pairs(abx_file, by, memory=1000, tmpdir=None):
-    """Sort pairs in a ABX task file
-
-    abx_file: the hdf5 file generated by ABX task
-
-    by:
-
-    memory: available RAM in Mo
-
-    tmpdir: dircetory to write temporary files
+    sampled = counts > threshold if threshold else np.zeros(0, dtype=bool)
+    if not np.any(sampled):
+        return permut, unique_idx
+
+    # rank of the triplets of the sampled cells in a random order of
+    # their cell
+    in_sampled = np.repeat(sampled, counts)
+    candidates = np.flatnonzero(in_sampled)
+    cell = np.repeat(np.arange(np.sum(sampled)), counts[sampled])
+    keys = sampler.check_random_state(random_state).rand(candidates.shape[0])
+    order = np.lexsort((keys, cell))
+    rank = np.arange(candidates.shape[0]) - np.repeat(
+        cumulated_bounds(counts[sampled])[:-1], counts[sampled])
+    kept = np.sort(np.concatenate((np.flatnonzero(~in_sampled),
+                                   candidates[order[rank < threshold]])))
+    return permut[kept], unique_idx
+
+
+def sort_and_threshold_blocks(triplet_block, keys, offsets, threshold=None,
+                              random_state=None):
+    """Sort the triplets of consecutive blocks by block and regressor
+    cell, and sample the cells larger than threshold
+
+    triplet_block is the block of each triplet, offsets the len(blocks)
+    + 1 boundaries of the blocks in the triplets and keys the regressors
+    sorting the triplets of a block, the cells being the triplets of a
+    block sharing the same keys (see sort_and_threshold).
+
+    Returns the sampled permutation and the boundaries of the cells of
+    each block, relative to the block, as written in the block index.
 
     """
-    # estimate of the amount of data to be sorted
-    with h5py.File(abx_file) as fh:
-        n = fh['/pairs/' + str(by)].shape[0]
-        i = fh['/pairs/' + str(by)].dtype.itemsize
-
-    # harmonize units in Ko
-    memory = 1000 * memory
-    amount = n * i / 1000.
-
-    # be conservative: aim at using no more than 3/4 the available
-    # memory if enough memory take one chunk (this will do an
-    # unnecessary full write and read of the file... could be
-    # optimized easily, would it be beneficial to have large
-    # o_buffer_size as well?)
-    if amount <= 0.75 * memory:
-        buffer_size = amount
-
-    # else take around 30 chunks if possible (this seems efficient
-    # given the current implem, using a larger number of chunks
-    # efficiently might be possible if the reading chunks part of the
-    # sort was cythonized ?)
-    elif amount / 30. <= 0.75 * memory:
-        buffer_size = amount / 30.
-
-    # else take minimum number of chunks possible given the
-    # available RAM
-    else:
-        buffer_size = 0.75 * memory
-
-    # finally sort the pairs in place
-    handler = h5_handler.H5Handler(abx_file, '/pairs/', str(by))
-    handler.sort(buffer_size=buffer_size, tmpdir=tmpdir)
+    total = offsets[-1]
+    if total == 0:
+        return (np.empty(shape=0, dtype=np.int64),
+                np.zeros(len(offsets) - 1, dtype=np.int64))
+    permut = np.lexsort(tuple(keys[::-1]) + (triplet_block,))
+    cell_change = np.zeros(total - 1, dtype=bool)
+    for key in keys + [triplet_block]:
+        sorted_key = key[permut]
+        cell_change |= sorted_key[1:] != sorted_key[:-1]
+    cells = np.empty(total, dtype=np.int64)
+    cells[permut] = np.concatenate(([0], np.cumsum(cell_change)))
+
+    thr_sort_permut, unique_idx = sort_and_threshold(
+        permut, cells, threshold=threshold, random_state=random_state)
+    # regressor cells boundaries relative to each block
+    lo = np.searchsorted(unique_idx, offsets[:-1])
+    hi = np.searchsorted(unique_idx, offsets[1:])
+    block_index = (
+        unique_idx[concatenated_ranges(lo, hi + 1)] -
+        np.repeat(offsets[:-1], hi + 1 - lo))
+    return thr_sort_permut, block_index
 
 
 def parse_arguments():
@@ -1293,6 +3466,22 @@ Example call:
         help='add this flag if you only want some statistics '
         'about the specified task')
 
+    parser.add_argument(
+        '--estimate', action='store_true',
+        help='only estimate the numbers of triplets, unique pairs and '
+        'frame cells (see --features) and the sizes of the task, distance '
+        'and score files, without generating anything')
+
+    parser.add_argument(
+        '--features', default=None,
+        help='h5features file used by --estimate to count the frames of '
+        'the items, the DTW cost being proportional to the sum over the '
+        'pairs of the products of their numbers of frames')
+
+    parser.add_argument(
+        '--features-group', default='features',
+        help='group to read in the features file, default is %(default)s')
+
     parser.add_argument(
         '--tempdir', default=None,
         help='directory where temporary files will be stored')
@@ -1301,6 +3490,55 @@ Example call:
         '--seed', default=None, type=int,
         help='seed used to initialize the pseudo-random number generator')
 
+    parser.add_argument(
+        '-j', '--njobs', default=1, type=int,
+        help='number of processes used to generate the task, '
+        'default is %(default)s')
+
+    parser.add_argument(
+        '--symmetric-pairs', action='store_true',
+        help='store the pairs (a, b) and (b, a) only once, so that their '
+        'distance is computed only once (only valid for symmetric '
+        'distances)')
+
+    parser.add_argument(
+        '-m', '--memory', default=1000, type=float,
+        help='approximate amount of memory (in Mo) used to generate '
+        'the triplets, default is %(default)s')
+
+    parser.add_argument(
+        '--layout', default='explicit', choices=['explicit', 'virtual'],
+        help='storage of the triplets in the task file: explicit triplets '
+        'or, more compact, the items of each on/across block (only without '
+        'ABX filters and threshold), default is %(default)s')
+
+    parser.add_argument(
+        '--storage', default='lzf',
+        help='storage profile of the task file datasets: none, lzf, gzip '
+        'or gzip-<level>, default is %(default)s')
+
+    parser.add_argument(
+        '--cache-dir', default=None,
+        help='directory caching the generated task files, an identical '
+        'task being then reused instead of generated again')
+
+    parser.add_argument(
+        '--cache-size', default=None, type=float,
+        help='maximal size of the cache directory (in Mo), the least '
+        'recently used task files being removed first, default is '
+        'unlimited')
+
+    parser.add_argument(
+        '--lazy-stats', action='store_true',
+        help='with A, B, X or ABX filters, do not generate the triplets '
+        'twice to count them before writing them, their exact number is '
+        'then only known after the generation')
+
+    parser.add_argument(
+        '--sidecar', action='store_true',
+        help='cache the parsed item file in a binary file next to it '
+        '(<database>.npz), making the next loadings much faster')
+
     # I/O files
     g1 = parser.add_argument_group('I/O files')
     g1.add_argument(
@@ -1338,6 +3576,11 @@ Example call:
         help='threshold on the maximal size of a block of'
         ' triplets sharing the same regressors')
 
+    g2.add_argument(
+        '-n', '--n-samples', default=None, type=int,
+        help='number of triplets drawn uniformly from the whole task, '
+        'default is to generate all the triplets')
+
     return parser.parse_args()
 
 
@@ -1360,10 +3603,14 @@ def main():
         by=args.by,
         filters=args.filters,
         regressors=args.regressors,
-        verbose=args.verbose)
+        verbose=args.verbose,
+        sidecar=args.sidecar,
+        lazy_stats=args.lazy_stats)
 
     if args.stats_only:
         task.print_stats()
+    elif args.estimate:
+        task.print_estimate(args.features, args.features_group)
     else:
         if args.tempdir and not os.path.exists(args.tempdir):
             os.makedirs(args.tempdir)
@@ -1373,7 +3620,15 @@ def main():
             output=args.output,
             threshold=args.threshold,
             tmpdir=args.tempdir,
-            seed=args.seed)
+            seed=args.seed,
+            n_jobs=args.njobs,
+            memory=args.memory,
+            symmetric_pairs=args.symmetric_pairs,
+            layout=args.layout,
+            storage=args.storage,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            n_samples=args.n_samples)
 
 
 if __name__ == '__main__':
@@ -137,3 +137,39 @@ def test_frozen_analyze():
             # os.remove(analyzefilename)
         except:
             pass
+
+
+# the virtual layout of the task file must give the same results as the
+# explicit one
+def test_virtual_layout_analyze():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        for filters in [[], ["[attr != 1 for attr in c1_A]"]]:
+            results = {}
+            for layout in ['explicit', 'virtual']:
+                name = 'test_items/data_' + layout
+                task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2',
+                                       filters=filters)
+                task.generate_triplets(name + '.abx', layout=layout)
+                distances.compute_distances(
+                    feature_file, '/features/', name + '.abx',
+                    name + '.distance', dtw_cosine_distance,
+                    normalized=True, n_cpu=1)
+                score.score(name + '.abx', name + '.distance',
+                            name + '.score')
+                analyze.analyze(name + '.abx', name + '.score',
+                                name + '.csv')
+                with open(name + '.csv') as fid:
+                    results[layout] = fid.read()
+                for ext in ['.abx', '.distance', '.score', '.csv']:
+                    os.remove(name + ext)
+            assert results['explicit'] == results['virtual']
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
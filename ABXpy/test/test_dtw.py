@@ -1,6 +1,7 @@
 """Module for testing the dtw module"""
 
 import ABXpy.distances.metrics.dtw as dtw
+import ABXpy.distance
 import numpy as np
 
 
@@ -34,3 +35,16 @@ def test_normalized():
     dists_mid = np.concatenate([dists[:, :3], dists_mid, dists[:, 3:]], axis=1)
     res = dtw._dtw(5, 7, dists_mid, normalized=True)
     assert res == 1
+
+
+def test_distance_many():
+    x = np.random.randn(4, 3)
+    ys = [np.random.randn(n, 3) for n in [1, 5, 0, 3]]
+    for normalized in [True, False]:
+        res = ABXpy.distance.default_distance_many(x, ys, normalized)
+        for y, d in zip(ys, res):
+            assert np.allclose(
+                d, ABXpy.distance.default_distance(y, x, normalized))
+        res = ABXpy.distance.default_distance_many(
+            np.zeros((0, 3)), ys, normalized)
+        assert np.array_equal(res, [np.inf, np.inf, 0, np.inf])
@@ -11,6 +11,7 @@ if not(package_path in sys.path):
 import ABXpy.task
 import ABXpy.sampling as sampling
 import numpy as np
+import h5py
 import ABXpy.misc.items as items
 import random
 import warnings
@@ -106,6 +107,64 @@ def test_simple_uniformity():
                          n=random.randrange(50, N))
 
 
+def test_random_state():
+    """Samples drawn from a RandomState do not depend on numpy.random"""
+    samples = []
+    for i in range(2):
+        np.random.seed(i)
+        random_state = np.random.RandomState(0)
+        sampler = sampling.sampler.IncrementalSampler(
+            10 ** 6, 10 ** 4, random_state=random_state)
+        sample = [sampler.sample(10 ** 5) for j in range(10)]
+        sample.append(sampling.sampler.sample_without_replacement(
+            900, 1000, random_state=random_state))
+        samples.append(np.concatenate(sample))
+    assert np.array_equal(samples[0], samples[1])
+
+
+def test_task_random_state():
+    """Sampled tasks do not depend on numpy.random"""
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for i, name in enumerate(['data.abx', 'data2.abx']):
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3',
+                                   regressors=['c2_X'])
+            np.random.seed(i)
+            task.generate_triplets(name, threshold=2, seed=0)
+        with h5py.File('data.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            assert np.array_equal(f1['triplets/data'][...],
+                                  f2['triplets/data'][...])
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def test_hypergeometric():
+    """The sample sizes follow the hypergeometric distribution"""
+    for N, K, n in [(1000, 100, 300), (10 ** 12, 10 ** 6, 10 ** 10),
+                    (50, 45, 40)]:
+        draws = np.array([sampling.sampler.hypergeometric_sample(N, K, n)
+                          for i in range(2000)])
+        assert np.all(draws >= max(0, n + K - N))
+        assert np.all(draws <= min(n, K))
+        mean = n * K / float(N)
+        std = np.sqrt(mean * (N - K) / float(N) * (N - n) / float(N - 1))
+        # the standard error of the mean of 2000 draws is std / 45
+        assert abs(draws.mean() - mean) < 5 * std / 45 + 1e-9
+
+
+def test_knuth_uniformity():
+    """Each item is sampled with the same probability"""
+    counts = np.zeros(20)
+    for i in range(5000):
+        sample = sampling.sampler.Knuth_sampling(15, 20)
+        assert np.all(np.diff(sample) > 0)
+        counts[sample] += 1
+    assert chi2test(counts, 0.001)
+
+
 import matplotlib.pyplot as plt
 
 
@@ -128,4 +187,8 @@ def plot_uniformity(nb_resamples, N, K):
 # test_hard_no_replace()
 # test_simple_no_replace()
 # test_simple_completion()
+# test_random_state()
+# test_task_random_state()
+# test_hypergeometric()
+# test_knuth_uniformity()
 # plot_uniformity(10**4, 10**3, 10)
@@ -6,16 +6,23 @@ import os
 import shutil
 import sys
 
+import h5features
+import h5py
+import numpy as np
+import pandas
+
 package_path = os.path.dirname(os.path.dirname(
     os.path.dirname(os.path.realpath(__file__))))
 if not(package_path in sys.path):
     sys.path.append(package_path)
 import ABXpy.task
+import ABXpy.distance
 import ABXpy.distances.distances as distances
 import ABXpy.distances.metrics.cosine as cosine
 import ABXpy.distances.metrics.dtw as dtw
 import ABXpy.score as score
 import ABXpy.misc.items as items
+from ABXpy.distances.feature_store import FeatureStore
 
 
 def dtw_cosine_distance(x, y, normalized):
@@ -49,3 +56,233 @@ def test_score():
             # os.remove(scorefilename)
         except:
             pass
+
+
+# with a symmetric distance, storing symmetric pairs gives the same scores
+# with fewer distances
+def test_score_symmetric_pairs():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        scores = {}
+        n_pairs = {}
+        for symmetric in [False, True]:
+            name = 'test_items/data_{}'.format(symmetric)
+            task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+            task.generate_triplets(name + '.abx', symmetric_pairs=symmetric)
+            distances.compute_distances(
+                feature_file, '/features/', name + '.abx',
+                name + '.distance', dtw_cosine_distance,
+                normalized=True, n_cpu=1)
+            score.score(name + '.abx', name + '.distance', name + '.score')
+            with h5py.File(name + '.abx', 'r') as fh:
+                assert fh.attrs['symmetric_pairs'] == symmetric
+                n_pairs[symmetric] = fh['unique_pairs/data'].shape[0]
+            with h5py.File(name + '.score', 'r') as fh:
+                scores[symmetric] = fh['scores'][...]
+        assert n_pairs[True] < n_pairs[False]
+        assert np.array_equal(scores[True], scores[False])
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
+
+
+# computing the distances by batches of pairs sharing their X gives the
+# same distances as computing them pair by pair
+def test_distances_many():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        taskfilename = 'test_items/data.abx'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(taskfilename)
+
+        def one_by_one(x, y, normalized):
+            return ABXpy.distance.default_distance(x, y, normalized)
+
+        dis = {}
+        for name, distance in [('many', ABXpy.distance.default_distance),
+                               ('one', one_by_one)]:
+            distance_file = 'test_items/data_{}.distance'.format(name)
+            distances.compute_distances(
+                feature_file, '/features/', taskfilename,
+                distance_file, distance, normalized=True, n_cpu=1)
+            with h5py.File(distance_file, 'r') as fh:
+                dis[name] = fh['distances/data'][...]
+        assert np.allclose(dis['many'], dis['one'])
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
+
+
+# the distances computed by several processes sharing a feature store are
+# the same as with a single process
+def test_distances_feature_store():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        taskfilename = 'test_items/data.abx'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(taskfilename)
+
+        store = FeatureStore.convert(
+            [feature_file], ['/features/'], 'test_items/store')
+        times, features = h5features.read(feature_file, '/features/')
+        accessor = distances.Features_Accessor(times, features)
+        db = pandas.read_csv(item_file, sep=' ').rename(
+            columns={'#file': 'file'})
+        expected = accessor.get_features_from_raw(db)
+        for ix, f in store.get_features_from_raw(db).items():
+            assert np.array_equal(f, expected[ix])
+
+        dis = {}
+        for n_cpu in [1, 3]:
+            distance_file = 'test_items/data_{}.distance'.format(n_cpu)
+            distances.compute_distances(
+                feature_file, '/features/', taskfilename,
+                distance_file, dtw_cosine_distance,
+                normalized=True, n_cpu=n_cpu, tmpdir='test_items')
+            with h5py.File(distance_file, 'r') as fh:
+                dis[n_cpu] = fh['distances/data'][...]
+        assert np.allclose(dis[1], dis[3])
+        assert set(os.listdir('test_items')) == set(
+            ['data.item', 'data.features', 'data.abx', 'store',
+             'data_1.distance', 'data_3.distance'])
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
+
+
+# a single precision feature store can be given in place of the features
+def test_distances_from_store():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        store_dir = 'test_items/data.store'
+        taskfilename = 'test_items/data.abx'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(taskfilename)
+        store = FeatureStore.convert([feature_file], ['/features/'],
+                                     store_dir, dtype=np.float32)
+        assert store.features.dtype == np.float32
+        assert isinstance(store.features, np.memmap)
+        times = distances.read_feature_times(store_dir, None)
+        for f, t in h5features.read(feature_file, '/features/')[0].items():
+            assert np.array_equal(times[f], t)
+
+        dis = {}
+        for features, n_cpu in [(feature_file, 1), (store_dir, 1),
+                                (store_dir, 2)]:
+            distance_file = 'test_items/data_{}.distance'.format(len(dis))
+            distances.compute_distances(
+                features, '/features/', taskfilename,
+                distance_file, dtw_cosine_distance,
+                normalized=True, n_cpu=n_cpu)
+            with h5py.File(distance_file, 'r') as fh:
+                assert fh.attrs['done']
+                dis[len(dis)] = fh['distances/data'][...]
+        assert np.allclose(dis[0], dis[1], atol=1e-5)
+        assert np.array_equal(dis[1], dis[2])
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
+
+
+# the distances of a job written to a shard and merged in the distance
+# file are the same as when written directly, the job having blocks from
+# several 'by' levels
+def test_distance_shard():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        taskfilename = 'test_items/data.abx'
+        shard_file = 'test_items/shard.h5'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(taskfilename)
+
+        dis = []
+        for shard in [None, shard_file]:
+            distance_file = 'test_items/data_{}.distance'.format(len(dis))
+            job, = distances.create_distance_jobs(
+                taskfilename, distance_file, 1)
+            assert len(set(job['by'])) > 1
+            distances.run_distance_job(
+                job, distance_file, dtw_cosine_distance, [feature_file],
+                ['/features/'], False, 1, True, shard_file=shard)
+            if shard is not None:
+                distances.merge_distance_shard(job, shard, distance_file)
+            with h5py.File(distance_file, 'r') as fh:
+                dis.append(fh['distances/data'][...])
+        assert np.array_equal(dis[0], dis[1])
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
+
+
+# the blocks of the distance jobs cover each pair exactly once, the most
+# costly first
+def test_distance_jobs():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        taskfilename = 'test_items/data.abx'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(taskfilename)
+        with h5py.File(taskfilename, 'r') as fh:
+            n_pairs = {by: fh['unique_pairs'].attrs[by][2] -
+                       fh['unique_pairs'].attrs[by][1] for by in fh['bys']}
+        for n_cpu in [1, 3]:
+            distance_file = 'test_items/data_{}.distance'.format(n_cpu)
+            jobs = distances.create_distance_jobs(
+                taskfilename, distance_file, n_cpu, chunks_per_cpu=2)
+            if n_cpu == 1:
+                assert len(jobs) == 1
+            covered = {by: np.zeros(n, dtype=int)
+                       for by, n in n_pairs.items()}
+            for job in jobs:
+                for by, start, stop in zip(job['by'], job['start'],
+                                           job['stop']):
+                    covered[by][start:stop] += 1
+            for c in covered.values():
+                assert np.all(c == 1)
+        costs = {}
+        for by, sta, cost in distances.pair_costs(
+                taskfilename, n_pairs.keys(), 1000):
+            costs[by] = np.concatenate((costs.get(by, []), cost))
+        job_costs = [np.sum(costs[job['by'][0]][job['start'][0]:
+                                                job['stop'][0]])
+                     for job in jobs]
+        assert job_costs == sorted(job_costs, reverse=True)
+    finally:
+        try:
+            shutil.rmtree('test_items')
+        except:
+            pass
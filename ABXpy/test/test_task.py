@@ -3,6 +3,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
 import sys
 import warnings
 
@@ -11,6 +12,9 @@ package_path = os.path.dirname(os.path.dirname(
 if not(package_path in sys.path):
     sys.path.append(package_path)
 import ABXpy.task
+import ABXpy.database.database
+import ABXpy.h5tools.np2h5
+import ABXpy.distances.distances
 import h5py
 import numpy as np
 import ABXpy.misc.items as items
@@ -40,6 +44,13 @@ def get_triplets(hdf5file, by):
     return triplets[slice(*triplets_index)]
 
 
+# triplets of all the 'by' levels, tagged with their 'by' level since
+# their items are indexed in the 'by' level
+def get_all_triplets(hdf5file):
+    return set((by,) + tuple(triplet) for by in hdf5file['bys']
+               for triplet in get_triplets(hdf5file, by))
+
+
 def get_pairs(hdf5file, by):
     pairs_db = hdf5file['unique_pairs']
     pairs = pairs_db['data']
@@ -246,6 +257,680 @@ def test_filter_on_C():
             pass
 
 
+# testing the whole 'by' generation against the block by block one
+def test_whole_by_generation():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for across in ['c1', ['c1', 'c2'], None]:
+            task = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                   filters=["[attr != 1 for attr in c2]"])
+            task.generate_triplets()
+            f = h5py.File('data.abx', 'r')
+            for by in task.by_dbs:
+                expected = set()
+                for key, block in task.on_across_blocks[by].groups.items():
+                    on, across_key = ABXpy.task.on_across_from_key(key)
+                    triplets = task.on_across_triplets(
+                        by, on, across_key, block,
+                        dict(task.by_dbs[by].loc[block[0]]),
+                        with_regressors=False)
+                    expected.update(map(tuple, triplets))
+                triplets = get_triplets(f, str(by))
+                assert len(expected) == triplets.shape[0], error_triplets
+                assert expected == set(map(tuple, triplets)), error_triplets
+            f.close()
+            os.remove('data.abx')
+    finally:
+        for name in ['data.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# the closed-form count of multiple across tasks must match the actual
+# number of triplets
+def test_multiple_across_statistics():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c2'], 'c3')
+        nb_triplets = 0
+        for by, stats in task.by_stats.items():
+            for key, block in task.on_across_blocks[by].groups.items():
+                on, across = ABXpy.task.on_across_from_key(key)
+                n = task.on_across_triplets(
+                    by, on, across, block,
+                    dict(task.by_dbs[by].loc[block[0]]),
+                    with_regressors=False).shape[0]
+                assert stats['block_sizes'][key] == n
+                nb_triplets += n
+        assert task.stats['nb_triplets'] == nb_triplets
+        assert nb_triplets > 0
+    finally:
+        if os.path.exists('data.item'):
+            os.remove('data.item')
+
+
+def assert_same_datasets(f1, f2):
+    names1, names2 = [], []
+    f1.visit(names1.append)
+    f2.visit(names2.append)
+    assert sorted(names1) == sorted(names2)
+    for name in names1:
+        assert sorted(f1[name].attrs) == sorted(f2[name].attrs)
+        for key in f1[name].attrs:
+            assert np.array_equal(f1[name].attrs[key], f2[name].attrs[key])
+        if isinstance(f1[name], h5py.Dataset):
+            assert f1[name].dtype == f2[name].dtype
+            assert np.array_equal(f1[name][...], f2[name][...]), name
+
+
+# generating a task with several processes must give the same file as
+# with a single process
+def test_parallel_generation():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3',
+                               filters=["[attr != 1 for attr in c2]"],
+                               regressors=['c2_X'])
+        task.generate_triplets('data.abx', threshold=2, seed=0)
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3',
+                               filters=["[attr != 1 for attr in c2]"],
+                               regressors=['c2_X'])
+        task.generate_triplets('data2.abx', threshold=2, seed=0, n_jobs=3)
+        with h5py.File('data.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            assert_same_datasets(f1, f2)
+            assert set(f1['unique_pairs'].attrs) == set(f1['bys'][...])
+            assert len(f1['bys']) > 1
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# generating large blocks by chunks must give the same triplets as
+# generating them at once
+def test_chunked_generation():
+    items.generate_testitems(3, 4, name='data.item')
+    no_c2_pairs = "[a != x for a, x in zip(c2_A, c2_X)]"
+    try:
+        for across, filters, threshold in [
+                ('c1', [], None),
+                ('c1', ["[attr != 1 for attr in c2_A]"], None),
+                (None, [no_c2_pairs], None),
+                (['c1', 'c2'], [], None),
+                ('c1', [], 10)]:
+            for memory, output in [(1000, 'data.abx'), (1e-3, 'data2.abx')]:
+                task = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                       filters=filters)
+                task.generate_triplets(output, threshold=threshold,
+                                       memory=memory)
+            assert task.chunk_size < 10
+            with h5py.File('data.abx', 'r') as f1, \
+                    h5py.File('data2.abx', 'r') as f2:
+                assert np.array_equal(
+                    f1['triplets/on_across_block_index'][...],
+                    f2['triplets/on_across_block_index'][...])
+                for by in f1['bys']:
+                    triplets1 = set(map(tuple, get_triplets(f1, by)))
+                    triplets2 = set(map(tuple, get_triplets(f2, by)))
+                    if threshold is None:
+                        assert triplets1 == triplets2, error_triplets
+                        assert np.array_equal(get_pairs(f1, by),
+                                              get_pairs(f2, by)), error_pairs
+                    else:
+                        assert len(triplets1) == len(triplets2)
+            os.remove('data.abx')
+            os.remove('data2.abx')
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# with a threshold and a seed, the sampled triplets must not depend on
+# the memory used, whether the blocks are streamed or not
+def test_chunked_sampling():
+    items.generate_testitems(3, 4, name='data.item')
+    no_c2_pairs = "[a != x for a, x in zip(c2_A, c2_X)]"
+    try:
+        for across, filters in [
+                ('c1', []),
+                ('c1', ["[attr != 1 for attr in c2_A]"]),
+                ('c1', [no_c2_pairs]),
+                (None, [no_c2_pairs])]:
+            for memory, output in [(1000, 'data.abx'), (1e-3, 'data2.abx')]:
+                task = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                       filters=filters)
+                task.generate_triplets(output, threshold=3, seed=0,
+                                       memory=memory)
+            assert task.chunk_size < 10
+            with h5py.File('data.abx', 'r') as f1, \
+                    h5py.File('data2.abx', 'r') as f2:
+                assert_same_datasets(f1, f2)
+            os.remove('data.abx')
+            os.remove('data2.abx')
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# the unique pairs must be exactly the AX and BX pairs of the triplets
+def test_unique_pairs():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for across, filters, threshold in [
+                ('c1', [], None),
+                (None, ["[attr != 1 for attr in c2_B]"], None),
+                ('c1', ["[a != x for a, x in zip(c2_A, c2_X)]"], None),
+                ('c1', [], 10)]:
+            task = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                   filters=filters)
+            task.generate_triplets(threshold=threshold)
+            with h5py.File('data.abx', 'r') as f:
+                for by in f['bys']:
+                    base = f['unique_pairs'].attrs[by][0]
+                    triplets = get_triplets(f, by).astype(np.int64)
+                    expected = np.unique(np.concatenate(
+                        (triplets[:, 0] + base * triplets[:, 2],
+                         triplets[:, 1] + base * triplets[:, 2])))
+                    assert np.array_equal(
+                        get_pairs(f, by)[:, 0], expected), error_pairs
+            os.remove('data.abx')
+    finally:
+        for name in ['data.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# the virtual layout must store the same triplets and regressors as the
+# explicit one
+def test_virtual_layout():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for across, filters, n_jobs in [
+                ('c1', [], 1),
+                (['c1', 'c2'], [], 1),
+                (None, ["[attr != 1 for attr in c2_B]"], 1),
+                ('c1', [], 3)]:
+            for layout, output in [('explicit', 'data.abx'),
+                                   ('virtual', 'data2.abx')]:
+                task = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                       filters=filters)
+                task.generate_triplets(output, layout=layout, n_jobs=n_jobs)
+            with h5py.File('data.abx', 'r') as f1, \
+                    h5py.File('data2.abx', 'r') as f2:
+                assert f2.attrs['triplets_layout'] == 'virtual'
+                assert 'data' not in f2['triplets']
+                assert np.array_equal(f1['bys'][...], f2['bys'][...])
+                assert np.array_equal(f1['triplets/by_index'][...],
+                                      f2['triplets/by_index'][...])
+                for n_by, by in enumerate(f1['bys']):
+                    assert np.array_equal(get_pairs(f1, by),
+                                          get_pairs(f2, by)), error_pairs
+                    triplets = []
+                    for f in [f1, f2]:
+                        chunks = list(ABXpy.task.read_triplets(
+                            f, n_by, chunk_size=5, regressors=True))
+                        triplets.append(set(
+                            tuple(triplet) + tuple(codes)
+                            for chunk, regs in chunks
+                            for triplet, codes in zip(chunk, regs)))
+                    assert triplets[0] == triplets[1], error_triplets
+            os.remove('data.abx')
+            os.remove('data2.abx')
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# the storage profile must not change the content of the task file
+def test_storage_profiles():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for storage, compression in [
+                ('lzf', 'lzf'), ('gzip-9', 'gzip'),
+                ({'compression': None, 'chunk_rows': 7}, None)]:
+            for output, profile in [('data.abx', 'none'),
+                                    ('data2.abx', storage)]:
+                task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3')
+                task.generate_triplets(output, storage=profile)
+            with h5py.File('data.abx', 'r') as f1, \
+                    h5py.File('data2.abx', 'r') as f2:
+                for name in ['triplets/data', 'unique_pairs/data']:
+                    assert f1[name].compression is None
+                    assert f2[name].compression == compression
+                    assert np.array_equal(f1[name][...], f2[name][...])
+                    if compression is None:
+                        assert f2[name].chunks == (7, f2[name].shape[1])
+            os.remove('data.abx')
+            os.remove('data2.abx')
+
+            # empty fixed-size datasets cannot be chunked
+            with h5py.File('data.abx') as fh:
+                fh.create_dataset(
+                    'empty', shape=(0, 1), dtype=np.int64,
+                    **ABXpy.h5tools.np2h5.storage_options(
+                        storage, np.int64, 1, 0))
+                assert fh['empty'].chunks is None
+            os.remove('data.abx')
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# a task generated again must be taken from the cache, which must not
+# grow larger than its maximal size
+def test_task_cache():
+    items.generate_testitems(3, 4, name='data.item')
+    cache_dir = 'task_cache'
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3')
+        task.generate_triplets('data.abx', threshold=2, seed=0,
+                               cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 1
+        cached = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        # the entry and the files linked to it are read-only
+        assert not os.stat(cached).st_mode & 0o222
+        assert os.stat('data.abx').st_ino == os.stat(cached).st_ino
+        assert not os.stat('data.abx').st_mode & 0o222
+
+        # a hit links the entry instead of generating the task again,
+        # whatever the memory used
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3')
+        task.generate_triplets('data2.abx', threshold=2, seed=0,
+                               cache_dir=cache_dir, memory=1e-3)
+        assert len(os.listdir(cache_dir)) == 1
+        assert os.stat('data2.abx').st_ino == os.stat(cached).st_ino
+        assert not hasattr(task, 'chunk_size')
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3')
+        task.generate_triplets('data5.abx', threshold=2, seed=0)
+        with h5py.File('data5.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            assert_same_datasets(f1, f2)
+
+        # another task or another item file give another entry
+        task = ABXpy.task.Task('data.item', 'c0', 'c2', 'c3')
+        task.generate_triplets('data3.abx', cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+        items.generate_testitems(3, 4, name='data.item', repeats=2)
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3')
+        task.generate_triplets('data4.abx', cache_dir=cache_dir,
+                               cache_size=0)
+        assert len(os.listdir(cache_dir)) == 1
+        with h5py.File('data.abx', 'r') as f1, \
+                h5py.File('data4.abx', 'r') as f2:
+            assert f1['triplets/data'].shape != f2['triplets/data'].shape
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data3.abx', 'data4.abx',
+                     'data5.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+# the item database read from its binary sidecar must be the same as
+# the one parsed from the text file, and be updated with the item file
+def test_item_sidecar():
+    items.generate_testitems(3, 3, name='data.item')
+    sidecar = ABXpy.database.database.sidecar_name('data.item')
+    try:
+        db, _, feat_db = ABXpy.database.database.load(
+            'data.item', features_info=True)
+        db1, _, feat_db1 = ABXpy.database.database.load(
+            'data.item', features_info=True, sidecar=True)
+        assert os.path.exists(sidecar)
+        db2, _, feat_db2 = ABXpy.database.database.load(
+            'data.item', features_info=True, sidecar=True)
+        for frame, expected in [(db1, db), (db2, db), (feat_db1, feat_db),
+                                (feat_db2, feat_db)]:
+            assert frame.equals(expected)
+            # same column names and types, which end up pickled in the
+            # task files
+            assert ([type(col) for col in frame.columns] ==
+                    [type(col) for col in expected.columns])
+            assert list(frame.dtypes) == list(expected.dtypes)
+
+        # the second task reads the sidecar written by the first one
+        for name, sidecar_arg in [('data.abx', False), ('data2.abx', True),
+                                  ('data3.abx', True)]:
+            ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                            sidecar=sidecar_arg).generate_triplets(name)
+        with h5py.File('data.abx', 'r') as f1:
+            for name in ['data2.abx', 'data3.abx']:
+                with h5py.File(name, 'r') as f2:
+                    assert_same_datasets(f1, f2)
+
+        items.generate_testitems(3, 3, repeats=1, name='data.item')
+        db3, _ = ABXpy.database.database.load('data.item', sidecar=True)
+        assert len(db3) == 2 * len(db)
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data3.abx', 'data.item',
+                     sidecar]:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# the on/across blocks computed from integer codes must be the same as
+# the ones given by pandas groupby
+def test_coded_groups():
+    items.generate_named_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c2'], 'c3')
+        for by, db in task.by_dbs.iteritems():
+            # the 'on', 'across' and 'by' columns are stored as codes
+            db = db.copy()
+            for col in ['c0', 'c1', 'c2', 'c3']:
+                assert db[col].dtype.kind == 'i'
+                db[col] = task.code_tables[col][db[col].values]
+            assert set(db['c3']) == set([by])
+            for columns, blocks in [
+                    (task.on, task.on_blocks[by]),
+                    (task.across, task.across_blocks[by]),
+                    (task.on + task.across, task.on_across_blocks[by])]:
+                groups = db.groupby(columns)
+                assert blocks.size().equals(groups.size())
+                assert np.array_equal(blocks.ngroup().values,
+                                      groups.ngroup().values)
+                assert set(blocks.groups) == set(groups.groups)
+                for key, index in groups.groups.iteritems():
+                    assert np.array_equal(blocks.groups[key], index)
+    finally:
+        os.remove('data.item')
+
+
+# filters and regressors see the values of the coded columns, and the
+# indexes of the regressors are these values
+def test_coded_columns():
+    items.generate_named_testitems(3, 4, name='data.item')
+    try:
+        # c0_2 is decoded for the regressors, since it is not only used
+        # by a column regressor
+        task = ABXpy.task.Task(
+            'data.item', 'c0', 'c1', 'c3',
+            regressors=['[[len(attr) for attr in c0_2]]'])
+        assert 'c0_2' not in task.regressors.coded_variables
+        assert 'c1_1' in task.regressors.coded_variables
+        db = task.by_dbs['c3_v0']
+        results = list(task.regressors.evaluate_B({}, db, db.index.values))
+        assert results[0] == [[len('c0_v0')] * len(db)]
+        assert np.array_equal(results[1][0], db['c0'].values)
+
+        task = ABXpy.task.Task(
+            'data.item', 'c0', 'c1', 'c3',
+            filters=["[attr != 'c1_v1' for attr in c1]",
+                     "[attr != 'c0_v2' for attr in c0_X]"],
+            regressors=['c2_X'])
+        task.generate_triplets('data.abx')
+        with h5py.File('data.abx', 'r') as fh:
+            for by in fh['bys']:
+                db = task.by_dbs[by]
+                triplets = get_triplets(fh, by)
+                for col, positions in [('c1', triplets.ravel()),
+                                       ('c0', triplets[:, 2])]:
+                    values = task.code_tables[col][db[col][positions]]
+                    assert 'c1_v1' not in values and 'c0_v2' not in values
+                indexes = fh['regressors'][by]['indexes']
+                assert list(indexes['c1_1'][...]) == [
+                    'c1_v0', 'c1_v1', 'c1_v2']
+    finally:
+        for name in ['data.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# a saved and loaded task must have the same statistics and give the
+# same task file as the original task
+def test_save_load():
+    items.generate_testitems(3, 5, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c2'], 'c3',
+                               filters=["[attr != 1 for attr in c4]"])
+        task.save('data.task')
+        loaded = ABXpy.task.Task.load('data.task')
+        # the databases are only decoded when accessed
+        assert loaded.db is None
+        # a loaded task can be saved again
+        loaded.save('data2.task')
+        reloaded = ABXpy.task.Task.load('data2.task')
+        for key in ['nb_blocks', 'nb_triplets', 'nb_by_levels']:
+            assert loaded.stats[key] == task.stats[key]
+        for by, db in task.by_dbs.iteritems():
+            for other in [loaded, reloaded]:
+                assert other.by_dbs[by].equals(db)
+                assert other.feat_dbs[by].equals(task.feat_dbs[by])
+        task.generate_triplets('data.abx')
+        loaded.generate_triplets('data2.abx')
+        with h5py.File('data.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            assert_same_datasets(f1, f2)
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+        shutil.rmtree('data.task', ignore_errors=True)
+        shutil.rmtree('data2.task', ignore_errors=True)
+
+
+# the antiacross items found from the codes must be the items differing
+# from the across key in every across column
+def test_antiacross_index():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c2'], 'c3')
+        for by, db in task.by_dbs.iteritems():
+            antiacross = task.antiacross_blocks[by]
+            keys = task.across_blocks[by].keys()
+            counts = antiacross.group_counts(keys, task.on_blocks[by])
+            on_codes = task.on_blocks[by].ngroup().values
+            for key, key_counts in zip(keys, counts):
+                b = (db['c1'] != key[0]) & (db['c2'] != key[1])
+                assert np.array_equal(antiacross.items(key), db[b].index)
+                assert np.array_equal(
+                    key_counts,
+                    np.bincount(on_codes[b.values],
+                                minlength=len(task.on_blocks[by])))
+    finally:
+        os.remove('data.item')
+
+
+# without across, the statistics and the triplets computed per 'on' level
+# must match the ones of the block by block computation
+def test_no_across_filters():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', None, 'c3',
+                               filters=["[attr != 1 for attr in c1_B]",
+                                        "[attr != 2 for attr in c2_X]"])
+        nb_triplets = 0
+        for by, stats in task.by_stats.items():
+            for key, block in task.on_across_blocks[by].groups.items():
+                on, across = ABXpy.task.on_across_from_key(key)
+                n = task.on_across_triplets(
+                    by, on, across, block,
+                    dict(task.by_dbs[by].loc[block[0]]),
+                    with_regressors=False).shape[0]
+                assert stats['block_sizes'][key] == n
+                nb_triplets += n
+        assert task.stats['nb_triplets'] == nb_triplets
+        assert nb_triplets > 0
+        task.generate_triplets('data.abx')
+        with h5py.File('data.abx', 'r') as f:
+            assert f['triplets/data'].shape[0] == nb_triplets
+    finally:
+        for name in ['data.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# with lazy statistics, the exact statistics must be collected during
+# the generation, which must give the same task file
+def test_lazy_statistics():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for across in ['c1', ['c1', 'c2'], None]:
+            for n_jobs in [1, 2]:
+                filters = ["[attr != 1 for attr in c2_B]",
+                           "[attr != 2 for attr in c0_X]"]
+                task = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                       filters=filters)
+                lazy = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                       filters=filters, lazy_stats=True)
+                assert lazy.stats['approximate_nb_triplets']
+                assert lazy.stats['nb_triplets'] >= task.stats['nb_triplets']
+                task.generate_triplets('data.abx', n_jobs=n_jobs)
+                lazy.generate_triplets('data2.abx', n_jobs=n_jobs)
+                assert not lazy.stats['approximate_nb_triplets']
+                assert lazy.stats['nb_triplets'] == task.stats['nb_triplets']
+                for by, stats in task.by_stats.iteritems():
+                    assert lazy.by_stats[by]['block_sizes'] == \
+                        stats['block_sizes']
+                with h5py.File('data.abx', 'r') as f1, \
+                        h5py.File('data2.abx', 'r') as f2:
+                    assert np.array_equal(f1['triplets/data'][...],
+                                          f2['triplets/data'][...])
+                os.remove('data.abx')
+                os.remove('data2.abx')
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+# with lazy statistics, a task whose triplets are all filtered out must
+# not give a task file, as with exact statistics
+def test_lazy_statistics_no_triplets():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for n_jobs in [1, 2]:
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c3',
+                                   filters=["[attr < 0 for attr in c2_X]"],
+                                   lazy_stats=True)
+            assert task.stats['nb_triplets'] > 0
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                task.generate_triplets('data.abx', n_jobs=n_jobs)
+            assert not os.path.exists('data.abx')
+            assert task.stats['nb_triplets'] == 0
+            assert any('no possible ABX triplets' in str(w.message)
+                       for w in caught)
+    finally:
+        for name in ['data.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def test_global_sampling():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for across in ['c1', ['c1', 'c2'], None]:
+            task = ABXpy.task.Task('data.item', 'c0', across, 'c3')
+            task.generate_triplets('data.abx')
+            with h5py.File('data.abx', 'r') as fh:
+                all_triplets = get_all_triplets(fh)
+            for n_samples, n_jobs in [(50, 1), (50, 2), (10 ** 6, 1)]:
+                for name in ['data2.abx', 'data3.abx']:
+                    task = ABXpy.task.Task('data.item', 'c0', across, 'c3',
+                                           regressors=['c2_X'])
+                    task.generate_triplets(name, seed=1, n_jobs=n_jobs,
+                                           n_samples=n_samples)
+                with h5py.File('data2.abx', 'r') as f2, \
+                        h5py.File('data3.abx', 'r') as f3:
+                    assert_same_datasets(f2, f3)
+                    triplets = get_all_triplets(f2)
+                    assert len(triplets) == f2['triplets/data'].shape[0]
+                    assert len(triplets) == min(n_samples, len(all_triplets))
+                    assert triplets <= all_triplets
+                os.remove('data2.abx')
+                os.remove('data3.abx')
+            for n_samples in [0, -1]:
+                try:
+                    task.generate_triplets('data2.abx', n_samples=n_samples)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError('n_samples < 1 must be rejected')
+                assert not os.path.exists('data2.abx')
+            os.remove('data.abx')
+    finally:
+        for name in ['data.abx', 'data2.abx', 'data3.abx', 'data.item']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def test_sort_and_threshold():
+    new_index = np.random.randint(0, 50, 2000)
+    permut = np.argsort(new_index, kind='mergesort')
+    threshold = 30
+    np.random.seed(0)
+    sampled, unique_idx = ABXpy.task.sort_and_threshold(
+        permut, new_index, threshold=threshold)
+    np.random.seed(0)
+    sampled2, _ = ABXpy.task.sort_and_threshold(
+        permut, new_index, threshold=threshold)
+    assert np.array_equal(sampled, sampled2)
+    assert np.array_equal(unique_idx, np.flatnonzero(np.concatenate(
+        ([True], np.diff(new_index[permut]) != 0, [True]))))
+    for cell in np.unique(new_index):
+        items = permut[new_index[permut] == cell]
+        kept = sampled[new_index[sampled] == cell]
+        assert len(kept) == min(len(items), threshold)
+        # sampled without replacement and kept in sorted order
+        assert len(set(kept)) == len(kept)
+        assert np.array_equal(kept, items[np.in1d(items, kept)])
+    assert ABXpy.task.sort_and_threshold(
+        permut, new_index, threshold=threshold,
+        count_only=True) == len(sampled)
+
+    # each triplet of a sampled cell is kept with the same probability
+    permut = np.arange(10)
+    counts = np.zeros(10)
+    for i in range(2000):
+        counts[ABXpy.task.sort_and_threshold(
+            permut, np.zeros(10), threshold=3)[0]] += 1
+    assert np.all(np.abs(counts / 2000. - 0.3) < 0.05)
+
+
+def test_estimate_costs():
+    items.generate_named_testitems(3, 4, name='data.item')
+    items.generate_features(3 ** 4, max_frames=4, name='data.features')
+    # items spanning the whole file, with 1 to 4 frames
+    with open('data.item') as fid:
+        lines = [line.split() for line in fid]
+    for line in lines[1:]:
+        line[2] = '1'
+    with open('data.item', 'w') as fid:
+        fid.write(''.join(' '.join(line) + '\n' for line in lines))
+    try:
+        times = ABXpy.distances.distances.read_feature_times(
+            'data.features', 'features')
+        for across in ['c1', ['c1', 'c2'], None]:
+            task = ABXpy.task.Task('data.item', 'c0', across, 'c3')
+            costs = task.estimate_costs('data.features')
+            task.generate_triplets('data.abx')
+            n_cells = 0
+            with h5py.File('data.abx', 'r') as fh:
+                assert costs['nb_triplets'] == fh['triplets/data'].shape[0]
+                assert costs['nb_unique_pairs'] == \
+                    fh['unique_pairs/data'].shape[0]
+                for by in task.by_dbs:
+                    frames = ABXpy.distances.distances.item_frames(
+                        task.feat_dbs[by], times)
+                    pairs = get_pairs(fh, str(by))[:, 0]
+                    base = fh['unique_pairs'].attrs[str(by)][0]
+                    n_cells += np.sum(frames[pairs % base] *
+                                      frames[pairs // base])
+            assert costs['nb_frame_cells'] == n_cells
+            assert costs['distance_bytes'] == 8 * costs['nb_unique_pairs']
+            os.remove('data.abx')
+    finally:
+        for name in ['data.abx', 'data.item', 'data.features']:
+            if os.path.exists(name):
+                os.remove(name)
+
+
 # test_basic()
 # test_multiple_across()
 # test_no_across()
@@ -254,3 +939,20 @@ def test_filter_on_C():
 # test_filter_on_A()
 # test_filter_on_B()
 # test_filter_on_C()
+# test_whole_by_generation()
+# test_multiple_across_statistics()
+# test_parallel_generation()
+# test_chunked_generation()
+# test_unique_pairs()
+# test_virtual_layout()
+# test_storage_profiles()
+# test_task_cache()
+# test_item_sidecar()
+# test_coded_groups()
+# test_save_load()
+# test_antiacross_index()
+# test_no_across_filters()
+# test_lazy_statistics()
+# test_global_sampling()
+# test_sort_and_threshold()
+# test_estimate_costs()
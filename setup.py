@@ -78,5 +78,6 @@ setup(
         'abx-distance = ABXpy.distance:main',
         'abx-analyze = ABXpy.analyze:main',
         'abx-score = ABXpy.score:main',
+        'abx-features-store = ABXpy.distances.feature_store:main',
     ]}
 )